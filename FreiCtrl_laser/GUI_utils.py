@@ -1,4 +1,6 @@
 import logging, queue
+import time
+from collections import deque
 from enum import IntEnum
 from pathlib import Path
 from PyQt6 import QtSerialPort
@@ -52,7 +54,11 @@ class QtPicoSerial(QObject):
     of text."""
 
     # class variable with Qt signal used to communicate between background thread and serial port thread
-    _threadedWrite = pyqtSignal(bytes, name='threadedWrite')
+    _threadedWrite = pyqtSignal(bytes, bool, name='threadedWrite')
+    # frames are only handed to QSerialPort while less than this is waiting to be written,
+    # so urgent frames are not stuck behind large parameter uploads
+    MAX_BYTES_IN_FLIGHT = 64
+    CLOSE_TIMEOUT_MS = 1000  # max time close() waits for queued frames to be written
 
     def __init__(self, main, comm=None):
         super(QtPicoSerial, self).__init__()
@@ -64,6 +70,20 @@ class QtPicoSerial(QObject):
         self.log.setLevel(logging.DEBUG)
         self.main = main
         self.comm = comm
+        self.recorder = None  # SerialRecorder if traffic is captured
+        self._write_queue = deque()  # frames waiting to be handed to the port
+        self._urgent_queue = deque()  # frames which jump ahead of the write queue, e.g. TRIGGER
+
+    def start_capture(self, path):
+        """records all traffic on this port to a capture file, see serial_capture"""
+        from serial_capture import SerialRecorder
+        self.stop_capture()
+        self.recorder = SerialRecorder(path)
+
+    def stop_capture(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
     def is_open(self):
         return self._port is not None
@@ -96,6 +116,8 @@ class QtPicoSerial(QObject):
             self.log.info("Opened serial port %s", self._port.portName())
             # always process data as it becomes available
             self._port.readyRead.connect(self.read_input)
+            # hand over the next queued frame once the previous ones are written
+            self._port.bytesWritten.connect(self._drain_write_queue)
 
             # initialize the slot used to receive data from background threads
             self._threadedWrite.connect(self._data_send)
@@ -128,26 +150,71 @@ class QtPicoSerial(QObject):
         """Shut down the serial connection to the Pico."""
         if self._port is not None:
             self.log.info("Closing serial port %s", self._port.portName())
+            self.flush(self.CLOSE_TIMEOUT_MS)
+            n_dropped = len(self._write_queue) + len(self._urgent_queue)
+            if n_dropped:
+                self.log.warning(f"Dropping {n_dropped} unsent frames")
+            self._write_queue.clear()
+            self._urgent_queue.clear()
             self._port.close()
             self._port = None
+        self.stop_capture()
         return
 
-    def write(self, data):
-        if self._port is not None:
-            res = self._port.write(data)
-            self._port.flush()
-            # self.log.debug(f"writen{res} to serial")
-        else:
+    def flush(self, timeout_ms: int = CLOSE_TIMEOUT_MS) -> bool:
+        """
+        blocks until the queued frames, urgent ones first, are written to the port or timeout_ms passed,
+        returns True if everything was written
+        """
+        if self._port is None:
+            return False
+        deadline = time.monotonic() + timeout_ms / 1000
+        while self._urgent_queue or self._write_queue or self._port.bytesToWrite():
+            self._drain_write_queue()
+            remaining_ms = int((deadline - time.monotonic()) * 1000)
+            if remaining_ms <= 0 or not self._port.waitForBytesWritten(remaining_ms):
+                break
+        return not (self._urgent_queue or self._write_queue or self._port.bytesToWrite())
+
+    def write(self, data, urgent=False):
+        """
+        queues a frame for sending, the port drains the queue asynchronously without blocking the event loop.
+        urgent frames are send before any frame not yet handed to the port
+        """
+        if self._port is None:
             self.log.error("Serial port not open during write.")
+            return
+        if self.recorder is not None:
+            self.recorder.record_out(data)
+        if urgent:
+            self._urgent_queue.append(data)
+        else:
+            self._write_queue.append(data)
+        self._drain_write_queue()
+
+    @pyqtSlot(int)
+    def _drain_write_queue(self, _n_written=0):
+        """hands queued frames to the port, while little is waiting to be written"""
+        while self._port is not None and self._port.bytesToWrite() < self.MAX_BYTES_IN_FLIGHT:
+            if self._urgent_queue:
+                frame = self._urgent_queue.popleft()
+            elif self._write_queue:
+                frame = self._write_queue.popleft()
+            else:
+                return
+            res = self._port.write(frame)
+            if res != len(frame):
+                self.log.error(f"Writing to serial failed, {res} of {len(frame)} bytes written")
+            # self.log.debug(f"writen{res} to serial")
 
-    @pyqtSlot(bytes)
-    def _data_send(self, data):
+    @pyqtSlot(bytes, bool)
+    def _data_send(self, data, urgent):
         """Slot to receive serial data on the main thread."""
-        self.write(data)
+        self.write(data, urgent=urgent)
 
-    def thread_safe_write(self, data):
+    def thread_safe_write(self, data, urgent=False):
         """Function to receive data to transmit from a background thread, then send it as a signal to a slot on the main thread."""
-        self._threadedWrite.emit(data)
+        self._threadedWrite.emit(data, urgent)
 
     def read_input(self):
         # Read as much input as available; callback from Qt event loop.
@@ -169,7 +236,10 @@ class QtPicoSerial(QObject):
     def data_received(self, data):
         # Manage the possibility of partial reads by appending new data to any previously received partial line.
         # The data arrives as a PyQT5.QtCore.QByteArray.
-        self._buffer += bytes(data)
+        data = bytes(data)
+        if self.recorder is not None:
+            self.recorder.record_in(data)
+        self._buffer += data
 
         # Process all complete newline-terminated lines.
         while b'\n' in self._buffer:
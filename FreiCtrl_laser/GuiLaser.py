@@ -8,7 +8,7 @@ from threading import Thread
 
 import numpy as np
 from PyQt6.QtWidgets import QApplication, QMainWindow, QFileDialog
-from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtCore import Qt, QTimer, pyqtSignal
 
 from PyQt6 import uic, QtSerialPort, QtGui
 
@@ -16,6 +16,7 @@ from pathlib import Path
 from datetime import datetime
 from host_utils import PythonBoardCommander
 from GUI_utils import QtPicoSerial
+from socket_utils import TriggerEndpoint
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from luxx_communication import LaserColor, TriggerEnum
@@ -44,6 +45,10 @@ class MplCanvas(FigureCanvasQTAgg):
 
 
 class GuiLaser(QMainWindow):
+    # network triggers are handed from the TriggerEndpoint thread to the GUI thread, with their receive time
+    _network_triggered = pyqtSignal(object)
+    MAX_SETTLE_PASSES = 10  # recompute passes of one flush, derived setValue calls can mark channels dirty again
+
     def __init__(self, main=None):
         super(GuiLaser, self).__init__()
         self.laser_module = None
@@ -53,7 +58,11 @@ class GuiLaser(QMainWindow):
         self.calib_tread = None
         self.lasercalib_path = Path("laser_cal")
         self.trigger_log = {'name': datetime.now().strftime('%Y%m%d%H%M%S'),
-                            'manual_triggers': []}  # save data about trigger events
+                            'manual_triggers': [], 'network_triggers': []}  # save data about trigger events
+        # trigger log is written to disk in the background, to not delay triggers
+        self.trigger_log_queue = queue.Queue()
+        self.trigger_log_thread = Thread(target=self._trigger_log_worker, daemon=True)
+        self.trigger_log_thread.start()
         self.current_params = {}
         self.laser1_attenuation = 1
         self.laser2_attenuation = 1
@@ -75,6 +84,13 @@ class GuiLaser(QMainWindow):
             self.communicator = PythonBoardCommander(self.pico)
             self.pico.comm = self.communicator  # looping interaction.. not great!
 
+        self.trigger_endpoint = None
+        if self.main is None and TRIGGER_PORT is not None:  # remote rigs can trigger the lasers via network
+            self._network_triggered.connect(self._run_network_trigger)
+            self.trigger_endpoint = TriggerEndpoint(self.network_trigger, host=TRIGGER_HOST, port=TRIGGER_PORT,
+                                                    allowed_hosts=TRIGGER_ALLOWED_HOSTS)
+            self.trigger_endpoint.start()
+
         self.log = logging.getLogger('Laser-GUI')
         self._handler = None
         self.consoleOutput.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAsNeeded)
@@ -84,6 +100,16 @@ class GuiLaser(QMainWindow):
         self.console_timer.timeout.connect(self._poll_console_queue)
         self.console_timer.start(50)  # units are milliseconds
 
+        # coalesce GUI edits: slots only mark what changed, a single timer flush recomputes/redraws/sends
+        self._dirty_pulse = {}  # channel idx -> 'pulse' or 'duty', whichever was edited last
+        self._dirty_power = set()  # channel idx with changed power settings
+        self._preview_dirty = False
+        self._send_pending = False
+        self.update_timer = QTimer()
+        self.update_timer.setSingleShot(True)
+        self.update_timer.setInterval(EDIT_COALESCE_MS)
+        self.update_timer.timeout.connect(self._flush_updates)
+
         self.task_is_running = False
         self.enable_console_logging()
         self.parameters_send = False  # Bool if parameters were send for this session
@@ -150,6 +176,11 @@ class GuiLaser(QMainWindow):
     def power_calc(self):
         sender = self.sender()  # which power was changed
         idx = [idx for idx, b in enumerate(self.laser_power_list) if b == sender][0]
+        self._dirty_power.add(idx)
+        self._schedule_update()
+
+    def _update_attenuation(self, idx: int):
+        """recalculates the attenuation factor of laser idx from its power setting"""
         self.laser_attenuationValues_list[idx] = ((self.laser_power_list[idx].value() - self.calib_data[idx]['b'])
                                                   / self.calib_data[idx]['m'])
 
@@ -160,21 +191,89 @@ class GuiLaser(QMainWindow):
 
         self.log.info(f"Laser{idx+1} was set to {self.laser_attenuationValues_list[idx]} for "
                       f"{self.laser_power_list[idx].value()}mW")
-        self.show_example()
+
+    def _schedule_update(self):
+        """arms the coalescing timer, all edits until it fires are handled by one flush"""
+        if not self.update_timer.isActive():
+            self.update_timer.start()
+
+    def request_preview(self):
+        """marks the pulse preview as outdated, it is redrawn on the next flush"""
+        self._preview_dirty = True
+        self._schedule_update()
+
+    def _flush_updates(self):
+        """
+        recomputes derived values of all dirty channels, sends the latest parameters if requested
+        and redraws the preview once
+        """
+        n_passes = 0
+        while self._dirty_pulse or self._dirty_power:
+            if n_passes == self.MAX_SETTLE_PASSES:
+                break
+            n_passes += 1
+            dirty_pulse, self._dirty_pulse = self._dirty_pulse, {}
+            dirty_power, self._dirty_power = self._dirty_power, set()
+            for idx, source in dirty_pulse.items():
+                if source == 'duty':
+                    self._update_pulse_from_duty(idx)
+                else:
+                    self._update_duty_from_pulse(idx)
+            for idx in dirty_power:
+                self._update_attenuation(idx)
+            self._preview_dirty = True
+        self.update_timer.stop()  # everything requested so far is handled by this flush
+        if self._dirty_pulse or self._dirty_power:  # values did not settle, handle the rest with the next flush
+            self.log.warning(f"Channel updates did not settle after {n_passes} passes, rescheduling")
+            self.update_timer.start()
+        if self._send_pending:
+            self._send_latest_params()
+        if self._preview_dirty:
+            self._preview_dirty = False
+            self.show_example()
 
     def start_task(self):
+        self._trigger('manual_triggers')
+
+    def network_trigger(self, t_received: int):
+        """called from the TriggerEndpoint thread, the trigger is send from the GUI thread like a manual one"""
+        self._network_triggered.emit(t_received)
+
+    def _run_network_trigger(self, t_received: int):
+        self._trigger('network_triggers', t_received)
+
+    def _trigger(self, log_key: str, t_received: int = None):
         message = ('TRIGGER' + '\n').encode('utf-8')
+        if self._send_pending:  # make sure the board runs the latest parameters
+            self._flush_updates()
 
         if self.main is None:  # stand alone
-            self.pico.write(message)
+            self.pico.write(message, urgent=True)
+            if t_received is not None and self.trigger_endpoint is not None:
+                self.trigger_endpoint.record_latency(t_received)  # frame is queued or handed to the port
             now = time.ctime(time.time())
-            self.trigger_log['manual_triggers'].append((now, self.current_params))
-            # write to disk
-            with open(f"laserLog_{self.trigger_log['name']}.json", 'w') as fi:
-                json.dump(self.trigger_log, fi, indent=4)
+            self.trigger_log[log_key].append((now, self.current_params))
+            self.trigger_log_queue.put(self._trigger_log_snapshot())  # write to disk
         else:
             self.main.pico.write(message)
 
+    def _trigger_log_snapshot(self) -> dict:
+        """copy of the trigger log for the writer thread, the GUI thread keeps appending to the original"""
+        return {key: list(value) if isinstance(value, list) else value for key, value in self.trigger_log.items()}
+
+    def _trigger_log_worker(self):
+        """writes the trigger log snapshots put in the queue, snapshots piling up are merged into one write"""
+        stop = False
+        while not stop:
+            requests = [self.trigger_log_queue.get()]
+            while not self.trigger_log_queue.empty():
+                requests.append(self.trigger_log_queue.get())
+            stop = None in requests  # None signals the app is exiting
+            snapshots = [request for request in requests if request is not None]
+            if snapshots and (snapshots[-1]['manual_triggers'] or snapshots[-1]['network_triggers']):
+                with open(f"laserLog_{snapshots[-1]['name']}.json", 'w') as fi:
+                    json.dump(snapshots[-1], fi, indent=4)
+
     def get_params(self) -> dict:
         """
         gets the current parameters as a dict
@@ -318,6 +417,12 @@ class GuiLaser(QMainWindow):
         return params
 
     def send_params(self):
+        """requests a parameter upload, repeated requests before the next flush result in one send"""
+        self._send_pending = True
+        self._schedule_update()
+
+    def _send_latest_params(self):
+        self._send_pending = False
         params = self.get_params()
         message = (json.dumps(params) + '\n').encode('utf-8')
         # self.pico.thread_safe_write(message)
@@ -637,14 +742,14 @@ class GuiLaser(QMainWindow):
             ele.toggled.connect(self.set_square)
 
         for ele in self.laser_duration_list + self.laser_delay_list + self.laser_attenuation_list:
-            ele.valueChanged.connect(self.show_example)
+            ele.valueChanged.connect(self.request_preview)
 
         for check in [self.lasercheck1, self.lasercheck2, self.lasercheck3, self.lasercheck4,
                       self.maskcheck1, self.maskcheck2, self.maskcheck3, self.maskcheck4]:
-            check.stateChanged.connect(self.show_example)
+            check.stateChanged.connect(self.request_preview)
 
         for combo in self.wave_length_list:
-            combo.currentIndexChanged.connect(self.show_example)
+            combo.currentIndexChanged.connect(self.request_preview)
 
         for power in self.laser_power_list:
             power.valueChanged.connect(self.power_calc)
@@ -673,7 +778,7 @@ class GuiLaser(QMainWindow):
             self.Laser_burst_attenuation_4.blockSignals(True)
             self.Laser_burst_attenuation_4.setValue(0)
             self.Laser_burst_attenuation_4.blockSignals(False)
-        self.show_example()
+        self.request_preview()
 
     def set_sine(self):
         sender = self.sender()  # Get the sender of the signal
@@ -685,18 +790,30 @@ class GuiLaser(QMainWindow):
             self.Laser_burst_pulsewidth_3.setValue(int(1000 / self.Laser_burst_freq_3.value() * 0.5))
         elif sender == self.radioSine_5 or sender == self.radioHSine_5:
             self.Laser_burst_pulsewidth_4.setValue(int(1000 / self.Laser_burst_freq_4.value() * 0.5))
-        self.show_example()
+        self.request_preview()
 
     def set_pulsedur(self):
         """
-        sets the pulse duration and duty cycle according to pulse_freq
+        marks the pulse duration and duty cycle of the channel to be updated according to pulse_freq
         """
         sender = self.sender()  # Get the sender of the signal
         try:
             idx = [idx for idx, slider in enumerate(self.laser_pulsew_list) if slider == sender][0]
         except IndexError:
             idx = [idx for idx, slider in enumerate(self.laser_freq_list) if slider == sender][0]
+        self._dirty_pulse[idx] = 'pulse'
+        self._schedule_update()
+
+    def set_pulseduty(self):
+        sender = self.sender()  # Get the sender of the signal
+        idx = [idx for idx, slider in enumerate(self.laser_duty_list) if slider == sender][0]
+        self._dirty_pulse[idx] = 'duty'
+        self._schedule_update()
 
+    def _update_duty_from_pulse(self, idx: int):
+        """
+        sets the pulse duration and duty cycle of laser idx according to pulse_freq
+        """
         pulse = self.laser_pulsew_list[idx].value()
         if pulse > self.laser_duration_list[idx].value():
             self.laser_duration_list[idx].setValue(pulse)
@@ -710,11 +827,8 @@ class GuiLaser(QMainWindow):
         self.laser_duty_list[idx].blockSignals(True)
         self.laser_duty_list[idx].setValue(duty)
         self.laser_duty_list[idx].blockSignals(False)
-        self.show_example()
 
-    def set_pulseduty(self):
-        sender = self.sender()  # Get the sender of the signal
-        idx = [idx for idx, slider in enumerate(self.laser_duty_list) if slider == sender][0]
+    def _update_pulse_from_duty(self, idx: int):
         freq = self.laser_freq_list[idx].value()
         duty = self.laser_duty_list[idx].value()
         pulse = int(1000 / freq * duty / 100)
@@ -723,7 +837,6 @@ class GuiLaser(QMainWindow):
         self.laser_pulsew_list[idx].blockSignals(False)
         if pulse > self.laser_duration_list[idx].value():  # modify total duration accordingly
             self.laser_duration_list[idx].setValue(pulse)
-        self.show_example()
 
     def get_values2plot(self, pulse_train_dur, total_duration, freq, duty, stype, delay, atten) -> tuple:
         tx = [v for v in range(0, total_duration, self.fs_show)]
@@ -1010,6 +1123,12 @@ class GuiLaser(QMainWindow):
             self._handler = None
 
     def app_is_exiting(self):
+        if self.trigger_endpoint is not None:
+            self.trigger_endpoint.stop()
+            self.log.info(f"Network trigger latency in us: {self.trigger_endpoint.latency_stats()}")
+        self.trigger_log_queue.put(self._trigger_log_snapshot())  # write last triggers
+        self.trigger_log_queue.put(None)  # and stop the writer
+        self.trigger_log_thread.join()
         if self.main is None:
             self.pico.close()  # close serial port
         self.disable_console_logging()
@@ -1,2 +1,9 @@
 USE_OMICRON = False   # True: enable Omicron laser control, False: disable Omicron laser control
-CALIB_STEPS = [.1, .4, .7, 1]   # Calibration steps for the laser power
\ No newline at end of file
+CALIB_STEPS = [.1, .4, .7, 1]   # Calibration steps for the laser power
+EDIT_COALESCE_MS = 20   # GUI edits arriving within this interval (ms) are merged into one recompute/redraw/send
+TRIGGER_PORT = None   # port of the network trigger endpoint (socket_utils.TriggerEndpoint), None: disabled
+TRIGGER_HOST = '127.0.0.1'   # interface the trigger endpoint listens on, '' for all interfaces
+TRIGGER_ALLOWED_HOSTS = None   # addresses allowed to trigger, e.g. ['127.0.0.1', '10.0.0.12'], None: any peer
+SSL_CERT_FILE = None   # certificate (PEM) of the socket server for SocketComm TLS links, None: no certificate
+SSL_KEY_FILE = None   # private key of SSL_CERT_FILE, None: key is contained in the certificate file
+SSL_CA_FILE = None   # certificate(s) trusted by SocketComm clients, e.g. the self-signed server cert, None: system CAs
@@ -0,0 +1,290 @@
+"""
+Background copying and deleting of session files, so file transfers do not block the thread handling socket
+messages. Jobs are queued and run by a pool of worker threads. Files are copied in chunks to a temporary file
+which is checked against a checksum computed while reading the source before it replaces the target.
+Files already present at the target with the same size and modification time (or the same checksum) are skipped.
+Progress is reported per job, optionally as events of an EventBus.
+"""
+import hashlib
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from socket_utils import (ClientConnection, EventBus, EventTopic, MessageStatus, MessageType, SocketMessage,
+                          SocketServer)
+
+CHUNK_SIZE = 1 << 20  # bytes per read/write, large enough for hashlib to release the GIL
+SESSION_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]+')  # no glob characters, separators or dots
+SESSION_FILE_SUFFIX = '_behav'  # session files are <session_id>_behav.<ext>, see host_utils.DataWriter
+
+
+def file_checksum(path: (str, Path), chunk_size: int = CHUNK_SIZE) -> str:
+    """sha256 of a file, read in chunks"""
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as fi:
+        for chunk in iter(lambda: fi.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def is_unchanged(source: Path, target: Path, compare_checksum: bool = False) -> bool:
+    """
+    True if target is a copy of source, judged by size and mtime (copystat keeps it), or checksum if the mtime
+    differs. Mtimes equal only to the second, e.g. rounded by the target file system or a file rewritten within
+    the same second, are always checked by checksum.
+    """
+    try:
+        target_stat = target.stat()
+    except FileNotFoundError:
+        return False
+    source_stat = source.stat()
+    if source_stat.st_size != target_stat.st_size:
+        return False
+    if source_stat.st_mtime_ns == target_stat.st_mtime_ns:
+        return True
+    if int(source_stat.st_mtime) == int(target_stat.st_mtime):
+        return file_checksum(source) == file_checksum(target)
+    return compare_checksum and file_checksum(source) == file_checksum(target)
+
+
+def copy_file(source: Path, target: Path, chunk_size: int = CHUNK_SIZE):
+    """copies source via a temporary file, verifies the checksum, yields the bytes copied per chunk"""
+    temp_file = target.with_name(target.name + '.part')
+    checksum = hashlib.sha256()
+    try:
+        with open(source, 'rb') as fi, open(temp_file, 'wb') as fo:
+            for chunk in iter(lambda: fi.read(chunk_size), b''):
+                checksum.update(chunk)
+                fo.write(chunk)
+                yield len(chunk)
+            fo.flush()
+            os.fsync(fo.fileno())
+        if file_checksum(temp_file, chunk_size) != checksum.hexdigest():
+            raise OSError(f"Checksum mismatch copying {source.name}")
+        shutil.copystat(source, temp_file)
+        os.replace(temp_file, target)
+    finally:
+        if temp_file.exists():
+            temp_file.unlink()
+
+
+class TransferJob:
+    """files to copy to a target directory, or to delete if target is None"""
+    COPY = 'copy'
+    PURGE = 'purge'
+
+    def __init__(self, job_id: str, kind: str, files: list, target: Path = None, on_done=None):
+        self.job_id = job_id
+        self.kind = kind
+        self.files = [Path(file) for file in files]
+        self.target = None if target is None else Path(target)
+        self.on_done = on_done  # called with the job when it is finished
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.copied = []
+        self.deleted = []
+        self.skipped = []
+        self.failed = []  # (file, error)
+        self.finished = threading.Event()
+
+    @property
+    def ok(self) -> bool:
+        return self.finished.is_set() and not self.failed
+
+    def summary(self) -> dict:
+        return {'job_id': self.job_id, 'kind': self.kind, 'total_bytes': self.total_bytes,
+                'done_bytes': self.done_bytes, 'copied': [file.name for file in self.copied],
+                'deleted': [file.name for file in self.deleted],
+                'skipped': [file.name for file in self.skipped],
+                'failed': [(None if file is None else file.name, error) for file, error in self.failed]}
+
+
+class FileTransferService:
+    """
+    Worker pool copying and deleting files in the background
+
+    :param n_workers: number of jobs running at the same time
+    :param event_bus: if given, progress and results are published as transfer.progress/transfer.done events
+    :param compare_checksum: also compare checksums of files of equal size but different mtime before skipping
+    :param progress_interval: s between progress events of a job
+    """
+
+    def __init__(self, n_workers: int = 2, event_bus: EventBus = None, compare_checksum: bool = True,
+                 chunk_size: int = CHUNK_SIZE, progress_interval: float = 0.2):
+        self.log = logging.getLogger('FileTransferService')
+        self.n_workers = n_workers
+        self.event_bus = event_bus
+        self.compare_checksum = compare_checksum
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.jobs = {}  # job_id -> TransferJob
+        self.job_queue = queue.Queue()
+        self.workers = []
+        self.source_dir = None  # directory with the session files for copy_files/purge_files messages
+        self.target_root = None  # session_path of copy_files messages must be below it
+        self._job_counter = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for w_id in range(self.n_workers):
+            worker = threading.Thread(target=self._work, name=f'FileTransfer_{w_id}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, wait: bool = True):
+        """stops the workers after the queued jobs are done, or right after the running ones if wait is False"""
+        if not wait:
+            while True:
+                try:
+                    self.job_queue.get_nowait()
+                except queue.Empty:
+                    break
+        for _ in self.workers:
+            self.job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def submit_copy(self, files: list, target: (str, Path), on_done=None, job_id: str = None) -> TransferJob:
+        """queues copying files into the directory target"""
+        return self._submit(TransferJob(job_id or self._new_job_id(), TransferJob.COPY, files, target, on_done))
+
+    def submit_purge(self, files: list, on_done=None, job_id: str = None) -> TransferJob:
+        """queues deleting files"""
+        return self._submit(TransferJob(job_id or self._new_job_id(), TransferJob.PURGE, files, None, on_done))
+
+    def register(self, server: SocketServer, source_dir: (str, Path), target_root: (str, Path)):
+        """
+        handles copy_files/purge_files messages of server clients: the files of the session in source_dir are
+        copied to the session_path of the message, which must be below target_root, or deleted.
+        The client gets a response when the job is done, or right away if the message is refused.
+        """
+        self.source_dir = Path(source_dir)
+        self.target_root = Path(target_root).resolve()
+        server.register_handler(MessageType.copy_files, lambda client, message: self._copy_files(server, client,
+                                                                                              message))
+        server.register_handler(MessageType.purge_files, lambda client, message: self._purge_files(server, client,
+                                                                                                message))
+
+    def session_files(self, session_id: str) -> list:
+        """the files <session_id>_behav.<ext> in source_dir, raises ValueError for an invalid session_id"""
+        if not isinstance(session_id, str) or not SESSION_ID_PATTERN.fullmatch(session_id):
+            raise ValueError(f"Invalid session_id {session_id!r}")
+        prefix = f'{session_id}{SESSION_FILE_SUFFIX}.'
+        return sorted(file for file in self.source_dir.iterdir()
+                      if file.name.startswith(prefix) and '.' not in file.name[len(prefix):] and file.is_file())
+
+    def session_target(self, session_path: str) -> Path:
+        """session_path resolved, raises ValueError if it is not below target_root"""
+        if not isinstance(session_path, str) or not session_path:
+            raise ValueError(f"Invalid session_path {session_path!r}")
+        target = Path(session_path).resolve()
+        if self.target_root is None or self.target_root not in target.parents:
+            raise ValueError(f"session_path {session_path} is not below {self.target_root}")
+        return target
+
+    def _copy_files(self, server: SocketServer, client: ClientConnection, message: dict):
+        def respond(job):
+            response = SocketMessage.respond_copy if job.ok else SocketMessage.respond_copy_fail
+            server.send(client, dict(response, job_id=job.job_id))
+
+        try:
+            files = self.session_files(message.get('session_id'))
+            target = self.session_target(message.get('session_path'))
+        except ValueError as e:
+            self.log.warning(f"Refused copy_files from {client.addr}: {e}")
+            server.send(client, dict(SocketMessage.respond_copy_fail, error=str(e)))
+            return
+        self.submit_copy(files, target, on_done=respond)
+
+    def _purge_files(self, server: SocketServer, client: ClientConnection, message: dict):
+        def respond(job):
+            status = MessageStatus.purge_ok if job.ok else MessageStatus.purge_fail
+            server.send(client, {'type': MessageType.response.value, 'status': status.value, 'job_id': job.job_id})
+
+        try:
+            files = self.session_files(message.get('session_id'))
+        except ValueError as e:
+            self.log.warning(f"Refused purge_files from {client.addr}: {e}")
+            server.send(client, {'type': MessageType.response.value, 'status': MessageStatus.purge_fail.value,
+                                 'error': str(e)})
+            return
+        self.submit_purge(files, on_done=respond)
+
+    def _new_job_id(self) -> str:
+        with self._lock:
+            self._job_counter += 1
+            return f'job{self._job_counter}'
+
+    def _submit(self, job: TransferJob) -> TransferJob:
+        self.jobs[job.job_id] = job
+        self.job_queue.put(job)
+        self.log.debug(f"Queued {job.kind} of {len(job.files)} files as {job.job_id}")
+        return job
+
+    def _work(self):
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                return
+            try:
+                if job.kind == TransferJob.COPY:
+                    self._run_copy(job)
+                else:
+                    self._run_purge(job)
+            except Exception as e:  # keep the worker alive
+                self.log.exception(f"{job.job_id} failed")
+                job.failed.append((job.target, str(e)))
+            job.finished.set()
+            if job.failed:
+                self.log.warning(f"{job.job_id}: {len(job.failed)} files failed: {job.failed}")
+            else:
+                self.log.info(f"{job.job_id}: {job.kind} done, {len(job.copied) + len(job.deleted)} files, "
+                              f"{len(job.skipped)} skipped")
+            self._publish(EventTopic.transfer_done, job.summary())
+            if job.on_done is not None:
+                try:
+                    job.on_done(job)
+                except Exception:  # e.g. the response to a client which is gone, keep the worker alive
+                    self.log.exception(f"on_done of {job.job_id} failed")
+
+    def _run_copy(self, job: TransferJob):
+        job.target.mkdir(parents=True, exist_ok=True)
+        job.total_bytes = sum(file.stat().st_size for file in job.files if file.exists())
+        last_progress = 0
+        for file in job.files:
+            target = job.target / file.name
+            try:
+                if is_unchanged(file, target, self.compare_checksum):
+                    job.skipped.append(file)
+                    job.done_bytes += file.stat().st_size
+                    continue
+                for n_bytes in copy_file(file, target, self.chunk_size):
+                    job.done_bytes += n_bytes
+                    if time.monotonic() - last_progress > self.progress_interval:
+                        last_progress = time.monotonic()
+                        self._publish(EventTopic.transfer_progress,
+                                      {'job_id': job.job_id, 'file': file.name, 'done_bytes': job.done_bytes,
+                                       'total_bytes': job.total_bytes})
+                job.copied.append(file)
+            except OSError as e:
+                job.failed.append((file, str(e)))
+
+    def _run_purge(self, job: TransferJob):
+        for file in job.files:
+            try:
+                file.unlink()
+                job.deleted.append(file)
+            except FileNotFoundError:
+                job.skipped.append(file)
+            except OSError as e:
+                job.failed.append((file, str(e)))
+
+    def _publish(self, topic: EventTopic, data: dict):
+        if self.event_bus is not None:
+            self.event_bus.publish(topic, data)
@@ -1,5 +1,7 @@
 # this code is a starting point for the host-application communicating with the CircuitPython
+import math
 import time
+from functools import lru_cache
 from uuid import UUID
 
 import numpy as np
@@ -28,240 +30,269 @@ ser.write(params.encode())
 """
 
 
+@lru_cache(maxsize=None)
+def _message_layout(message_type: str, fields: tuple) -> tuple:
+    """precompiled head and key prefixes of a message type, keeps key order and separators of json.dumps"""
+    head = '{"message_type": ' + json.dumps(message_type)
+    return head, tuple(f', {json.dumps(field)}: ' for field in fields)
+
+
+def _encode_message(message_type: str, fields: tuple, values: tuple) -> bytes:
+    head, keys = _message_layout(message_type, fields)
+    parts = [head]
+    for key, value in zip(keys, values):
+        parts.append(key)
+        parts.append(json.dumps(value))
+    parts.append('}\n')
+    return ''.join(parts).encode('utf-8')
+
+
+class BoardMessage:
+    """
+    Base of the messages send to the board. Subclasses define the message_type and the fields that are
+    serialised, so encoding only touches the fields of the message itself.
+    """
+    __slots__ = ()
+    message_type = None
+    fields = ()
+
+    def values(self) -> tuple:
+        return tuple(getattr(self, field) for field in self.fields)
+
+    def to_dict(self) -> dict:
+        dictionary = {'message_type': self.message_type}
+        dictionary.update(zip(self.fields, self.values()))
+        return dictionary
+
+    def get_bytes(self) -> bytes:
+        return _encode_message(self.message_type, self.fields, self.values())
+
+
+class CommandMessage(BoardMessage):
+    """Command for the board, all command types share the same fields"""
+    __slots__ = ('message_type', 'command', 'params', 'gate')
+    fields = ('command', 'params', 'gate')
+
+    def __init__(self, message_type: str, command: str = None, params=None, gate: str = None):
+        self.message_type = message_type
+        self.command = command
+        self.params = params
+        self.gate = gate
+
+    def get_bytes(self) -> bytes:
+        if isinstance(self.params, _SCALARS):
+            return _encode_command(self.message_type, self.command, self.params, self.gate)
+        # typed caching only tells the top level arguments apart, (1,) and (1.0,) would share an entry
+        return super().get_bytes()
+
+
+_SCALARS = (str, int, float, bool, type(None))
+
+
+@lru_cache(maxsize=256, typed=True)
+def _encode_command(message_type: str, command: str, params, gate: str) -> bytes:
+    """commands are repeated a lot (ping, reward, ...), cache their encoded bytes, params must be a scalar"""
+    return _encode_message(message_type, CommandMessage.fields, (command, params, gate))
+
+
+class TaskParametersMessage(BoardMessage):
+    """Task parameters, the fields are the keys of the parameter dictionary"""
+    __slots__ = ('fields', '_values')
+    message_type = "TaskParameters"
+
+    def __init__(self, params: dict):
+        params = {key: value for key, value in params.items() if key != 'message_type'}
+        self.fields = tuple(params.keys())
+        self._values = tuple(params.values())
+
+    def values(self) -> tuple:
+        return self._values
+
+
+class LaserParamsMessage(BoardMessage):
+    """Laser settings as produced by GuiLaser.get_params"""
+    __slots__ = ('fields', '_values')
+    message_type = "LaserParams"
+
+    def __init__(self, params: dict):
+        params = {key: value for key, value in params.items() if key != 'message_type'}
+        self.fields = tuple(params.keys())
+        self._values = tuple(params.values())
+
+    def values(self) -> tuple:
+        return self._values
+
+
 class PythonBoardCommander:
     def __init__(self, ser: serial.Serial):
 
         self.log = logging.getLogger('PythonBoardComm')
         self.serial = ser
-        self.message_type = None
-        self.command = None
-        self.params = None
-        self.gate = None
         self.received = ""
         self.waiting_forecho = False
         self.waiting_forpong = False
-        self.params_names = None
         self.mess_in = []
+        self.recorder = None  # SerialRecorder if traffic is captured here and not by the serial itself
         # self.serial.reset_output_buffer()  # make sure buffers are empty
         # self.serial.reset_input_buffer()
 
     def clear_message_queu(self):
         self.mess_in = []
 
+    def start_capture(self, path):
+        """records the traffic to a capture file, see serial_capture. QtPicoSerial records itself"""
+        if hasattr(self.serial, 'start_capture'):
+            self.serial.start_capture(path)
+        else:
+            from serial_capture import SerialRecorder
+            self.stop_capture()
+            self.recorder = SerialRecorder(path)
+
+    def stop_capture(self):
+        if hasattr(self.serial, 'stop_capture'):
+            self.serial.stop_capture()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def _write(self, data: bytes):
+        if self.recorder is not None:
+            self.recorder.record_out(data)
+        self.serial.write(data)
+
+    def expect_echo(self, message: bytes):
+        """registers a message send to the board, whose echo is awaited"""
+        self.mess_in.append(message)
+        self.waiting_forecho = True
+
     def send_laser_params(self, dictionary: dict):
-        dictionary['message_type'] = "LaserParams"
-        self.serial.write(f'{json.dumps(dictionary)}\n'.encode('utf-8'))
+        self._write(LaserParamsMessage(dictionary).get_bytes())
 
     def send_task_params(self, dictionary: dict):
-        self.message_type = "TaskParameters"
-        self.params_names = dictionary.keys()
-        self.__dict__.update(**dictionary)
         self.log.info('Sending Task parameters')
-        self.send_command()
+        self.send_message(TaskParametersMessage(dictionary))
 
     def send_StartTask(self):
-        self.message_type = "StartTask"
         self.log.info('Sending Task Start Command')
-        self.send_command()
+        self.send_command("StartTask")
         # if not self.send_command():
         #    logging.warning('Start Command was not echoed! Check if Task started')
 
     def send_EndTask(self):
-        self.message_type = "EndTask"
         self.log.info('Sending End Task Command')
-        self.send_command()
+        self.send_command("EndTask")
 
     def ask_dummy_trial(self):
-        self.message_type = "AskTrial"
-        self.send_command()
+        self.send_command("AskTrial")
         self.log.info("Asking for dummy trial data")
 
     def ask_params(self):
-        self.message_type = "AskTask"
-        self.send_command()
+        self.send_command("AskTask")
         self.log.info("Asking for task params data")
 
     def reset_board(self):
-        self.message_type = "ResetBoard"
-        self.send_command()
+        self.send_command("ResetBoard")
         self.log.info("resetting board")
 
     def initialize_box(self):
-        self.message_type = "ResetBox"
-        self.send_command()
+        self.send_command("ResetBox")
         self.log.info("Initializing Box")
 
     def exit_debug(self):
-        self.message_type = "ExitDebug"
-        self.send_command()
+        self.send_command("ExitDebug")
         self.log.info("Exiting Debug")
 
     def test_startSignal(self):
-        self.message_type = "SendStartPul"
-        self.send_command()
+        self.send_command("SendStartPul")
         self.log.info("Asked to send trial start pulses")
 
     def PingCircuitPython(self):  # not really needed if i echo commands...
-        self.message_type = "Ping"
-        self.send_command()
+        self.send_command("Ping")
         self.log.debug("send ping")
         self.waiting_forpong = True
 
     def ToggleLED(self, gate: str, value: bool):
-        self.message_type = "SwitchLED"
-        if value:
-            self.command = 'turn_on'
-        else:
-            self.command = 'turn_off'
-        self.gate = gate
-        self.send_command()
+        self.send_command("SwitchLED", 'turn_on' if value else 'turn_off', gate=gate)
 
     def STOPMove(self):
-        self.message_type = "MoveArm"
-        self.command = 'stopMotors'
-        self.send_command()
+        self.send_command("MoveArm", 'stopMotors')
 
     def MoveArmR(self, value: float):
-        self.message_type = "MoveArm"
-        self.command = 'moveArmR'
-        self.params = value
-        self.send_command()
+        self.send_command("MoveArm", 'moveArmR', params=value)
 
     def MoveArmL(self, value: float):
-        self.message_type = "MoveArm"
-        self.command = 'moveArmL'
-        self.params = value
-        self.send_command()
+        self.send_command("MoveArm", 'moveArmL', params=value)
 
     def AskAngles(self):
-        self.message_type = "MoveArm"
-        self.command = 'askAngles'
-        self.send_command()
+        self.send_command("MoveArm", 'askAngles')
 
     def MoveGate(self, gate: str, state: bool):
-        self.message_type = "MoveGate"
-        if state:
-            self.command = 'open_gate'
-        else:
-            self.command = 'close_gate'
-        self.gate = gate
-        self.send_command()
+        self.send_command("MoveGate", 'open_gate' if state else 'close_gate', gate=gate)
 
     def MoveServo(self, gate: str, value: int):
-        self.message_type = "MoveGate"
-        self.command = 'move_gate_fast'
-        self.gate = gate
-        self.params = value
-        self.send_command()
+        self.send_command("MoveGate", 'move_gate_fast', params=value, gate=gate)
 
     def PlayRewardSound(self):
         self.log.info("playing reward sound")
-        self.message_type = "PlaySound"
-        self.command = 'play'
-        self.gate = 'reward'
-        self.send_command()
+        self.send_command("PlaySound", 'play', gate='reward')
 
     def PlayErrorSound(self):
         self.log.info("playing error sound")
-        self.message_type = "PlaySound"
-        self.command = 'play'
-        self.gate = 'noise'
-        self.send_command()
+        self.send_command("PlaySound", 'play', gate='noise')
 
     def GiveReward(self, value: int = None):
         self.log.info("Giving reward")
-        self.message_type = "GiveReward"
-        self.command = 'give_reward'
-        self.params = value
-        self.send_command()
+        self.send_command("GiveReward", 'give_reward', params=value)
 
     def RewardPumpToggle(self, state: bool):
         self.log.info("Toggling Reward Pump")
-        self.message_type = "GiveReward"
-        if state:
-            self.command = 'open_valve'
-        else:
-            self.command = 'close_valve'
-        self.send_command()
+        self.send_command("GiveReward", 'open_valve' if state else 'close_valve')
 
     def ToggleCameraTriggers(self, fps: int, state: bool):
         self.log.info("Toggling camera Triggers")
-        self.message_type = "CameraTrigger"
         if state:
-            self.command = 'startPulsing'
-            self.params = fps
+            self.send_command("CameraTrigger", 'startPulsing', params=fps)
         else:
-            self.command = 'stopPulsing'
-        self.send_command()
+            self.send_command("CameraTrigger", 'stopPulsing')
 
     def PingArduino(self):
         self.log.info("Pinging Arduino")
-        self.message_type = "PingArduino"
-        self.command = 'pingSlave'
-        self.send_command()
+        self.send_command("PingArduino", 'pingSlave')
 
     def PollBeamBlockes(self):
         self.log.info("PollingBeamBlocks")
-        self.message_type = "PollBeamBlockers"
-        self.command = 'pollBeamblockers'
-        self.send_command()
+        self.send_command("PollBeamBlockers", 'pollBeamblockers')
 
     def RoomLights(self, value: int):
         self.log.info(f"Turning roomlights {'On' if value == 100 else str(value) if value != 0 else 'Off'}")
-        self.message_type = "RoomLights"
-        self.command = 'dimm_roomlight'
-        self.params = value * 255 // 100
-        self.send_command()
+        self.send_command("RoomLights", 'dimm_roomlight', params=value * 255 // 100)
 
     def send_ctrlc(self):
         """ writes ctrl c character to serial """
-        self.serial.write(b"\x03")
+        self._write(b"\x03")
         # tODO write this to the other serial not data
 
     def send_ctrld(self):
-        self.serial.write(b"\x04")
+        self._write(b"\x04")
 
-    def get_bytes(self) -> bytes:
-        dict2send = vars(self).copy()
-        dict2send.pop('serial', None)
-        dict2send.pop('log', None)
-        dict2send.pop('received', None)
-        dict2send.pop('waiting_forecho', None)
-        dict2send.pop('waiting_forpong', None)
-        dict2send.pop('mess_in', None)
-        dict2send.pop('params_names', None)
-        return f'{json.dumps(dict2send)}\n'.encode('utf-8')
-
-    def send_command(self):
-        message2send = self.get_bytes()
-        self.mess_in.append(message2send)
-        # self.serial.write(mess_in)
-        self.serial.write(message2send)
-        # replace with send
-        self.waiting_forecho = True
-        # mess_out = self.serial.readline()
-        # self.serial.read_input()
-        # replace with self.serial.read_input()
+    def send_command(self, message_type: str, command: str = None, params=None, gate: str = None):
+        self.send_message(CommandMessage(message_type, command, params, gate))
+
+    def send_message(self, message: BoardMessage):
+        message2send = message.get_bytes()
+        self.expect_echo(message2send)
+        self._write(message2send)
 
     def pico_data_received(self, payload):
         """Process a message from the Pico."""
+        if self.recorder is not None:
+            self.recorder.record_in(payload + b'\n')
         self.log.debug("Received: %s", payload.decode())
         self.received = payload.decode()
-        # TODO Problem if we send more then one message before aknowledging it, it contains previos params.
-        # strip params direktly after sending and not after aknowledgement ?
         if self.waiting_forecho:
             for m_id, message in enumerate(self.mess_in):  # look through messages we await echo from.
                 if message.rstrip() == payload:
                     self.log.debug(f"Successfull transmission {m_id + 1} out of {len(self.mess_in)}")
-                    self.message_type = None
-                    self.command = None
-                    self.params = None
-                    self.gate = None
-                    if self.params_names is not None:
-                        for name in self.params_names:
-                            delattr(self, name)  # purge params from self to not be resend
-                        print(self.__dict__)
-                        self.params_names = None
                     self.mess_in.pop(m_id)  # remove message from list
                     if len(self.mess_in) == 0:  # waiting list is empty
                         self.waiting_forecho = False
@@ -274,18 +305,93 @@ class PythonBoardCommander:
                 self.log.info(f'Board on {self.serial._port.portName()} responded to ping')
 
 
+import atexit
 import csv
 import json
 import logging
+import os
+import queue
+import threading
+import weakref
 from pathlib import Path
 from datetime import datetime
 
+from trial_store import TrialStore
+
+_running_writers = weakref.WeakSet()  # DataWriters whose writer thread runs, held weakly
+
+
+@atexit.register
+def _stop_writers():
+    """writes what is still queued by DataWriters which were not closed"""
+    for writer in list(_running_writers):
+        writer._stop_writer()
+
+
+def read_trial_journal(journal_file: (str, Path)) -> dict:
+    """
+    rebuilds the session dictionary (task with 'trials' and 'motortimes') from a DataWriter journal,
+    e.g. after a crash before the session JSON was compacted. A record cut short at the end is ignored.
+    """
+    task = None
+    with open(journal_file, 'r') as fi:
+        for line in fi:
+            try:
+                record = json.loads(line)
+            except json.decoder.JSONDecodeError:  # last line of an interrupted write
+                break
+            if record['kind'] == 'task':
+                task = record['data']
+            elif task is None:
+                raise ValueError(f"{journal_file} does not start with a task record")
+            elif record['kind'] == 'trial':
+                task['trials'].append(record['data'])
+            elif record['kind'] == 'motortimes':
+                task['motortimes'] = record['data']
+    return task
+
+
+def compact_journal(journal_file: (str, Path)) -> Path:
+    """
+    writes the session JSON of a journal left behind (e.g. by a crash or a session which was never closed) and
+    removes the journal, like DataWriter.close. Returns the session JSON.
+    """
+    journal_file = Path(journal_file)
+    json_file = journal_file.with_suffix('.json')
+    task = read_trial_journal(journal_file)
+    if task is None:
+        raise ValueError(f"{journal_file} contains no task record")
+    temp_file = json_file.with_suffix('.json.tmp')
+    with open(temp_file, 'w') as fi:
+        json.dump(task, fi, indent=4, sort_keys=True)
+    os.replace(temp_file, json_file)
+    journal_file.unlink()
+    return json_file
+
 
 class DataWriter:
     """Class for writing data received from serial to csv and JSON file
-    data arrives per trial and is written as individual row"""
-
-    def __init__(self, session_id: str, path2save: (str, Path) = None, write_csv: bool = False):
+    data arrives per trial and is written as individual row.
+    Trials are appended to a JSON lines journal. The session JSON is written with the task parameters when the
+    task arrives and only gets the trials and motortimes on compact/close, until then they are in the journal.
+    Trials are also kept as columns (trial_store), saved as .npz next to the JSON.
+    By default all file access happens on a writer thread, the injest methods only queue the data,
+    flush() waits until everything queued is on disk, if the writer thread died the data is written directly.
+    close() has to be called at the end of the session (or use the writer as context manager): until then the
+    writer thread keeps the DataWriter, its files and the journal alive. Data still queued at interpreter exit
+    is written, the session JSON stays without trials though."""
+    MAX_BATCH = 100  # records written together by the writer thread
+    WRITER_TIMEOUT = 10  # s flush/close wait for the writer thread, checking in between whether it is alive
+
+    def __init__(self, session_id: str, path2save: (str, Path) = None, write_csv: bool = False,
+                 sync_rows: int = 10, sync_interval: float = 5, background: bool = True, max_queue: int = 1000):
+        """
+        :param sync_rows: csv rows and journal records are flushed and fsynced after this many trials
+        :param sync_interval: or once this many s passed since the last sync, whatever comes first. A crash
+            loses at most the trials since the last sync (the journal is also flushed per record).
+        :param background: write on a separate thread, otherwise the injest methods write directly
+        :param max_queue: records the writer thread may lag behind before the injest methods block
+        """
         self.log = logging.getLogger('DataWriter')
         self.log.setLevel('DEBUG')
         self.session_id = session_id
@@ -296,6 +402,26 @@ class DataWriter:
         prepath.mkdir(parents=True, exist_ok=True)
         self.file_name = prepath / f'{self.session_id}_behav.csv'
         self.json_file = self.file_name.parent / f"{self.file_name.name.split('.')[0]}.json"
+        self.journal_file = self.json_file.with_suffix('.jsonl')  # one record per line, see read_trial_journal
+        self.npz_file = self.json_file.with_suffix('.npz')  # columns of trial_store
+        self._journal = None
+        self._csv_file = None  # kept open for the session, see writeTrial
+        self._csv_writer = None
+        self.sync_rows = sync_rows
+        self.sync_interval = sync_interval
+        self._unsynced_rows = 0
+        self._last_sync = time.monotonic()
+        self._task_lock = threading.Lock()  # task is extended by the caller while the writer thread dumps it
+        self._io_lock = threading.RLock()  # csv and journal handles, used by the writer and e.g. copyCSV
+        self.writer_stats = {'max_queue_depth': 0, 'batches': 0, 'records': 0, 'errors': 0,
+                             'last_write_time': 0, 'max_write_time': 0, 'max_record_latency': 0}
+        self.write_queue = None
+        self.writer_thread = None
+        if background:
+            self.write_queue = queue.Queue(maxsize=max_queue)
+            self.writer_thread = threading.Thread(target=self._write_loop, name='DataWriter', daemon=True)
+            self.writer_thread.start()
+            _running_writers.add(self)
 
         self.header_written = False  # flag to check if header was written
         # here one can define the sorting in the csv!
@@ -313,6 +439,7 @@ class DataWriter:
                            "trial_sync_pulse"]
 
         self.task = None
+        self.trial_store = TrialStore(self.fieldnames)
         self.trial_counter = 0
         self.error_counter = 0
         self.hit_counter = 0
@@ -333,7 +460,8 @@ class DataWriter:
         self.task['session_id'] = self.session_id
         self.task['trials'] = list()
         self.task['motortimes'] = list()
-        self.writeJSON()
+        self.trial_store = TrialStore(self.fieldnames)
+        self._write('task', dict(self.task, trials=[], motortimes=[]))
 
     def injest_trial(self, trial: dict, do_additional_math: bool = True):
         """
@@ -342,6 +470,7 @@ class DataWriter:
         if self.task is None:
             self.log.error('No task was passed!, saving only trial info')
             self.task = {'session_id': self.session_id, 'trials': list()}
+            self._write('task', {'session_id': self.session_id, 'trials': list()})
         self.trial_counter += 1
         if trial['trial_nr'] != self.trial_counter:
             self.log.warning('Trial counter host/remote do not correspond !')
@@ -349,10 +478,10 @@ class DataWriter:
             trial = self.make_trial_math(trial)  # add some additional info to the trial
         except TypeError as e:
             self.log.error(e)
-        if self.write_csv:
-            self.writeTrial(trial)  # append trial to csv
-        self.task['trials'].append(trial)
-        self.writeJSON()
+        with self._task_lock:
+            self.task['trials'].append(trial)
+            self.trial_store.append(trial)
+        self._write('trial', trial)  # appended to csv and journal
         if trial['outcome'] == 'omission':
             self.omission_counter += 1
         elif trial['outcome'] == 'error':
@@ -388,11 +517,235 @@ class DataWriter:
         self.log.info(f"Received trial {trial['trial_nr']} with {trial['outcome']} at {side}")
 
     def injest_motortimes(self, motor_time: list):
-        self.task['motortimes'] = motor_time
-        self.writeJSON()
+        with self._task_lock:
+            self.task['motortimes'] = motor_time
+        self._write('motortimes', motor_time)
+
+    def _write(self, kind: str, data):
+        """queues a record for the writer thread, or writes it directly without one"""
+        if not self._put((kind, data, time.monotonic())):
+            with self._io_lock:
+                self._write_records([(kind, data, time.monotonic())])
+            return
+        depth = self.write_queue.qsize()
+        if depth > self.writer_stats['max_queue_depth']:
+            self.writer_stats['max_queue_depth'] = depth
+
+    def _writer_alive(self) -> bool:
+        return self.writer_thread is not None and self.writer_thread.is_alive()
+
+    def _put(self, item: tuple) -> bool:
+        """queues item for the writer thread, False if there is none (anymore) and the caller has to write"""
+        write_queue = self.write_queue
+        while self._writer_alive() and write_queue is not None:
+            try:  # blocks only if the writer lags max_queue behind
+                write_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        if write_queue is not None and self.write_queue is write_queue:
+            self.log.error("Writer thread is not running, writing directly")
+            self._drain_queue()
+            self.writer_thread = None
+            self.write_queue = None
+        return False
+
+    def _write_loop(self):
+        """writer thread, writes queued records in batches until a 'stop' record arrives"""
+        while True:
+            try:  # wake up at sync_interval to sync rows which arrived since the last sync
+                items = [self.write_queue.get(timeout=self.sync_interval)]
+            except queue.Empty:
+                if self._unsynced_rows:
+                    self._guarded(self.sync)
+                continue
+            while len(items) < self.MAX_BATCH:
+                try:
+                    items.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = []
+            for kind, data, t_queued in items:
+                if kind == 'flush':  # barrier, data is the event the caller waits on
+                    self._guarded(self._write_records, records)
+                    records = []
+                    self._guarded(self.sync)
+                    data.set()
+                elif kind == 'stop':
+                    self._guarded(self._write_records, records)
+                    self._guarded(self.sync)
+                    data.set()
+                    return
+                else:
+                    records.append((kind, data, t_queued))
+            self._guarded(self._write_records, records)
+
+    def _guarded(self, function, *args):
+        """runs a write on the writer thread, errors are logged and counted instead of ending the thread"""
+        try:
+            function(*args)
+        except Exception as e:  # e.g. disk problems or data json can not encode
+            self.writer_stats['errors'] += 1
+            self.log.error(f"Writing session data failed: {e}")
+
+    def _write_records(self, records: list):
+        """writes (kind, data, time queued) records to journal and csv, with one journal write, syncs if due"""
+        if not records:
+            return
+        t_start = time.monotonic()
+        lines = []
+        with self._io_lock:
+            for kind, data, _ in records:
+                if kind == 'compact':  # on this thread, so it does not race with the writeJSON of a task record
+                    self._append_journal_lines(lines)
+                    lines = []
+                    self._compact()
+                    continue
+                if kind == 'task':  # new session: records before belong to the old journal
+                    self._append_journal_lines(lines)
+                    lines = []
+                    self.writeJSON(data)  # the snapshot, trials are appended to the live task meanwhile
+                    self._open_journal('w')
+                elif kind == 'trial':
+                    if self.write_csv:
+                        self.writeTrial(data)
+                    self._unsynced_rows += 1
+                lines.append(json.dumps({'kind': kind, 'data': data}))
+            self._append_journal_lines(lines)
+            if self._unsynced_rows >= self.sync_rows or time.monotonic() - self._last_sync >= self.sync_interval:
+                self.sync()
+        t_end = time.monotonic()
+        stats = self.writer_stats
+        stats['batches'] += 1
+        stats['records'] += len(records)
+        stats['last_write_time'] = t_end - t_start
+        stats['max_write_time'] = max(stats['max_write_time'], t_end - t_start)
+        stats['max_record_latency'] = max(stats['max_record_latency'], t_end - records[0][2])
+
+    def get_writer_stats(self) -> dict:
+        """write metrics: queue depth, batches and records written, write times and queue-to-disk latency in s"""
+        stats = dict(self.writer_stats)
+        stats['queue_depth'] = 0 if self.write_queue is None else self.write_queue.qsize()
+        stats['records_per_batch'] = stats['records'] / stats['batches'] if stats['batches'] else 0
+        return stats
+
+    def flush(self, timeout: float = WRITER_TIMEOUT) -> bool:
+        """barrier: returns once everything injested so far is written and synced, False on timeout"""
+        done = threading.Event()
+        if not self._put(('flush', done, time.monotonic())):
+            self._drain_queue()
+            self.sync()
+            return True
+        return self._wait_for_writer(done, timeout)
+
+    def _wait_for_writer(self, done: threading.Event, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not done.wait(0.1):
+            if not self._writer_alive():
+                self._drain_queue()  # writer died, write what it left
+                return True
+            if time.monotonic() > deadline:
+                self.log.error(f"Writer thread did not finish within {timeout} s")
+                return False
+        return True
+
+    def _drain_queue(self):
+        """writes the records left in the queue by a writer thread which died, on the caller thread"""
+        if self.write_queue is None or self._writer_alive():
+            return
+        records = []
+        while True:
+            try:
+                kind, data, t_queued = self.write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind in ('flush', 'stop'):
+                data.set()
+            else:
+                records.append((kind, data, t_queued))
+        with self._io_lock:
+            self._write_records(records)
+
+    def _stop_writer(self, timeout: float = WRITER_TIMEOUT):
+        """writes everything queued and ends the writer thread, file access continues on the caller thread"""
+        _running_writers.discard(self)
+        if self.writer_thread is not None:
+            done = threading.Event()
+            if self._put(('stop', done, time.monotonic())):
+                self._wait_for_writer(done, timeout)
+                self.writer_thread.join(timeout)
+            self._drain_queue()
+            self.writer_thread = None
+            self.write_queue = None
+
+    def _open_journal(self, mode: str = 'a'):
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_file, mode)
+
+    def _append_journal_lines(self, lines: list):
+        """appends records, one per line, with a single write"""
+        if not lines:
+            return
+        if self._journal is None:
+            self._open_journal()
+        self._journal.write('\n'.join(lines) + '\n')
+        self._journal.flush()
+
+    def sync(self):
+        """flushes csv and journal and makes sure they are on disk"""
+        with self._io_lock:
+            for file in (self._csv_file, self._journal):
+                if file is not None:
+                    file.flush()
+                    os.fsync(file.fileno())
+            self._unsynced_rows = 0
+            self._last_sync = time.monotonic()
+
+    def close_csv(self):
+        """writes buffered rows and closes the csv, writeTrial opens it again if needed"""
+        with self._io_lock:
+            if self._csv_file is not None:
+                self._csv_file.flush()
+                os.fsync(self._csv_file.fileno())
+                self._csv_file.close()
+                self._csv_file = None
+                self._csv_writer = None
+
+    def compact(self):
+        """writes the complete session JSON and the trial columns, the journal is kept"""
+        if self._put(('compact', None, time.monotonic())):
+            self.flush()
+        else:
+            self._drain_queue()
+            with self._io_lock:
+                self._compact()
+
+    def _compact(self):
+        if self.task is not None:
+            self.writeJSON()
+            with self._task_lock:
+                self.trial_store.save(self.npz_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """end of session: stops the writer thread, closes the csv, writes the session JSON and removes the journal"""
+        self._stop_writer()
+        self.close_csv()
+        self.compact()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            self.journal_file.unlink(missing_ok=True)
 
     def make_trial_math(self, dict_trial: dict) -> dict:
-        """modify the trial dictionary with some more calculated values"""
+        """modify the trial dictionary with some more calculated values
+        trial_store.make_trial_math_batch does the same for the columns of whole sessions"""
         mod_dict_trial = dict_trial.copy()
 
         # calculate the duration of the trial
@@ -455,22 +808,26 @@ class DataWriter:
 
         return mod_dict_trial
 
-    def writeJSON(self):
-        """Write global parameters as json
+    def writeJSON(self, task: dict = None):
+        """Write global parameters as json, task defaults to the complete session (self.task)
         input is Task.strip_parameters(return_global = True) """
         # header.update(**{'datetime': datetime.now().strftime('%Y%m%d_%H%M')})
-        with open(self.json_file, 'w') as fi:
-            json.dump(self.task, fi, indent=4, sort_keys=True)
+        temp_file = self.json_file.with_suffix('.json.tmp')  # a crash while writing leaves the old file intact
+        with self._task_lock, open(temp_file, 'w') as fi:
+            json.dump(self.task if task is None else task, fi, indent=4, sort_keys=True)
+        os.replace(temp_file, self.json_file)
 
     def writeTrial(self, trial: dict):
-        """write a  dict representing Information about a single Trial to file"""
-        with open(self.file_name, 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=self.fieldnames, extrasaction='ignore')
+        """write a  dict representing Information about a single Trial to file
+        the file stays open and rows are buffered, they reach the disk with sync/close_csv"""
+        if self._csv_file is None:
+            self._csv_file = open(self.file_name, 'a', newline='')
+            self._csv_writer = csv.DictWriter(self._csv_file, fieldnames=self.fieldnames, extrasaction='ignore')
             self.log.debug(f"Opened {self.file_name} for writing")
-            if not self.header_written:
-                writer.writeheader()
-                self.header_written = True
-            writer.writerow(trial)
+        if not self.header_written:
+            self._csv_writer.writeheader()
+            self.header_written = True
+        self._csv_writer.writerow(trial)
         self.log.debug(f"Written trial {trial['trial_nr']} to file")
 
     def copyCSV(self, target_path: Path):
@@ -479,15 +836,32 @@ class DataWriter:
         """
         # TODO trow an error if files not exist !
         import shutil
-        try:
-            shutil.copy2(self.file_name, target_path)
-        except FileNotFoundError:
-            pass
-        shutil.copy2(self.json_file, target_path)
+        self.compact()
+        self.close_csv()
+        for file in (self.file_name, self.json_file, self.npz_file):
+            if file.exists():  # csv only with write_csv, npz only once trials arrived
+                shutil.copy2(file, target_path)
         self.log.info(f"Copied {self.file_name.name} to {target_path.as_posix()}")
 
+    def copy_files_async(self, target_path: Path, transfer_service, on_done=None):
+        """
+        like copyCSV but in the background, with a file_transfer.FileTransferService
+        returns the TransferJob, on_done is called with it when the copy is finished
+        """
+        self.compact()
+        self.close_csv()
+        files = [file for file in (self.file_name, self.json_file, self.npz_file) if file.exists()]
+        return transfer_service.submit_copy(files, target_path, on_done=on_done)
+
     def purgeFiles(self):
         """delete created files, in case of early abort"""
+        self._stop_writer()
+        self.close_csv()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self.journal_file.unlink(missing_ok=True)
+        self.npz_file.unlink(missing_ok=True)
         self.json_file.unlink()
         self.file_name.unlink()
         self.log.info(f"Deleted {self.file_name.name}.")
@@ -510,6 +884,10 @@ def dict_to_uuid(key: dict):
 
 from collections import namedtuple
 
+from params_store import ParamsStore
+
+JOURNAL_IDLE_TIME = 12 * 3600  # s, journals not written for this long belong to sessions which ended
+
 Stage_params = namedtuple('stage_tuple', "stage_name,params,stage_description")
 Version_params = namedtuple('version_tuple', "version,stages_list")
 """
@@ -621,57 +999,70 @@ class HostsideParamsOld:
 
 
 class HostsideParams:
-    def __init__(self, path2json: (str, Path) = "params.json"):
+    """
+    Task parameters of all training stages and versions, kept in a ParamsStore (SQLite) next to the json file.
+    The json file is the source of truth: it is rewritten after every change made through this class, and
+    imported if the store is empty or older than the file (e.g. after the json was edited by hand).
+    """
+
+    def __init__(self, path2json: (str, Path) = "params.json", path2db: (str, Path) = None):
         self.stages = None
         self.versions = None
-        self.all_params = {}
         self.path2json = path2json
         self.log = logging.getLogger('ParameterCommander')
         self.log.setLevel(logging.DEBUG)
-        self.read_json()
+        path2db = Path(path2json).with_suffix('.sqlite') if path2db is None else Path(path2db)
+        json_edited = (Path(path2json).exists() and path2db.exists()
+                       and Path(path2json).stat().st_mtime > path2db.stat().st_mtime)
+        self.store = ParamsStore(path2db)
+        if json_edited or not len(self.store):  # e.g. the json was edited by hand
+            self.read_json()
         # self.all_versions()
 
+    @property
+    def all_params(self) -> dict:
+        """
+        all parameters in the layout of the json file, read only: every access exports a new dict from the store,
+        so changes to it are lost. Change parameters with add_new_stage, add_new_version and modify_params.
+        """
+        return self.store.export_dict()
+
     def reload_file(self):
         self.read_json()
 
-    def write_json(self, path2json: (str, Path) = "params.json"):
-        with open(path2json, 'w') as fi:
-            json.dump(self.all_params, fi, indent=4)
+    def write_json(self, path2json: (str, Path) = None):
+        self.store.export_json(self.path2json if path2json is None else path2json)
 
     def read_json(self):
-        """reads the parameters json"""
+        """reads the parameters json into the store"""
         try:
-            with open(self.path2json, "r") as fi:
-                self.all_params = json.load(fi)
+            self.store.import_json(self.path2json)
         except FileNotFoundError:
             self.log.warning('No parameter File exists!')
-            self.all_params = {}
 
     def add_new_stage(self, stage_name: str, params: dict, state_discription: str = ""):
         # json.load(state_discription)
-        self.all_params[stage_name] = {"version_0": params}
+        self.store.add_stage(stage_name, params, state_discription)
         self.write_json()
 
     def add_new_version(self, stage: str, params: dict, note: str = "") -> int:
         """adds a new version to the parameters"""
-        if stage not in self.all_params.keys():
+        if not self.store.has_stage(stage):
             self.log.warning(f"stage {stage} doesnt exist")
             return None
-        version = len(self.all_params[stage].keys())
         params["note"] = note
-        self.all_params[stage][f"version_{version}"] = params
+        version = self.store.add_version(stage, params)
         self.write_json()
         return version
 
     def modify_params(self, version: int, stage: str, params: dict):
         self.log.debug(f"modifying parameters vor v{version} and stage: {stage}")
-        if stage not in self.all_params.keys():
+        if not self.store.has_stage(stage):
             self.log.warning(f"stage {stage} doesnt exist")
             return
-        if f"version_{version}" not in self.all_params[stage].keys():
+        if not self.store.update(stage, version, params):
             self.log.warning(f"version {version} doesnt exist")
             return
-        self.all_params[stage][f"version_{version}"].update(**params)
         self.write_json()
 
     def hash_params(self, params: dict = None, version: int = 0, stage2find: str = "") -> UUID:
@@ -683,50 +1074,65 @@ class HostsideParams:
         return dict_to_uuid(params)
 
     def all_versions(self, stage: str) -> list:
-        try:
-            self.versions = [int(ver.split("_")[-1]) for ver in self.all_params[stage].keys()]
-            return self.versions
-        except KeyError:
-            return []
+        self.versions = self.store.versions(stage)
+        return self.versions
 
     def all_stages(self) -> list:
         """returns all stages of parameters_set"""
-        stages = list()
-        for stage in self.all_params.keys():
-            stages.append(stage)
-        self.stages = stages
-        return stages
+        self.stages = self.store.stages()
+        return self.stages
 
     def get_params(self, version: int, stage2find: str) -> (dict, None):
-        if stage2find not in self.all_stages():
+        if not self.store.has_stage(stage2find):
             self.log.warning(f'Stage {stage2find} doesnt exist in ver.{version}')
             return None
-        if version not in self.all_versions(stage2find):
+        params = self.store.get(stage2find, version)
+        if params is None:
             self.log.warning(f'Ver.{version} doesnt exist')
-            return None
-        params = self.all_params[stage2find][f"version_{version}"]
         return params
 
 
 class Session_backupCreator:
 
-    def __init__(self):
-        from datastructure_tools.DataBaseAccess import DataBaseAccess
+    def __init__(self, database: 'SessionDatabase' = None, catalog: 'SessionCatalog' = None, recheck: bool = False):
+        # imported here, so importing host_utils does not pull in session_catalog, file_transfer and socket_utils
+        from session_catalog import DataJointDatabase, SessionCatalog
         self.path2datafiles = Path("./data/")
         self.typical_exptype = 'HillYmaze_Training'
-        self.DB = DataBaseAccess()
-        self.sessions_indb = self.DB.Session.fetch('session_id')
+        self.database = DataJointDatabase() if database is None else database
+        self.DB = getattr(self.database, 'DB', None)  # datastructure_tools.DataBaseAccess of the lab database
+        self.catalog = SessionCatalog(data_dir=self.path2datafiles) if catalog is None else catalog
         self.sessions2add = []
-        self.go_through_files()
+        self.go_through_files(recheck)
+
+    def fill_session_notinDB(self, weights_file: (str, Path) = None):
+        """adds the sessions not in the DB, asking for the weights unless weights_file is given"""
+        if weights_file is None:
+            self.add_session_to_DB()
+        else:
+            self.upload_sessions(weights_file)
 
-    def fill_session_notinDB(self):
-        self.add_session_to_DB()
+    def upload_sessions(self, weights_file: (str, Path), log_file: (str, Path) = None, n_workers: int = 4,
+                        db_workers: int = 1, retries: int = 3) -> dict:
+        """uploads sessions2add in parallel without prompts, see session_upload.BulkUploader"""
+        from GUI_full import PROJECT_NAME, CURRENT_EXPERIMENT, BEHAVIOUR_FOLDER
+        from session_upload import BulkUploader, read_weights
+        files = {sess_id: [entry['path'] for entry in self.catalog.get(sess_id)] for sess_id in self.sessions2add}
+        uploader = BulkUploader(self.database, files, read_weights(weights_file),
+                                log_file or self.path2datafiles / 'upload_log.jsonl', project=PROJECT_NAME,
+                                user='as153', experiment_name=CURRENT_EXPERIMENT,
+                                experiment_template=self.typical_exptype, behaviour_folder=BEHAVIOUR_FOLDER,
+                                n_workers=n_workers, db_workers=db_workers, retries=retries)
+        summary = uploader.run(self.sessions2add, on_done=lambda sess_id: self.catalog.mark_synced([sess_id]))
+        self.catalog.mark_synced(summary['skipped'])  # uploaded in an earlier run
+        self.sessions2add = [sess_id for sess_id in self.sessions2add if sess_id in summary['failed']]
+        return summary
 
     def change_animal_nr(self, session_id: str, new_animal: str):
         from datastructure_tools.utils import SessionClass
-        import shutil
-        assert session_id in self.sessions_indb, f"Session {session_id} not in DB!"
-        assert new_animal in self.DB.Animal.fetch('animal_id'), f"Animal {new_animal} not in DB!"
+        from session_rename import plan_session_rename
+        assert self.database.has_session(session_id), f"Session {session_id} not in DB!"
+        assert new_animal in self.database.animal_ids(), f"Animal {new_animal} not in DB!"
         print(f'Trying to patch {session_id} to be from animal {new_animal}')
         # assert session_id in self.sessions2add, f"Session {session_id} not in files!"
         session = (
@@ -748,19 +1154,10 @@ class Session_backupCreator:
         new_path = self.DB.server_path / session_class.session_dir
         print(f'Created new fodler structure at {new_path}')
 
-        # rename folder
-        print(f'renaming{session_path} to {new_path}')
-        shutil.move(session_path, new_path)
-
-        # rename files
-        for file in new_path.rglob("*"):
-            if file.is_file():
-                old_name = file.name
-                new_name = [old_name.split("_")[0], new_animal]
-                new_name.extend(old_name.split("_")[3:])
-                new_name = '_'.join(new_name)
-                print(f'renaming {old_name} to {new_name}')
-                shutil.move(file, file.parent.parent / new_name)
+        # move and rename the files and patch the session id in the json files, all undone if one fails
+        plan = plan_session_rename(session_path, new_path, session_id, new_sessname)
+        print('\n'.join(plan.describe()))
+        plan.execute()
 
         PushSuccess = session_class.checkInputs()  # checks inputs and pushes to DB
 
@@ -779,32 +1176,34 @@ class Session_backupCreator:
         (self.DB.Session & session).delete()
         # TODO Delete preprocessed and processed files
 
-        # rename session in in the behavior file.  in daq data is still wrongly named!
-        try:
-            for file in (new_path / 'behav').rglob('*.json'):
-                try:
-                    with open(file, 'r') as fi:
-                        sess_data = json.load(fi)
-                except json.decoder.JSONDecodeError:  # not a json
-                    sess_data = None
-                if sess_data is not None:
-                    try:
-                        assert sess_data['session_id'] == session_id
-                        sess_data['session_id'] = new_sessname
-                        with open(file, 'w') as fi:
-                            json.dump(sess_data,fi)
-                        break
-                    except AssertionError:
-                        print("Session id in beh is not as expected")
-        except Exception as e:
-            pass
-
-
-    def go_through_files(self):
-        for file in self.path2datafiles.rglob('*_behav.json'):
-            sess_id = '_'.join(file.name.split('_')[:-1])
-            if sess_id not in self.sessions_indb and 'MusterMaus' not in sess_id:
-                self.sessions2add.append(sess_id)
+    def compact_journals(self, min_idle: float = JOURNAL_IDLE_TIME) -> list:
+        """
+        compacts the DataWriter journals which were not written for min_idle s into their session JSON,
+        the catalog leaves sessions with a newer journal out. Returns the compacted session JSONs.
+        """
+        from session_catalog import JOURNAL_SUFFIX
+        compacted = []
+        for journal_file in self.path2datafiles.rglob(f'*_behav{JOURNAL_SUFFIX}'):
+            try:
+                if time.time() - journal_file.stat().st_mtime < min_idle:
+                    continue  # session probably still running
+                compacted.append(compact_journal(journal_file))
+            except (OSError, ValueError) as e:
+                print(f'Could not compact {journal_file.name}: {e}')
+        if compacted:
+            print(f"Compacted {len(compacted)} session journals")
+        return compacted
+
+    def go_through_files(self, recheck: bool = False):
+        """
+        compacts left behind journals, updates the session catalog from the data folder and lists the sessions
+        which are not in the DB. Sessions marked as synced are only asked for again with recheck, e.g. after
+        sessions were deleted from the DB.
+        """
+        self.compact_journals()
+        self.catalog.refresh()
+        self.catalog.update_sync_status(self.database, recheck_synced=recheck)
+        self.sessions2add = self.catalog.unsynced()
         print(f"Found {len(self.sessions2add)} session not in DB")
 
     def add_session_to_DB(self):
@@ -847,30 +1246,59 @@ class Session_backupCreator:
                     session_class.weight_note = 'Training'
                     session_class.pushWeights()
                     print(f'Pushed to DB')
+                    self.catalog.mark_synced([sess_id])
 
 
 class RunningAverage:
+    """
+    Moving average and sum of the last `window` values, NaN values are ignored (like np.nanmean/np.nansum).
+    Ring buffer with a running sum and count of valid values, so add_value and the queries are O(1).
+    """
 
     def __init__(self, window=5):
         self.window = window
-        self.data = np.zeros((self.window,)) * np.nan
-        self.previous_value = np.nan
+        self.reset()
+
+    @property
+    def data(self) -> np.ndarray:
+        """the window, oldest value first"""
+        return np.array(self._values[self._pos:] + self._values[:self._pos])
 
     @property
     def moving_average(self):
-        return np.nanmean(self.data)
+        return self._sum / self._count if self._count else math.nan
 
     @property
     def moving_sum(self):
-        return np.nansum(self.data)
+        return self._sum
 
     def add_value(self, value):
         self.previous_value = self.moving_average
-        self.data[:-1] = self.data[1:]
-        self.data[-1] = value
+        value = math.nan if value is None else float(value)
+        old = self._values[self._pos]
+        self._values[self._pos] = value
+        self._pos = (self._pos + 1) % self.window
+        if old == old:  # not NaN
+            self._sum -= old
+            self._count -= 1
+        if value == value:
+            self._sum += value
+            self._count += 1
+        if self._pos == 0 or not math.isfinite(self._sum):
+            self._resum()  # once per window, so rounding errors of adding and removing do not build up
+
+    def _resum(self):
+        values = [value for value in self._values if value == value]
+        try:
+            self._sum = math.fsum(values)
+        except (ValueError, OverflowError):  # +inf and -inf in the window, sum gives nan like before
+            self._sum = sum(values)
 
     def reset(self):
-        self.data = np.zeros((self.window,)) * np.nan
+        self._values = [math.nan] * self.window
+        self._pos = 0  # position of the oldest value, overwritten next
+        self._sum = 0.0
+        self._count = 0
         self.previous_value = np.nan
 
 
@@ -0,0 +1,165 @@
+"""
+Storage of the task parameters of all training stages and versions in an SQLite file. Each (stage, version) is
+one row, so looking up or editing a parameter set does not read or rewrite the others, and every write is a
+transaction. Lookups go through a cache of the JSON text which is updated by the writes of the store once they
+are committed, get returns a new dict every time, so callers can not change the cache.
+The store imports and exports the params.json layout of HostsideParams: {stage: {"version_<n>": params}}.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+VERSION_PREFIX = 'version_'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    stage TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    description TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS params (
+    stage TEXT NOT NULL REFERENCES stages (stage),
+    version INTEGER NOT NULL,
+    params TEXT NOT NULL,
+    PRIMARY KEY (stage, version)
+) WITHOUT ROWID;
+"""
+
+
+class ParamsStore:
+    """
+    Parameter sets by stage and version
+
+    :param db_file: SQLite file, ':memory:' for a store which is not kept
+    """
+
+    def __init__(self, db_file: (str, Path) = 'params.sqlite'):
+        self.log = logging.getLogger('ParamsStore')
+        self.db_file = db_file
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(str(db_file), check_same_thread=False)
+        with self._lock, self.conn:
+            self.conn.executescript(SCHEMA)
+        self._stages = None  # cached stage names in order
+        self._versions = {}  # stage -> cached versions
+        self._params = {}  # (stage, version) -> cached params as JSON text
+
+    def __len__(self) -> int:
+        return len(self.stages())
+
+    def stages(self) -> list:
+        with self._lock:
+            if self._stages is None:
+                self._stages = [row[0] for row in self.conn.execute("SELECT stage FROM stages ORDER BY position")]
+            return list(self._stages)
+
+    def has_stage(self, stage: str) -> bool:
+        return stage in self.stages()
+
+    def versions(self, stage: str) -> list:
+        with self._lock:
+            if stage not in self._versions:
+                self._versions[stage] = [row[0] for row in self.conn.execute(
+                    "SELECT version FROM params WHERE stage = ? ORDER BY version", (stage,))]
+            return list(self._versions[stage])
+
+    def get(self, stage: str, version: int) -> (dict, None):
+        """the parameters of a stage and version (a copy), None if they do not exist"""
+        text = self._get_text(stage, version)
+        return None if text is None else json.loads(text)
+
+    def _get_text(self, stage: str, version: int) -> (str, None):
+        with self._lock:
+            key = (stage, version)
+            if key not in self._params:
+                row = self.conn.execute("SELECT params FROM params WHERE stage = ? AND version = ?",
+                                        key).fetchone()
+                if row is None:
+                    return None
+                self._params[key] = row[0]
+            return self._params[key]
+
+    def add_stage(self, stage: str, params: dict, description: str = ''):
+        """adds a stage with params as version 0, replacing the versions of an existing stage"""
+        with self._lock, self.conn:
+            if not self.has_stage(stage):
+                self.conn.execute("INSERT INTO stages (stage, position, description) VALUES "
+                                  "(?, (SELECT COALESCE(MAX(position), -1) + 1 FROM stages), ?)",
+                                  (stage, description))
+            self.conn.execute("DELETE FROM params WHERE stage = ?", (stage,))
+            self.conn.execute("INSERT INTO params (stage, version, params) VALUES (?, 0, ?)",
+                              (stage, json.dumps(params)))
+            self._invalidate(stage)
+
+    def add_version(self, stage: str, params: dict) -> int:
+        """adds params as the next version of stage, returns the version"""
+        with self._lock, self.conn:
+            version = self.conn.execute("SELECT COALESCE(MAX(version), -1) + 1 FROM params WHERE stage = ?",
+                                        (stage,)).fetchone()[0]
+            self.conn.execute("INSERT INTO params (stage, version, params) VALUES (?, ?, ?)",
+                              (stage, version, json.dumps(params)))
+            self._versions.pop(stage, None)
+        return version
+
+    def update(self, stage: str, version: int, params: dict) -> bool:
+        """updates the parameters of a stage and version with params, False if they do not exist"""
+        with self._lock:
+            current = self.get(stage, version)
+            if current is None:
+                return False
+            text = json.dumps(dict(current, **params))
+            with self.conn:
+                self.conn.execute("UPDATE params SET params = ? WHERE stage = ? AND version = ?",
+                                  (text, stage, version))
+            self._params[(stage, version)] = text  # only once committed
+        return True
+
+    def import_dict(self, all_params: dict):
+        """replaces the content of the store with all_params in the params.json layout"""
+        rows = [(stage, int(version.split('_')[-1]), json.dumps(params))
+                for stage, versions in all_params.items() for version, params in versions.items()]
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM params")
+            self.conn.execute("DELETE FROM stages")
+            self.conn.executemany("INSERT INTO stages (stage, position) VALUES (?, ?)",
+                                  [(stage, position) for position, stage in enumerate(all_params)])
+            self.conn.executemany("INSERT INTO params (stage, version, params) VALUES (?, ?, ?)", rows)
+            self._invalidate()
+
+    def export_dict(self) -> dict:
+        """the content of the store in the params.json layout"""
+        all_params = {stage: {} for stage in self.stages()}
+        with self._lock:
+            for stage, version, params in self.conn.execute("SELECT stage, version, params FROM params "
+                                                            "ORDER BY stage, version"):
+                all_params[stage][f"{VERSION_PREFIX}{version}"] = json.loads(params)
+        return all_params
+
+    def import_json(self, path2json: (str, Path)):
+        with open(path2json, 'r') as fi:
+            self.import_dict(json.load(fi))
+        self.log.info(f"Imported {len(self)} stages from {path2json}")
+
+    def export_json(self, path2json: (str, Path)):
+        """writes the params.json layout, through a temporary file so readers never see a partial file"""
+        temp_file = Path(str(path2json) + '.tmp')
+        with open(temp_file, 'w') as fi:
+            json.dump(self.export_dict(), fi, indent=4)
+        os.replace(temp_file, path2json)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _invalidate(self, stage: str = None):
+        if stage is None:
+            self._versions.clear()
+            self._params.clear()
+        else:
+            self._versions.pop(stage, None)
+            for key in [key for key in self._params if key[0] == stage]:
+                del self._params[key]
+        self._stages = None
@@ -0,0 +1,203 @@
+"""
+Stand-in for the laser controller board for testing the host side without hardware.
+A pseudo terminal is opened and the line based protocol of circuitpython_code/main.py is spoken on it, so
+QtPicoSerial, PythonBoardCommander and GuiLaser can connect to `PicoSimulator.port_name` like to a real board.
+Latency, split packets and transmission errors can be injected. Only available on Unix (uses pty).
+"""
+import heapq
+import json
+import logging
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+
+class PicoSimulator:
+    """
+    Simulated laser controller board on a pseudo terminal
+
+    :param echo: echo every received line back to the host, like SerialReaderComm.read(echo=True); the firmware
+                 reads with echo=False, so this is off by default
+    :param refresh: ms between serial reads, the board handles one line per refresh (0 = handle all at once)
+    :param latency: ms added before anything is written back to the host
+    :param split_size: if >0 outgoing data is split into chunks of random size up to split_size bytes
+    :param error_rate: probability of a received line being dropped or garbled
+    :param time_scale: factor applied to simulated pulse and calibration durations
+    :param seed: seed for the random generator used for splitting and errors
+    """
+
+    def __init__(self, echo: bool = False, refresh: float = 0, latency: float = 0, split_size: int = 0,
+                 error_rate: float = 0, time_scale: float = 1, seed: int = None):
+        self.log = logging.getLogger('PicoSimulator')
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)  # pass bytes unchanged, no local echo or newline translation
+        self.port_name = os.ttyname(self.slave_fd)
+
+        self.echo = echo
+        self.refresh = refresh / 1000
+        self.latency = latency / 1000
+        self.split_size = split_size
+        self.error_rate = error_rate
+        self.time_scale = time_scale
+        self._random = random.Random(seed)
+
+        self.params = {}  # last received laser settings
+        self.laser_list = []
+        self.busy_until = 0  # monotonic time until which pulses/calibration run and serial is not read
+        self.triggers = []  # (time received, time pulse train ends) per trigger
+        self.stats = {'lines_in': 0, 'bytes_in': 0, 'bytes_out': 0, 'errors_injected': 0}
+
+        self._buffer = b''
+        self._outgoing = []  # heap of (due time, sequence nr, bytes)
+        self._out_counter = 0
+        self._last_due = 0  # keeps chunks of consecutive messages in order
+        self._last_read = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """runs the board in a background thread"""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.log.info(f"Simulated board listening on {self.port_name}")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            ready, _, _ = select.select([self.master_fd], [], [], 0.0005)
+            if ready:
+                data = os.read(self.master_fd, 4096)
+                self.stats['bytes_in'] += len(data)
+                self._buffer += data
+            now = time.monotonic()
+            self._write_due(now)
+            if now < self.busy_until:  # board does not read serial while lasers are active
+                continue
+            if now - self._last_read < self.refresh:
+                continue
+            self._last_read = now
+            while b'\n' in self._buffer:
+                line, self._buffer = self._buffer.split(b'\n', 1)
+                self.handle_line(line, now)
+                if self.refresh or now < self.busy_until:  # one line per refresh cycle, like the firmware
+                    break
+
+    def handle_line(self, line: bytes, now: float = None):
+        """processes one line received from the host"""
+        if now is None:
+            now = time.monotonic()
+        self.stats['lines_in'] += 1
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.stats['errors_injected'] += 1
+            if self._random.random() < 0.5 or not line:
+                self.log.debug("Dropping received line")
+                return
+            pos = self._random.randrange(len(line))
+            line = line[:pos] + bytes([line[pos] ^ 0xFF]) + line[pos + 1:]
+        if self.echo:
+            self.send(line + b'\n')
+        try:
+            data = line.decode('utf-8')
+        except UnicodeDecodeError:
+            return
+        if data == "TRIGGER":
+            self.start_all_lasers(now)
+            return
+        try:
+            data = json.loads(data)
+        except ValueError:  # json is broken
+            return
+        if data is None:
+            self.laser_list = []
+        elif not isinstance(data, dict):
+            return
+        elif data.get('calibrate', False):
+            self.run_laser_calib(data, now)
+        else:
+            self.params.update(data)
+            if 'laser_list' in data.keys():
+                self.laser_list = list(data['laser_list'])
+
+    def pulse_duration(self) -> float:
+        """duration in s of the pulse train started by a trigger with the current settings"""
+        duration = 0
+        for name in self.laser_list:
+            settings = self.params.get(name.replace('_mask', ''), {})
+            laser_dur = (settings.get('delay_time', 0) + settings.get('pulsetrain_duration', 0)
+                         + settings.get('attenuated_wave', 0))
+            duration = max(duration, laser_dur)
+        return duration / 1000 * self.time_scale
+
+    def start_all_lasers(self, now: float):
+        self.busy_until = now + self.pulse_duration()
+        self.triggers.append((now, self.busy_until))
+        self.log.debug(f"Triggered {self.laser_list} for {self.busy_until - now:.3f}s")
+
+    def run_laser_calib(self, data: dict, now: float):
+        name = data.get("laser2calib")
+        if name not in [f'laser{idx}' for idx in range(1, 5)] + [f'laser{idx}_mask' for idx in range(1, 5)]:
+            return
+        duration = len(data.get("calibsteps", [])) * data.get("calibdur", 0) * self.time_scale
+        self.send(f"Calibrating {name}\n".encode('utf-8'))
+        self.busy_until = now + duration
+        self.send(f"Done calibrating {name}\n".encode('utf-8'), delay=duration)
+
+    def send(self, data: bytes, delay: float = 0):
+        """queues data for the host, applying the configured latency and packet splitting"""
+        due = max(time.monotonic() + self.latency + delay, self._last_due)
+        if self.split_size > 0:
+            chunks = []
+            while data:
+                size = self._random.randint(1, self.split_size)
+                chunks.append(data[:size])
+                data = data[size:]
+        else:
+            chunks = [data]
+        for c_id, chunk in enumerate(chunks):
+            self._out_counter += 1
+            self._last_due = due + c_id * 0.001
+            heapq.heappush(self._outgoing, (self._last_due, self._out_counter, chunk))
+
+    def _write_due(self, now: float):
+        while self._outgoing and self._outgoing[0][0] <= now:
+            _, _, chunk = heapq.heappop(self._outgoing)
+            os.write(self.master_fd, chunk)
+            self.stats['bytes_out'] += len(chunk)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Simulated laser controller board on a pseudo terminal')
+    parser.add_argument('--echo', action='store_true', help='Echo received lines')
+    parser.add_argument('--refresh', type=float, default=0, help='ms between serial reads')
+    parser.add_argument('--latency', type=float, default=0, help='ms of latency added to responses')
+    parser.add_argument('--split', type=int, default=0, help='max chunk size for splitting responses')
+    parser.add_argument('--error_rate', type=float, default=0, help='probability of corrupting a line')
+    parser.add_argument('--time_scale', type=float, default=1, help='scale of simulated pulse durations')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+    pico = PicoSimulator(echo=args.echo, refresh=args.refresh, latency=args.latency,
+                         split_size=args.split, error_rate=args.error_rate, time_scale=args.time_scale)
+    print(f"Connect to {pico.port_name}")
+    try:
+        pico.run()
+    except KeyboardInterrupt:
+        pass
+    print(pico.stats)
+    pico.close()
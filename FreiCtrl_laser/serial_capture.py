@@ -0,0 +1,129 @@
+"""
+Recording and replay of the serial traffic between host and laser controller board.
+Captures are compact binary files: a short header followed by one record per frame, each record holding
+a nanosecond timestamp relative to the start of the capture, the direction and the raw bytes.
+Replaying a capture feeds the received frames back through the parsing stack, either as fast as possible
+or with the original timing.
+"""
+import logging
+import struct
+import time
+from pathlib import Path
+
+CAPTURE_MAGIC = b'FCSC'
+CAPTURE_VERSION = 1
+RECORD_HEADER = struct.Struct('<qBI')  # timestamp in ns, direction, payload length
+
+DIRECTION_OUT = 0  # host -> board
+DIRECTION_IN = 1  # board -> host
+
+
+class SerialRecorder:
+    """Appends timestamped frames to a capture file"""
+
+    def __init__(self, path: (str, Path)):
+        self.log = logging.getLogger('SerialRecorder')
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'wb')
+        self._file.write(CAPTURE_MAGIC + bytes([CAPTURE_VERSION]))
+        self._t0 = time.perf_counter_ns()
+        self.frames = 0
+        self.log.info(f"Capturing serial traffic to {self.path}")
+
+    def record(self, direction: int, data: bytes):
+        data = bytes(data)
+        self._file.write(RECORD_HEADER.pack(time.perf_counter_ns() - self._t0, direction, len(data)))
+        self._file.write(data)
+        self.frames += 1
+
+    def record_out(self, data: bytes):
+        self.record(DIRECTION_OUT, data)
+
+    def record_in(self, data: bytes):
+        self.record(DIRECTION_IN, data)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            self.log.info(f"Captured {self.frames} frames to {self.path}")
+
+
+def read_capture(path: (str, Path)):
+    """yields (timestamp in ns, direction, payload) for every frame in a capture file"""
+    with open(path, 'rb') as fi:
+        header = fi.read(len(CAPTURE_MAGIC) + 1)
+        if header[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a serial capture")
+        if header[-1] != CAPTURE_VERSION:
+            raise ValueError(f"Unsupported capture version {header[-1]}")
+        while True:
+            record = fi.read(RECORD_HEADER.size)
+            if len(record) < RECORD_HEADER.size:  # end of file, or capture cut short by a crash
+                return
+            timestamp, direction, length = RECORD_HEADER.unpack(record)
+            data = fi.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, direction, data
+
+
+def replay_capture(path: (str, Path), on_receive, on_send=None, realtime: bool = False) -> dict:
+    """
+    feeds a capture back into the host stack
+
+    :param path: capture file
+    :param on_receive: called with the payload of every frame received from the board,
+        e.g. QtPicoSerial.data_received
+    :param on_send: called with the payload of every frame the host sent, if given, e.g.
+        PythonBoardCommander.expect_echo for captures of a board echoing the commands
+    :param realtime: keep the original timing between frames, otherwise replay as fast as possible
+    :return: statistics of the replay
+    """
+    frames = 0
+    n_bytes = 0
+    t_start = time.perf_counter_ns()
+    for timestamp, direction, data in read_capture(path):
+        if realtime:
+            delay = timestamp - (time.perf_counter_ns() - t_start)
+            if delay > 0:
+                time.sleep(delay / 1e9)
+        if direction == DIRECTION_IN:
+            on_receive(data)
+        elif on_send is not None:
+            on_send(data)
+        else:
+            continue
+        frames += 1
+        n_bytes += len(data)
+    elapsed = (time.perf_counter_ns() - t_start) / 1e9
+    return {'frames': frames, 'bytes': n_bytes, 'elapsed': elapsed,
+            'frames_per_s': frames / elapsed if elapsed > 0 else float('inf')}
+
+
+if __name__ == "__main__":
+    import argparse
+    from GUI_utils import QtPicoSerial
+    from host_utils import PythonBoardCommander
+
+    parser = argparse.ArgumentParser(description='Replay a serial capture through the host parsing stack')
+    parser.add_argument('capture', type=str, help='Capture file')
+    parser.add_argument('--realtime', action='store_true', help='Replay with the original timing')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of replays')
+    parser.add_argument('--echo', action='store_true',
+                        help='The board echoed the captured commands, expect an echo for every sent frame')
+    args = parser.parse_args()
+
+    class _Main:
+        """minimal stand-in for the GUI receiving the parsed lines"""
+        def pico_data_received(self, payload):
+            pass
+
+    pico = QtPicoSerial(_Main())
+    pico.log.setLevel(logging.INFO)
+    pico.comm = PythonBoardCommander(pico)
+    pico.comm.log.setLevel(logging.INFO)
+    for _ in range(args.repeat):
+        stats = replay_capture(args.capture, pico.data_received,
+                               on_send=pico.comm.expect_echo if args.echo else None, realtime=args.realtime)
+        print(stats)
@@ -0,0 +1,298 @@
+"""
+Catalog of the session files in the data folder, kept in an SQLite file next to them. For every session file it
+stores the session id, path, size, mtime, content hash and whether the session is in the database.
+refresh() only stats the files and hashes the new or changed ones, so finding the sessions which are not yet in
+the database does not re-read the whole archive. Session files with a newer DataWriter journal next to them are
+still being recorded (or were never compacted) and are left out until the journal is compacted into them. The database is accessed through SessionDatabase, LocalDatabase
+stands in for the lab database (datastructure_tools) in tests and dry runs.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+
+from file_transfer import file_checksum
+
+BEHAV_SUFFIX = '_behav.json'
+JOURNAL_SUFFIX = '.jsonl'  # DataWriter journal next to the session JSON, see host_utils.DataWriter
+CATALOG_FILE = 'session_catalog.sqlite'
+TEST_ANIMAL = 'MusterMaus'  # sessions of the test animal are never added to the database
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    path TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    checksum TEXT,
+    synced INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sessions_id ON sessions (session_id);
+CREATE INDEX IF NOT EXISTS sessions_synced ON sessions (synced, session_id);
+"""
+
+SessionInfo = namedtuple('SessionInfo', "session_id,animal_id,session_datetime,project,user,experiment_name,"
+                                        "experiment_template")
+
+
+def parse_session_id(session_id: str) -> tuple:
+    """e.g. 20231211_r0093_wt_1607 -> ('r0093_wt', datetime(2023, 12, 11, 16, 7))"""
+    parts = session_id.split('_')
+    return '_'.join(parts[1:-1]), datetime.strptime(f'{parts[0]}_{parts[-1]}', '%Y%m%d_%H%M')
+
+
+def session_id_from_file(file: (str, Path), suffix: str = BEHAV_SUFFIX) -> str:
+    """e.g. 20231211_r0093_wt_1607_behav.json -> 20231211_r0093_wt_1607"""
+    name = Path(file).name
+    return name[:-len(suffix)] if name.endswith(suffix) else '_'.join(name.split('_')[:-1])
+
+
+def has_newer_journal(file: (str, Path), stat: os.stat_result) -> bool:
+    """True if the DataWriter journal of a session JSON has trials which are not yet compacted into it"""
+    try:
+        return os.stat(os.path.splitext(file)[0] + JOURNAL_SUFFIX).st_mtime_ns > stat.st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def scan_files(directory: (str, Path), suffix: str = BEHAV_SUFFIX):
+    """yields (path, stat) of the files ending with suffix below directory, one stat per file"""
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_files(entry.path, suffix)
+        elif entry.name.endswith(suffix) and entry.is_file():
+            yield entry.path, entry.stat()
+
+
+class SessionDatabase:
+    """interface of the session database used by Session_backupCreator"""
+
+    def session_ids(self) -> set:
+        raise NotImplementedError
+
+    def animal_ids(self) -> set:
+        raise NotImplementedError
+
+    def has_session(self, session_id: str) -> bool:
+        return session_id in self.existing_sessions([session_id])
+
+    def existing_sessions(self, session_ids: list) -> set:
+        """the ones of session_ids which are in the database"""
+        return self.session_ids().intersection(session_ids)
+
+    def create_session(self, info: SessionInfo) -> Path:
+        """creates the folders of a session on the server, returns the session folder"""
+        raise NotImplementedError
+
+    def push_session(self, info: SessionInfo) -> bool:
+        """checks and inserts the session, after its files are copied"""
+        raise NotImplementedError
+
+    def push_weight(self, info: SessionInfo, weight: float, note: str) -> bool:
+        raise NotImplementedError
+
+
+class DataJointDatabase(SessionDatabase):
+    """the lab database, DB is a datastructure_tools.DataBaseAccess"""
+
+    def __init__(self, DB=None):
+        if DB is None:
+            from datastructure_tools.DataBaseAccess import DataBaseAccess
+            DB = DataBaseAccess()
+        self.DB = DB
+        self._session_classes = {}  # session_id -> SessionClass
+        self._lock = threading.Lock()
+
+    def session_ids(self) -> set:
+        return set(self.DB.Session.fetch('session_id'))
+
+    def animal_ids(self) -> set:
+        return set(self.DB.Animal.fetch('animal_id'))
+
+    def existing_sessions(self, session_ids: list, chunk_size: int = 500) -> set:
+        session_ids = list(session_ids)
+        existing = set()
+        for start in range(0, len(session_ids), chunk_size):  # keeps the restriction queries short
+            restriction = [{'session_id': session_id} for session_id in session_ids[start:start + chunk_size]]
+            existing.update((self.DB.Session & restriction).fetch('session_id'))
+        return existing
+
+    def session_class(self, info: SessionInfo):
+        """the datastructure_tools SessionClass of a session, kept for the later steps of an upload"""
+        from datastructure_tools.utils import SessionClass
+        with self._lock:
+            if info.session_id not in self._session_classes:
+                self._session_classes[info.session_id] = SessionClass(
+                    self.DB, animal_id=info.animal_id, session_datetime=info.session_datetime,
+                    project=info.project, user=info.user, expName=info.experiment_name,
+                    experiment_template=info.experiment_template, session_id=info.session_id,
+                    test=info.animal_id == TEST_ANIMAL)
+            return self._session_classes[info.session_id]
+
+    def create_session(self, info: SessionInfo) -> Path:
+        session_class = self.session_class(info)
+        if not session_class.createSession_path():  # create Paths on server
+            raise OSError(f"Paths of {info.session_id} could not be created")
+        return self.DB.server_path / session_class.session_dir
+
+    def push_session(self, info: SessionInfo) -> bool:
+        return bool(self.session_class(info).checkInputs())  # checks inputs and pushes to DB
+
+    def push_weight(self, info: SessionInfo, weight: float, note: str) -> bool:
+        session_class = self.session_class(info)
+        session_class.weight = weight
+        session_class.weight_note = note
+        session_class.pushWeights()
+        with self._lock:
+            self._session_classes.pop(info.session_id, None)
+        return True
+
+
+class LocalDatabase(SessionDatabase):
+    """in-memory stand-in for the lab database"""
+
+    def __init__(self, sessions: (list, set) = (), animals: (list, set) = (), server_path: (str, Path) = None):
+        self.sessions = set(sessions)
+        self.animals = set(animals)
+        self.server_path = None if server_path is None else Path(server_path)  # folders are only created if set
+        self.weights = {}  # (animal_id, date) -> (weight, note)
+
+    def session_ids(self) -> set:
+        return set(self.sessions)
+
+    def animal_ids(self) -> set:
+        return set(self.animals)
+
+    def create_session(self, info: SessionInfo) -> Path:
+        if self.server_path is None:
+            raise OSError("LocalDatabase has no server_path")
+        session_dir = self.server_path / info.animal_id / info.session_id
+        session_dir.mkdir(parents=True, exist_ok=True)
+        return session_dir
+
+    def push_session(self, info: SessionInfo) -> bool:
+        if info.animal_id not in self.animals:
+            return False
+        self.sessions.add(info.session_id)
+        return True
+
+    def push_weight(self, info: SessionInfo, weight: float, note: str) -> bool:
+        self.weights[(info.animal_id, info.session_datetime.date())] = (weight, note)
+        return True
+
+
+class SessionCatalog:
+    """
+    Session files of data_dir, indexed by path, session id and sync status
+
+    :param catalog_file: SQLite file, ':memory:' for a catalog which is not kept
+    :param hash_files: compute the sha256 of new and changed files
+    """
+
+    def __init__(self, catalog_file: (str, Path) = None, data_dir: (str, Path) = './data/',
+                 suffix: str = BEHAV_SUFFIX, hash_files: bool = True):
+        self.log = logging.getLogger('SessionCatalog')
+        self.data_dir = Path(data_dir)
+        self.suffix = suffix
+        self.hash_files = hash_files
+        if catalog_file is None:
+            catalog_file = self.data_dir / CATALOG_FILE
+        if catalog_file != ':memory:':
+            Path(catalog_file).parent.mkdir(parents=True, exist_ok=True)
+        self.catalog_file = catalog_file
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(catalog_file), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self._lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(DISTINCT session_id) FROM sessions").fetchone()[0]
+
+    def __contains__(self, session_id: str) -> bool:
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM sessions WHERE session_id = ? LIMIT 1",
+                                     (session_id,)).fetchone() is not None
+
+    def refresh(self) -> dict:
+        """
+        updates the catalog from the files in data_dir: only files which are new or whose size or mtime changed
+        are hashed, changed files are checked against the database again. Files with a newer journal are pending
+        and left out of the catalog until the journal is compacted.
+        Returns the number of added, changed, removed and pending files.
+        """
+        with self._lock:
+            known = {row['path']: (row['size'], row['mtime_ns'])
+                     for row in self.conn.execute("SELECT path, size, mtime_ns FROM sessions")}
+        added, changed, pending = [], [], []
+        for path, stat in scan_files(self.data_dir, self.suffix):
+            previous = known.pop(path, None)
+            if self.suffix.endswith('.json') and has_newer_journal(path, stat):
+                pending.append(path)  # a previous entry is removed, it is catalogued again once compacted
+                if previous is not None:
+                    known[path] = previous
+                continue
+            if previous == (stat.st_size, stat.st_mtime_ns):
+                continue
+            try:
+                checksum = file_checksum(path) if self.hash_files else None
+            except OSError as e:  # removed or unreadable, catalogued on the next refresh
+                self.log.warning(f"Could not read {path}: {e}")
+                continue
+            row = (path, session_id_from_file(path, self.suffix), stat.st_size, stat.st_mtime_ns, checksum)
+            (added if previous is None else changed).append(row)
+        removed = [(path,) for path in known]
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT INTO sessions (path, session_id, size, mtime_ns, checksum) "
+                                  "VALUES (?, ?, ?, ?, ?)", added)
+            self.conn.executemany("UPDATE sessions SET session_id = ?, size = ?, mtime_ns = ?, checksum = ?, "
+                                  "synced = 0 WHERE path = ?", [row[1:] + row[:1] for row in changed])
+            self.conn.executemany("DELETE FROM sessions WHERE path = ?", removed)
+        counts = {'added': len(added), 'changed': len(changed), 'removed': len(removed), 'pending': len(pending)}
+        self.log.debug(f"Catalog refreshed: {counts}")
+        return counts
+
+    def update_sync_status(self, database: SessionDatabase, recheck_synced: bool = False) -> int:
+        """
+        asks database which of the unsynced sessions it has and marks them as synced. Synced sessions are only
+        checked again with recheck_synced. Returns the number of sessions whose status changed.
+        """
+        if recheck_synced:
+            with self._lock:
+                catalogued = [row[0] for row in self.conn.execute("SELECT DISTINCT session_id FROM sessions")]
+            in_db = database.existing_sessions(catalogued)
+            n_changed = self.mark_synced(sorted(in_db), True)
+            return n_changed + self.mark_synced(sorted(set(catalogued) - in_db), False)
+        return self.mark_synced(sorted(database.existing_sessions(self.unsynced(include_test=True))), True)
+
+    def mark_synced(self, session_ids: list, synced: bool = True) -> int:
+        with self._lock, self.conn:
+            cursor = self.conn.executemany("UPDATE sessions SET synced = ? WHERE session_id = ? AND synced != ?",
+                                           [(int(synced), session_id, int(synced)) for session_id in session_ids])
+            return cursor.rowcount
+
+    def unsynced(self, include_test: bool = False) -> list:
+        """ids of the sessions which are not in the database, sessions of the test animal only with include_test"""
+        query = "SELECT DISTINCT session_id FROM sessions WHERE synced = 0"
+        if not include_test:
+            query += f" AND instr(session_id, '{TEST_ANIMAL}') = 0"
+        with self._lock:
+            return [row[0] for row in self.conn.execute(query + " ORDER BY session_id")]
+
+    def get(self, session_id: str) -> list:
+        """catalog entries (dicts) of the files of a session"""
+        with self._lock:
+            return [dict(row) for row in self.conn.execute("SELECT * FROM sessions WHERE session_id = ? "
+                                                           "ORDER BY path", (session_id,))]
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,208 @@
+"""
+Renaming a session, e.g. when it was recorded under the wrong animal: every file of the session folder is moved
+to the new session folder, names containing the old session id are changed, and the session id stored in the
+JSON files (session JSON and journal) is patched. All operations are planned and checked before the first one
+runs, and undone in reverse order if one fails. Files are moved, not copied, so large DAQ and video files cost a
+rename on the same file system. The JSON files are patched while streaming them in chunks, without parsing.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+from collections import namedtuple
+from pathlib import Path
+
+from file_transfer import CHUNK_SIZE
+from session_catalog import parse_session_id
+
+PATCH_SUFFIXES = ('.json', '.jsonl')  # files whose id field is patched
+MAX_SPACES = 16  # whitespace around the ':' of a patched field, as written by json.dump with any indent
+
+FileOperation = namedtuple('FileOperation', "kind,source,target")
+MKDIR = 'mkdir'
+MOVE = 'move'
+PATCH = 'patch'  # source is patched in place, target is the backup of the original
+RMDIR = 'rmdir'
+
+
+def patch_json_values(source: (str, Path), target: (str, Path), field: str, old_value, new_value,
+                      chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    copies source to target, replacing the value of field where it is old_value, without loading the whole file.
+    Returns the number of replacements.
+    """
+    old_json = json.dumps(old_value).encode()
+    new_json = json.dumps(new_value).encode()
+    key = json.dumps(field).encode()
+    pattern = re.compile(re.escape(key) + rb'(\s{0,%d}:\s{0,%d})' % (MAX_SPACES, MAX_SPACES) + re.escape(old_json))
+    overlap = len(key) + 2 * MAX_SPACES + 1 + len(old_json) - 1  # a match can start this far before a chunk end
+    n_replaced = 0
+    carry = b''
+    with open(source, 'rb') as fi, open(target, 'wb') as fo:
+        while True:
+            chunk = fi.read(chunk_size)
+            buffer = carry + chunk
+            safe = len(buffer) - overlap if chunk else len(buffer)  # matches starting later may be cut off
+            pos = 0
+            for match in pattern.finditer(buffer):
+                if match.start() >= safe:
+                    break
+                fo.write(buffer[pos:match.start()])
+                fo.write(key + match.group(1) + new_json)
+                pos = match.end()
+                n_replaced += 1
+            cut = max(pos, safe, 0)
+            fo.write(buffer[pos:cut])
+            carry = buffer[cut:]
+            if not chunk:
+                break
+    return n_replaced
+
+
+def rename_file(name: str, old_id: str, new_id: str) -> str:
+    """file name with the session id, or date and animal it starts with, changed"""
+    if old_id in name:
+        return name.replace(old_id, new_id, 1)
+    old_animal, old_datetime = parse_session_id(old_id)
+    new_animal, _ = parse_session_id(new_id)
+    prefix = f"{old_datetime:%Y%m%d}_{old_animal}_"
+    if name.startswith(prefix):
+        return f"{old_datetime:%Y%m%d}_{new_animal}_" + name[len(prefix):]
+    return name
+
+
+class RenamePlan:
+    """
+    File operations run as one batch, undone if one of them fails
+
+    :param field: JSON field patched from old_value to new_value in the PATCH operations
+    """
+
+    def __init__(self, field: str = 'session_id', old_value=None, new_value=None):
+        self.log = logging.getLogger('RenamePlan')
+        self.field = field
+        self.old_value = old_value
+        self.new_value = new_value
+        self.operations = []
+        self.done = []
+
+    def add(self, kind: str, source: Path, target: Path = None):
+        self.operations.append(FileOperation(kind, Path(source), None if target is None else Path(target)))
+
+    def describe(self) -> list:
+        return [f"{op.kind} {op.source}" + ('' if op.target is None or op.kind == PATCH else f" -> {op.target}")
+                for op in self.operations]
+
+    def validate(self):
+        """raises FileExistsError/FileNotFoundError if an operation would fail because of existing files"""
+        created = set()
+        for op in self.operations:
+            if op.kind == MKDIR:
+                if op.source.exists():
+                    raise FileExistsError(f"{op.source} exists")
+                created.add(op.source)
+            elif op.kind == MOVE:
+                if not op.source.exists():
+                    raise FileNotFoundError(f"{op.source} does not exist")
+                if op.target.exists() or op.target in created:
+                    raise FileExistsError(f"{op.target} exists")
+                if not (op.target.parent.is_dir() or op.target.parent in created):
+                    raise FileNotFoundError(f"Folder {op.target.parent} does not exist")
+                created.add(op.target)
+            elif op.kind == PATCH and op.target.exists():
+                raise FileExistsError(f"Backup {op.target} exists")
+
+    def execute(self):
+        """runs all operations, if one fails the ones done are undone and the error is raised"""
+        self.validate()
+        self.done = []
+        try:
+            for op in self.operations:
+                self._run(op)
+                self.done.append(op)
+        except Exception:
+            self.log.exception(f"Rename failed, rolling back {len(self.done)} operations")
+            self.rollback()
+            raise
+        for op in self.done:  # the backups are only kept until all operations succeeded
+            if op.kind == PATCH and op.target.exists():
+                op.target.unlink()
+        self.log.info(f"Ran {len(self.done)} file operations")
+
+    def rollback(self):
+        for op in reversed(self.done):
+            try:
+                self._undo(op)
+            except OSError as e:
+                self.log.error(f"Could not undo {op.kind} {op.source}: {e}")
+        self.done = []
+
+    def _run(self, op: FileOperation):
+        if op.kind == MKDIR:
+            op.source.mkdir()
+        elif op.kind == MOVE:
+            shutil.move(op.source, op.target)
+        elif op.kind == RMDIR:
+            op.source.rmdir()
+        elif op.kind == PATCH:
+            temp_file = op.source.with_name(op.source.name + '.patching')
+            try:
+                if patch_json_values(op.source, temp_file, self.field, self.old_value, self.new_value):
+                    # permission bits only: the patched file keeps the mtime of its writing, unlike with
+                    # copystat, so copies of the old file are not taken as unchanged
+                    shutil.copymode(op.source, temp_file)
+                    os.replace(op.source, op.target)
+                    os.replace(temp_file, op.source)
+            finally:
+                if temp_file.exists():
+                    temp_file.unlink()
+
+    @staticmethod
+    def _undo(op: FileOperation):
+        if op.kind == MKDIR:
+            op.source.rmdir()
+        elif op.kind == MOVE:
+            shutil.move(op.target, op.source)
+        elif op.kind == RMDIR:
+            op.source.mkdir()
+        elif op.kind == PATCH and op.target.exists():
+            os.replace(op.target, op.source)
+
+
+def plan_session_rename(session_dir: (str, Path), new_dir: (str, Path), old_id: str, new_id: str,
+                        field: str = 'session_id') -> RenamePlan:
+    """
+    plans moving the files of session_dir into new_dir (which may exist, e.g. created for the new session),
+    renaming them from old_id to new_id and patching field in the JSON files
+    """
+    session_dir, new_dir = Path(session_dir), Path(new_dir)
+    plan = RenamePlan(field, old_id, new_id)
+    patches = []
+    old_dirs = []
+    missing = []  # parents of new_dir which do not exist
+    parent = new_dir.parent
+    while not parent.exists():
+        missing.append(parent)
+        parent = parent.parent
+    for folder in reversed(missing):
+        plan.add(MKDIR, folder)
+    for folder, dir_names, file_names in os.walk(session_dir):
+        folder = Path(folder)
+        target_dir = new_dir / folder.relative_to(session_dir)
+        if target_dir != folder:
+            old_dirs.append(folder)
+            if not target_dir.is_dir():
+                plan.add(MKDIR, target_dir)
+        for name in sorted(file_names):
+            target = target_dir / rename_file(name, old_id, new_id)
+            if target != folder / name:
+                plan.add(MOVE, folder / name, target)
+            if target.suffix in PATCH_SUFFIXES:
+                patches.append(target)
+    for target in patches:
+        plan.add(PATCH, target, target.with_name(target.name + '.bak'))
+    for folder in reversed(old_dirs):  # deepest first
+        plan.add(RMDIR, folder)
+    plan.validate()
+    return plan
@@ -0,0 +1,260 @@
+"""
+Non-interactive bulk upload of sessions to the lab database, e.g. to backfill the sessions recorded while the
+database was not reachable. The weights of the animals are read from a CSV or JSON file instead of being asked
+for. A pool of worker threads uploads the sessions: creating the session folders, copying the files (checksum
+verified, files already on the server are skipped) and pushing the session and weight to the database.
+The copy is retried with a growing delay. Database writes are not idempotent, so a push is only repeated after
+checking that the session is not in the database yet, and the weight is pushed once. Database calls are limited
+to db_workers at a time. Every finished step is appended to a progress log, a rerun with the same log skips the
+sessions and steps which are done.
+"""
+import argparse
+import csv
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import date, datetime
+from pathlib import Path
+
+from file_transfer import copy_file, is_unchanged
+from session_catalog import SessionDatabase, SessionInfo, parse_session_id
+
+WEIGHT_NOTE = 'Training'
+STEP_CREATED = 'created'
+STEP_COPIED = 'copied'
+STEP_PUSHED = 'pushed'
+STEP_WEIGHED = 'weighed'
+STEP_DONE = 'done'
+STEP_FAILED = 'failed'
+
+
+def _parse_date(value: str) -> date:
+    for fmt in ('%Y-%m-%d', '%Y%m%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown date format: {value}")
+
+
+def _parse_weight(value) -> float:
+    return float(value.replace(',', '.')) if isinstance(value, str) else float(value)
+
+
+def read_weights(weights_file: (str, Path)) -> dict:
+    """
+    weights of the animals as {(animal_id, date): (weight, note)}, from a CSV with the columns animal_id, date,
+    weight and optionally note, or a JSON mapping {animal_id: {date: weight or [weight, note]}}
+    """
+    weights_file = Path(weights_file)
+    weights = {}
+    if weights_file.suffix == '.json':
+        with open(weights_file, 'r') as fi:
+            for animal_id, animal_weights in json.load(fi).items():
+                for day, weight in animal_weights.items():
+                    weight, note = weight if isinstance(weight, list) else (weight, WEIGHT_NOTE)
+                    weights[(animal_id, _parse_date(day))] = (_parse_weight(weight), note)
+        return weights
+    with open(weights_file, 'r', newline='') as fi:
+        for row in csv.DictReader(fi):
+            weights[(row['animal_id'].strip(), _parse_date(row['date']))] = (_parse_weight(row['weight']),
+                                                                            row.get('note') or WEIGHT_NOTE)
+    return weights
+
+
+class UploadLog:
+    """append-only JSON lines log of the upload steps of each session, opened by the first record after close"""
+
+    def __init__(self, log_file: (str, Path)):
+        self.log_file = Path(log_file)
+        self.steps = {}  # session_id -> set of finished steps
+        self._lock = threading.Lock()
+        if self.log_file.exists():
+            with open(self.log_file, 'r') as fi:
+                for line in fi:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:  # line cut off by a crash
+                        continue
+                    self.steps.setdefault(record['session_id'], set()).add(record['step'])
+        self._fo = None
+
+    def done(self, session_id: str, step: str = STEP_DONE) -> bool:
+        with self._lock:
+            return step in self.steps.get(session_id, ())
+
+    def record(self, session_id: str, step: str, **info):
+        with self._lock:
+            self.steps.setdefault(session_id, set()).add(step)
+            if self._fo is None:
+                self._fo = open(self.log_file, 'a')
+            self._fo.write(json.dumps(dict(session_id=session_id, step=step, time=datetime.now().isoformat(),
+                                           **info)) + '\n')
+            self._fo.flush()
+
+    def close(self):
+        with self._lock:
+            if self._fo is not None:
+                self._fo.close()
+                self._fo = None
+
+
+class BulkUploader:
+    """
+    Uploads sessions with a pool of worker threads
+
+    :param files: session_id -> session files to copy into the behaviour folder of the session
+    :param weights: see read_weights, sessions without a weight fail unless require_weight is False
+    :param n_workers: sessions uploaded at the same time, i.e. parallel copies
+    :param db_workers: database calls at the same time
+    :param retries: attempts of the file copy and the session push
+    :param retry_delay: s before the second attempt, doubled for every further attempt
+    """
+
+    def __init__(self, database: SessionDatabase, files: dict, weights: dict, log_file: (str, Path),
+                 project: str, user: str, experiment_name: str, experiment_template: str,
+                 behaviour_folder: str = 'behav', n_workers: int = 4, db_workers: int = 1, retries: int = 3,
+                 retry_delay: float = 1., require_weight: bool = True):
+        self.log = logging.getLogger('BulkUploader')
+        self.database = database
+        self.files = files
+        self.weights = weights
+        self.upload_log = UploadLog(log_file)
+        self.experiment = dict(project=project, user=user, experiment_name=experiment_name,
+                               experiment_template=experiment_template)
+        self.behaviour_folder = behaviour_folder
+        self.n_workers = n_workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.require_weight = require_weight
+        self.db_slots = threading.BoundedSemaphore(db_workers)
+        self.done = []
+        self.skipped = []
+        self.failed = {}  # session_id -> error
+        self._results_lock = threading.Lock()
+
+    def run(self, session_ids: list, on_done=None) -> dict:
+        """
+        uploads the sessions, on_done is called with the session_id of each uploaded session.
+        Can be called again, e.g. for the failed sessions, the summary is of the last run.
+        """
+        self.done, self.skipped, self.failed = [], [], {}
+        session_queue = queue.Queue()
+        for session_id in session_ids:
+            if self.upload_log.done(session_id):
+                self.skipped.append(session_id)
+            else:
+                session_queue.put(session_id)
+        self.log.info(f"Uploading {session_queue.qsize()} sessions, {len(self.skipped)} already done")
+        workers = [threading.Thread(target=self._work, args=(session_queue, on_done), name=f'Upload_{w_id}',
+                                    daemon=True) for w_id in range(min(self.n_workers, session_queue.qsize()))]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            self.upload_log.close()
+        self.log.info(f"Uploaded {len(self.done)} sessions, {len(self.failed)} failed")
+        return self.summary()
+
+    def summary(self) -> dict:
+        return {'done': list(self.done), 'skipped': list(self.skipped), 'failed': dict(self.failed)}
+
+    def session_info(self, session_id: str) -> SessionInfo:
+        animal_id, session_datetime = parse_session_id(session_id)
+        return SessionInfo(session_id, animal_id, session_datetime, **self.experiment)
+
+    def _work(self, session_queue: queue.Queue, on_done):
+        while True:
+            try:
+                session_id = session_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._upload(session_id)
+            except Exception as e:  # keep the worker alive, the session is retried in the next run
+                self.log.warning(f"{session_id} failed: {e}")
+                self.upload_log.record(session_id, STEP_FAILED, error=str(e))
+                with self._results_lock:
+                    self.failed[session_id] = str(e)
+                continue
+            with self._results_lock:
+                self.done.append(session_id)
+            if on_done is not None:
+                on_done(session_id)
+
+    def _upload(self, session_id: str):
+        info = self.session_info(session_id)
+        weight = self.weights.get((info.animal_id, info.session_datetime.date()))
+        if weight is None and self.require_weight:
+            raise ValueError(f"No weight of {info.animal_id} on {info.session_datetime.date()}")
+        if not self.upload_log.done(session_id, STEP_PUSHED):
+            session_dir = self._db_call(self.database.create_session, info)
+            self.upload_log.record(session_id, STEP_CREATED, session_dir=str(session_dir))
+            target = session_dir / self.behaviour_folder
+            self._retry(self._copy, self.files[session_id], target)
+            self.upload_log.record(session_id, STEP_COPIED)
+            if not self._retry(self._push_session, info):
+                raise ValueError(f"{session_id} was not accepted by the database")
+            self.upload_log.record(session_id, STEP_PUSHED)
+        if not self.upload_log.done(session_id, STEP_WEIGHED):
+            if weight is not None:
+                self._db_call(self.database.push_weight, info, *weight)  # once, a retry could insert it twice
+                self.upload_log.record(session_id, STEP_WEIGHED)
+            elif self.require_weight:
+                raise ValueError(f"No weight of {info.animal_id} on {info.session_datetime.date()}")
+        self.upload_log.record(session_id, STEP_DONE)
+
+    def _push_session(self, info) -> bool:
+        """pushes the session unless an earlier attempt, e.g. one which timed out, already inserted it"""
+        if self._db_call(self.database.has_session, info.session_id):
+            return True
+        return self._db_call(self.database.push_session, info)
+
+    def _db_call(self, func, *args):
+        with self.db_slots:
+            return func(*args)
+
+    @staticmethod
+    def _copy(files: list, target: Path):
+        target.mkdir(parents=True, exist_ok=True)
+        for file in files:
+            file = Path(file)
+            if not is_unchanged(file, target / file.name, compare_checksum=True):
+                for _ in copy_file(file, target / file.name):
+                    pass
+
+    def _retry(self, func, *args):
+        delay = self.retry_delay
+        for attempt in range(1, self.retries + 1):
+            try:
+                return func(*args)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                self.log.debug(f"Attempt {attempt} failed ({e}), retrying in {delay}s")
+                time.sleep(delay)
+                delay *= 2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Uploads the sessions of the data folder which are not in the DB")
+    parser.add_argument('weights', help="CSV (animal_id,date,weight[,note]) or JSON file with the weights")
+    parser.add_argument('--log', default='./data/upload_log.jsonl', help="progress log, reruns resume from it")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--db_workers', type=int, default=1)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--recheck', action='store_true', help="also ask the DB again for sessions marked as synced")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from host_utils import Session_backupCreator
+    summary = Session_backupCreator(recheck=args.recheck).upload_sessions(
+        args.weights, log_file=args.log, n_workers=args.workers, db_workers=args.db_workers, retries=args.retries)
+    print(f"{len(summary['done'])} uploaded, {len(summary['skipped'])} already done, "
+          f"{len(summary['failed'])} failed")
+    for session_id, error in summary['failed'].items():
+        print(f"  {session_id}: {error}")
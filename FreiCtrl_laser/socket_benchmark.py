@@ -0,0 +1,393 @@
+"""
+Loopback benchmark of the socket layer.
+Pairs of SocketComm server and client are opened on localhost, the server echoes what it receives. For every
+combination of read path, message size, SSL and number of concurrent clients the throughput (messages per second
+one way) and the round trip latency (p50/p99 of ping-pong messages) are measured and written to a JSON file, so
+numbers from before and after changes of the socket layer can be compared.
+In the 'server' mode all clients connect to one SocketServer port instead, which serves them from one thread
+(newline framing without SSL, like the SocketServer).
+For TLS the time to (re)connect is measured as well, showing whether sessions are resumed.
+check_tls (--check_tls) verifies the TLS link on localhost: handshake, message round trip and session reuse,
+exiting with an error if one of them fails.
+"""
+import json
+import logging
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from socket_utils import SocketComm, SocketMessage, SocketServer, FRAMING_NEWLINE, FRAMING_LENGTH
+
+READERS = ('read_json_message', 'read_json_message_fast', 'read_json_message_fast_linebreak',
+           'read_json_messages')
+MODES = ('pairs', 'server')  # one SocketComm server per client or all clients on one SocketServer
+CONNECT_TIMEOUT = 5  # s
+
+
+def percentile(values: list, q: float) -> float:
+    """q-th percentile (0..100) of values, nearest rank"""
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def make_reader(comm: SocketComm, name: str):
+    """returns a function giving the list of messages received by one call of the read path `name`"""
+    if name == 'read_json_messages':
+        return comm.read_json_messages
+    read = getattr(comm, name)
+
+    def read_list() -> list:
+        message = read()
+        return [] if message is None else [message]
+    return read_list
+
+
+def make_self_signed_cert(directory: (str, Path)) -> (str, str):
+    """creates a certificate and key for localhost with the openssl command line tool"""
+    cert_file = str(Path(directory) / 'localhost_cert.pem')
+    key_file = str(Path(directory) / 'localhost_key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+                    '-keyout', key_file, '-out', cert_file], check=True, capture_output=True)
+    return cert_file, key_file
+
+
+def connect_client(client: SocketComm):
+    """connects client, retrying while the server is not listening yet"""
+    t_start = time.monotonic()
+    while True:
+        try:
+            client.reconnect()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() - t_start > CONNECT_TIMEOUT:
+                raise
+            time.sleep(0.001)
+
+
+def open_pair(port: int, use_ssl: bool = False, cert_file: str = None, key_file: str = None):
+    """returns connected (server, client) SocketComm on localhost:port"""
+    server = SocketComm('server', port=port, use_ssl=use_ssl, cert_file=cert_file, key_file=key_file)
+    client = SocketComm('client', port=port, use_ssl=use_ssl, ca_file=cert_file)
+    for comm in (server, client):
+        comm.log.setLevel(logging.WARNING)
+    server.threaded_accept_connection()
+    t_start = time.monotonic()
+    try:
+        connect_client(client)
+    except OSError:
+        server.stop_waiting_for_connection()
+        raise
+    while not server.connected:
+        if time.monotonic() - t_start > CONNECT_TIMEOUT:
+            server.stop_waiting_for_connection()
+            client.close_socket()
+            raise TimeoutError(f"Server on port {port} did not accept the connection")
+        time.sleep(0.001)
+    return server, client
+
+
+def echo_server(server: SocketComm, reader: str, stop_event: threading.Event, counter: list):
+    """answers messages with 'echo' set, counts all received messages in counter[0]"""
+    read = make_reader(server, reader)
+    while not stop_event.is_set():
+        for message in read():
+            if message is SocketMessage.client_disconnected:
+                return
+            counter[0] += 1
+            if message.get('echo'):
+                server.send_json_message(message)
+
+
+def wait_for_echo(read, seq: int, timeout: float = CONNECT_TIMEOUT) -> bool:
+    t_start = time.monotonic()
+    while time.monotonic() - t_start < timeout:
+        for message in read():
+            if message is SocketMessage.client_disconnected:
+                return False
+            if message.get('seq') == seq:
+                return True
+    return False
+
+
+def run_client(client: SocketComm, reader: str, size: int, n_messages: int, n_pings: int, framing: str,
+               result: dict):
+    """sends n_messages one way and n_pings ping-pongs, fills result with elapsed time and latencies"""
+    if framing != client.framing:
+        client.negotiate_framing(framing)
+        if client.framing != framing:
+            raise RuntimeError(f"Server refused {framing} framing")
+    read = make_reader(client, reader)
+    payload = 'x' * size
+    t_start = time.perf_counter()
+    for seq in range(n_messages):
+        client.send_json_message({'type': 'bench', 'seq': seq, 'echo': seq == n_messages - 1, 'payload': payload})
+    if not wait_for_echo(read, n_messages - 1):
+        raise TimeoutError('No answer from echo server')
+    result['elapsed'] = time.perf_counter() - t_start
+    latencies = []
+    for seq in range(n_messages, n_messages + n_pings):
+        t_sent = time.perf_counter()
+        client.send_json_message({'type': 'bench', 'seq': seq, 'echo': True, 'payload': payload})
+        if not wait_for_echo(read, seq):
+            raise TimeoutError('No answer from echo server')
+        latencies.append(time.perf_counter() - t_sent)
+    result['latencies'] = latencies
+
+
+def run_case(reader: str, size: int, n_clients: int, use_ssl: bool, port: int, n_messages: int, n_pings: int,
+             cert_file: str = None, key_file: str = None, framing: str = FRAMING_NEWLINE) -> dict:
+    """benchmarks one configuration, the pairs use ports port..port+n_clients-1"""
+    case = {'mode': 'pairs', 'reader': reader, 'size': size, 'clients': n_clients, 'ssl': use_ssl,
+            'framing': framing, 'messages': n_messages, 'pings': n_pings}
+    stop_event = threading.Event()
+    pairs, servers, clients = [], [], []
+    try:
+        for c_id in range(n_clients):
+            pairs.append(open_pair(port + c_id, use_ssl, cert_file, key_file))
+        for server, client in pairs:
+            counter = [0]
+            thread = threading.Thread(target=echo_server, args=(server, reader, stop_event, counter), daemon=True)
+            thread.start()
+            servers.append((thread, counter))
+            result = {}
+            thread = threading.Thread(target=_catch, args=(run_client, client, reader, size, n_messages,
+                                                           n_pings, framing, result), daemon=True)
+            clients.append((thread, result))
+        run_clients(case, clients)
+        case['received'] = sum(counter[0] for _, counter in servers)
+    except Exception as e:
+        case['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        stop_event.set()
+        for thread, _ in servers:
+            thread.join()
+        for server, client in pairs:
+            client.close_socket()
+            server.close_socket()
+    return case
+
+
+def run_server_case(reader: str, size: int, n_clients: int, port: int, n_messages: int, n_pings: int) -> dict:
+    """benchmarks n_clients SocketComm clients connected to one SocketServer on port"""
+    case = {'mode': 'server', 'reader': reader, 'size': size, 'clients': n_clients, 'ssl': False,
+            'framing': FRAMING_NEWLINE, 'messages': n_messages, 'pings': n_pings}
+    server = SocketServer(port=port, max_queue_bytes=1 << 24)
+    server.log.setLevel(logging.WARNING)
+    counter = [0]  # only changed on the server thread
+
+    def echo(client, message):
+        if message is SocketMessage.client_disconnected:
+            return
+        counter[0] += 1
+        if message.get('echo'):
+            server.send(client, message)
+
+    server.default_handler = echo
+    comms, clients = [], []
+    try:
+        server.start()
+        for _ in range(n_clients):
+            client = SocketComm('client', port=port)
+            client.log.setLevel(logging.WARNING)
+            comms.append(client)
+            connect_client(client)
+            result = {}
+            thread = threading.Thread(target=_catch, args=(run_client, client, reader, size, n_messages,
+                                                           n_pings, FRAMING_NEWLINE, result), daemon=True)
+            clients.append((thread, result))
+        run_clients(case, clients)
+        case['received'] = counter[0]
+    except Exception as e:
+        case['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        for client in comms:
+            client.close_socket()
+        server.stop()
+    return case
+
+
+def run_clients(case: dict, clients: list):
+    """runs the (thread, result) of the clients and adds throughput and latencies to case"""
+    for thread, _ in clients:
+        thread.start()
+    for thread, _ in clients:
+        thread.join()
+    errors = [result['error'] for _, result in clients if 'error' in result]
+    if errors:
+        raise RuntimeError(errors[0])
+    n_messages, size = case['messages'], case['size']
+    elapsed = max(result['elapsed'] for _, result in clients)
+    latencies = [latency * 1e6 for _, result in clients for latency in result['latencies']]
+    frame_size = len(json.dumps({'type': 'bench', 'seq': n_messages, 'echo': False, 'payload': 'x' * size})) + 1
+    case.update({
+        'msgs_per_s': n_messages * len(clients) / elapsed,
+        'mb_per_s': n_messages * len(clients) * frame_size / elapsed / 1e6,
+        'latency_p50_us': percentile(latencies, 50),
+        'latency_p99_us': percentile(latencies, 99),
+    })
+
+
+def _catch(function, *args):
+    """runs function in a thread, storing exceptions in its result dict (the last argument)"""
+    try:
+        function(*args)
+    except Exception as e:
+        args[-1]['error'] = f"{type(e).__name__}: {e}"
+
+
+def measure_connects(port: int, use_ssl: bool, n_connects: int = 20, cert_file: str = None,
+                     key_file: str = None) -> dict:
+    """
+    connects a client n_connects times to a server, exchanging one message per connection,
+    returns the connect times and how often the TLS session was resumed
+    """
+    server = SocketComm('server', port=port, use_ssl=use_ssl, cert_file=cert_file, key_file=key_file)
+    client = SocketComm('client', port=port, use_ssl=use_ssl, ca_file=cert_file)
+    for comm in (server, client):
+        comm.log.setLevel(logging.ERROR)
+    stop_event = threading.Event()
+
+    def serve():
+        while not stop_event.is_set():
+            server.accept_connection()
+            while server.connected and not stop_event.is_set():
+                message = server.read_json_message_fast()
+                if message is SocketMessage.client_disconnected:
+                    break
+                if message is not None:
+                    server.send_json_message(message)
+            server.close_connection()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    connect_times, reused = [], 0
+    case = {'ssl': use_ssl, 'connects': n_connects}
+    try:
+        for seq in range(n_connects):
+            t_start = time.perf_counter()
+            connect_client(client)
+            connect_times.append((time.perf_counter() - t_start) * 1e3)
+            reused += client.session_reused
+            client.send_json_message({'type': 'bench', 'seq': seq})
+            if not wait_for_echo(make_reader(client, 'read_json_messages'), seq):
+                raise TimeoutError('No answer from echo server')
+            client.close_socket()
+        case.update({'connect_ms_first': connect_times[0],
+                     'connect_ms_p50': percentile(connect_times[1:] or connect_times, 50),
+                     'sessions_reused': reused})
+    except Exception as e:
+        case['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        stop_event.set()
+        server.stop_waiting_for_connection()
+        client.close_socket()
+        thread.join()
+        server.close_socket()
+    return case
+
+
+def check_tls(port: int = 8900, cert_file: str = None, key_file: str = None, n_connects: int = 3) -> dict:
+    """
+    connects n_connects times over TLS to a local echo server, with a temporary self-signed certificate unless
+    cert_file is given. Raises RuntimeError if a handshake or round trip fails or a session is not reused.
+    """
+    with tempfile.TemporaryDirectory() as cert_dir:
+        if cert_file is None:
+            cert_file, key_file = make_self_signed_cert(cert_dir)
+        case = measure_connects(port, True, n_connects, cert_file, key_file)
+    if 'error' in case:
+        raise RuntimeError(f"TLS connection failed: {case['error']}")
+    if case['sessions_reused'] != n_connects - 1:
+        raise RuntimeError(f"Only {case['sessions_reused']} of {n_connects - 1} reconnects reused the TLS session")
+    return case
+
+
+def run_benchmark(readers=READERS, sizes=(64, 1024, 16384), clients=(1, 4), ssl_modes=(False,),
+                  n_messages: int = 2000, n_pings: int = 200, port: int = 8900,
+                  cert_file: str = None, key_file: str = None, framings=(FRAMING_NEWLINE,),
+                  modes=('pairs',)) -> dict:
+    """runs all combinations and returns the results with some information about the machine"""
+    log = logging.getLogger('SocketBenchmark')
+    results = []
+    cases = [(mode, use_ssl, framing) for mode in modes for use_ssl in ssl_modes for framing in framings
+             if mode == 'pairs' or (not use_ssl and framing == FRAMING_NEWLINE)]  # what SocketServer supports
+    for mode, use_ssl, framing in cases:
+        for n_clients in clients:
+            for size in sizes:
+                for reader in readers:
+                    if mode == 'server':
+                        case = run_server_case(reader, size, n_clients, port, n_messages, n_pings)
+                        port += 1
+                    else:
+                        case = run_case(reader, size, n_clients, use_ssl, port, n_messages, n_pings,
+                                        cert_file, key_file, framing)
+                        port += n_clients  # fresh ports, the old ones may still be in TIME_WAIT
+                    name = f"{mode} {reader} size={size} clients={n_clients} ssl={use_ssl} framing={framing}"
+                    if 'error' in case:
+                        log.warning(f"{name}: {case['error']}")
+                    else:
+                        log.info(f"{name}: {case['msgs_per_s']:.0f} msgs/s, "
+                                 f"p50 {case['latency_p50_us']:.0f}us, p99 {case['latency_p99_us']:.0f}us")
+                    results.append(case)
+    connects = []
+    for use_ssl in ssl_modes:
+        case = measure_connects(port, use_ssl, cert_file=cert_file, key_file=key_file)
+        port += 1
+        if 'error' not in case:
+            log.info(f"connect ssl={use_ssl}: first {case['connect_ms_first']:.2f}ms, "
+                     f"then p50 {case['connect_ms_p50']:.2f}ms, {case['sessions_reused']} sessions reused")
+        connects.append(case)
+    return {'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+            'connects': connects}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Loopback throughput and latency benchmark of SocketComm')
+    parser.add_argument('--readers', nargs='+', default=list(READERS), choices=READERS, help='Read paths')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[64, 1024, 16384], help='Payload sizes in bytes')
+    parser.add_argument('--clients', nargs='+', type=int, default=[1, 4], help='Numbers of concurrent clients')
+    parser.add_argument('--ssl', action='store_true', help='Run every case also with SSL')
+    parser.add_argument('--framing', nargs='+', default=[FRAMING_NEWLINE], choices=[FRAMING_NEWLINE, FRAMING_LENGTH],
+                        help='Message framings')
+    parser.add_argument('--modes', nargs='+', default=['pairs'], choices=MODES,
+                        help='pairs: one server per client, server: all clients on one SocketServer port')
+    parser.add_argument('--cert', type=str, default=None, help='Certificate file for SSL')
+    parser.add_argument('--key', type=str, default=None, help='Key file for SSL')
+    parser.add_argument('--self_signed', action='store_true', help='Use a temporary self-signed certificate')
+    parser.add_argument('--messages', type=int, default=2000, help='Messages per client for throughput')
+    parser.add_argument('--pings', type=int, default=200, help='Ping-pongs per client for latency')
+    parser.add_argument('--port', type=int, default=8900, help='First port used')
+    parser.add_argument('--output', type=str, default='socket_benchmark.json', help='Result file')
+    parser.add_argument('--check_tls', action='store_true',
+                        help='Only check handshake, round trip and session reuse of TLS, exit 1 if one fails')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.check_tls:
+        try:
+            result = check_tls(args.port, args.cert, args.key)
+        except RuntimeError as e:
+            print(f"TLS check failed: {e}")
+            raise SystemExit(1)
+        print(f"TLS check passed: handshake {result['connect_ms_first']:.2f}ms, "
+              f"{result['sessions_reused']} sessions reused")
+        raise SystemExit(0)
+    with tempfile.TemporaryDirectory() as cert_dir:
+        if args.self_signed:
+            args.cert, args.key = make_self_signed_cert(cert_dir)
+        report = run_benchmark(args.readers, args.sizes, args.clients, (False, True) if args.ssl else (False,),
+                               args.messages, args.pings, args.port, args.cert, args.key, args.framing,
+                               args.modes)
+    with open(args.output, 'w') as fo:
+        json.dump(report, fo, indent=2)
+    print(f"Results written to {args.output}")
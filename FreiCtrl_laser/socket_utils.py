@@ -1,13 +1,26 @@
 import socket
 import ssl
 import threading
+import queue
 import json
 import time
 import select
+import selectors
+import struct
 import logging
 
+from collections import deque
 from enum import Enum
 
+try:
+    from config import SSL_CERT_FILE, SSL_KEY_FILE, SSL_CA_FILE
+except ImportError:  # socket_utils used without the FreiCtrl_laser config
+    SSL_CERT_FILE = SSL_KEY_FILE = SSL_CA_FILE = None
+
+RECV_SIZE = 65536  # bytes pulled from the socket per recv call
+HANDSHAKE_TIMEOUT = 5  # s
+CONNECT_TIMEOUT = 2  # s, without it a connect during a network outage blocks for the OS TCP timeout
+
 
 class MessageType(Enum):
     start_daq = 'start_rec'
@@ -25,6 +38,13 @@ class MessageType(Enum):
     disconnected = 'disconnected'
     copy_files = 'copy_files'
     purge_files = 'purge_files'
+    subscribe = 'subscribe'
+    unsubscribe = 'unsubscribe'
+    event = 'event'
+    trigger = 'trigger'
+    heartbeat = 'heartbeat'
+    heartbeat_ack = 'heartbeat_ack'
+    framing = 'framing'
 
 class MessageStatus(Enum):
     ready = 'ready'
@@ -39,6 +59,79 @@ class MessageStatus(Enum):
     calib_ok = 'calib_ok'
     copy_ok = 'copy_ok'
     copy_fail = 'copy_fail'
+    trigger_ok = 'trigger_ok'
+    purge_ok = 'purge_ok'
+    purge_fail = 'purge_fail'
+
+
+FRAMING_NEWLINE = 'newline'  # json terminated by a newline, understood by every peer
+FRAMING_LENGTH = 'length'  # 4 byte length header, body is json or struct packed (see register_binary_body)
+
+# struct packed bodies for high rate message types, only used with length prefixed framing
+BINARY_BODIES = {}  # message type -> (body id, struct of the fields, field names, raw bytes in 'payload')
+_BINARY_BODY_TYPES = {}  # body id -> message type
+
+
+def register_binary_body(message_type: (MessageType, str), body_id: int, fmt: str, fields: tuple = (),
+                         payload: bool = False):
+    """
+    sends messages of message_type struct packed instead of as json if the length prefixed framing is used
+
+    :param body_id: first byte of the body, identifies the message type, 1..255 except ord('{')
+    :param fmt: struct format of the fields
+    :param fields: message keys packed with fmt, in order
+    :param payload: message carries raw bytes in 'payload', appended after the fields
+    """
+    if isinstance(message_type, MessageType):
+        message_type = message_type.value
+    if not 0 < body_id < 256 or body_id == ord('{'):
+        raise ValueError(f"Invalid body id {body_id}")
+    BINARY_BODIES[message_type] = (body_id, struct.Struct(fmt), tuple(fields), payload)
+    _BINARY_BODY_TYPES[body_id] = message_type
+
+
+def encode_body(message: dict) -> bytes:
+    """body of a length prefixed frame, struct packed if registered for the message type and fitting, else json"""
+    codec = BINARY_BODIES.get(message.get('type'))
+    if codec is not None:
+        body_id, packer, fields, payload = codec
+        if len(message) == len(fields) + 1 + payload and all(field in message for field in fields):
+            try:
+                body = bytes((body_id,)) + packer.pack(*[message[field] for field in fields])
+                return body + bytes(message['payload']) if payload else body
+            except (struct.error, KeyError, TypeError):  # e.g. None values, those go as json
+                pass
+    return json.dumps(message).encode()
+
+
+def decode_body(body: bytes) -> dict:
+    """inverse of encode_body, raises ValueError for unknown bodies"""
+    if body[:1] == b'{':
+        return json.loads(body.decode())
+    message_type = _BINARY_BODY_TYPES.get(body[0]) if body else None
+    if message_type is None:
+        raise ValueError(f"Unknown body id {body[:1]}")
+    _, packer, fields, payload = BINARY_BODIES[message_type]
+    try:
+        values = packer.unpack_from(body, 1)
+    except struct.error as e:
+        raise ValueError(f"Broken {message_type} body") from e
+    message = {'type': message_type}
+    message.update(zip(fields, values))
+    if payload:
+        message['payload'] = body[1 + packer.size:]
+    return message
+
+
+register_binary_body(MessageType.heartbeat, 1, '<d', ('time',))
+register_binary_body(MessageType.heartbeat_ack, 2, '<d', ('time',))
+# triggers stay json: their only consumer, TriggerEndpoint, reads newline framed json
+
+
+def encode_message(message: dict) -> bytes:
+    """encodes a message for sending, newline terminated json"""
+    return json.dumps(message).encode() + b'\n'
+
 
 class SocketMessage:
     status_error = {'type': MessageType.status.value, 'status': MessageStatus.error.value}
@@ -55,6 +148,42 @@ class SocketMessage:
     respond_copy = {'type': MessageType.response.value, 'status': MessageStatus.copy_ok.value}
     respond_copy_fail = {'type': MessageType.response.value, 'status': MessageStatus.copy_fail.value}
     client_disconnected = {'type': MessageType.disconnected.value}
+    trigger = {'type': MessageType.trigger.value}
+
+    # messages depending on the settings: name -> (settings it depends on, builder)
+    # they are built on first access and cached, together with their encoded bytes, until a setting changes
+    _templates = {
+        'start_daq': (('session_id', 'daq_setting_file'),
+                      lambda m: {'type': MessageType.start_daq.value, 'session_id': m.session_id,
+                                 'setting_file': m.daq_setting_file}),
+        'stop_daq': ((), lambda m: {'type': MessageType.stop_daq.value}),
+        'start_daq_pulses': (('fps', 'pulse_lag'),
+                             lambda m: {'type': MessageType.start_daq_pulses.value, 'fps': m.fps,
+                                        'pulse_lag': m.pulse_lag}),
+        'stop_daq_pulses': ((), lambda m: {'type': MessageType.stop_daq_pulses.value}),
+        'start_daq_viewing': (('session_id', 'daq_setting_file'),
+                              lambda m: {'type': MessageType.start_daq_viewing.value, 'session_id': m.session_id,
+                                         'setting_file': m.daq_setting_file}),
+        'poll_status': ((), lambda m: {'type': MessageType.poll_status.value}),
+        'start_video_rec': (('session_id', 'basler_setting_file', 'fps'),
+                            lambda m: {'type': MessageType.start_video_rec.value, 'session_id': m.session_id,
+                                       'setting_file': m.basler_setting_file, 'frame_rate': m.fps}),
+        'start_video_view': (('session_id', 'basler_setting_file', 'fps'),
+                             lambda m: {'type': MessageType.start_video_view.value, 'session_id': m.session_id,
+                                        'setting_file': m.basler_setting_file, 'frame_rate': m.fps}),
+        'stop_video': ((), lambda m: {'type': MessageType.stop_video.value}),
+        'start_video_calibrec': (('basler_setting_file',),
+                                 lambda m: {'type': MessageType.start_video_calibrec.value,
+                                            'session_id': 'calibration', 'setting_file': m.basler_setting_file,
+                                            'frame_rate': 5}),
+        'copy_files': (('session_id', 'session_path'),
+                       lambda m: {'type': MessageType.copy_files.value, 'session_id': m.session_id,
+                                  'session_path': m.session_path}),
+        'purge_files': (('session_id',),
+                        lambda m: {'type': MessageType.purge_files.value, 'session_id': m.session_id}),
+    }
+    _dependents = {}  # setting -> names of the messages using it, filled below the class
+    _static_encoded = {}  # encoded bytes of the constant class level messages
 
     def __init__(self):
         self._session_path = None
@@ -63,28 +192,31 @@ class SocketMessage:
         self._daq_setting_file = ''
         self._basler_setting_file = ''
         self._pulse_lag = 0
-        self.start_daq = {'type': MessageType.start_daq.value, 'session_id': self._session_id,
-                          'setting_file': self._daq_setting_file}
-        self.stop_daq = {'type': MessageType.stop_daq.value}
-        self.start_daq_pulses = {'type': MessageType.start_daq_pulses.value, 'fps': self._fps,
-                                 'pulse_lag': self._pulse_lag}
-        self.stop_daq_pulses = {'type': MessageType.stop_daq_pulses.value}
-        self.start_daq_viewing = {'type': MessageType.start_daq_viewing.value, 'session_id': self._session_id,
-                                  'setting_file': self._daq_setting_file}
-        self.poll_status = {'type': MessageType.poll_status.value}
-
-        self.start_video_rec = {'type': MessageType.start_video_rec.value, 'session_id': self._session_id,
-                                'setting_file': self._basler_setting_file, 'frame_rate': self._fps}
-        self.start_video_view = {'type': MessageType.start_video_view.value, 'session_id': self._session_id,
-                                 'setting_file': self._basler_setting_file, 'frame_rate': self._fps}
-        self.stop_video = {'type': MessageType.stop_video.value}
-
-        self.start_video_calibrec = {'type': MessageType.start_video_calibrec.value, 'session_id': 'calibration',
-                                     'setting_file': self._basler_setting_file, 'frame_rate': 5}
-
-        self.copy_files = {'type': MessageType.copy_files.value, 'session_id': self._session_id,
-                                     'session_path': self._session_path}
-        self.purge_files = {'type': MessageType.purge_files.value, 'session_id': self._session_id}
+        self._messages = {}  # built messages
+        self._encoded = {}  # encoded bytes of built messages
+
+    def get_message(self, name: str) -> dict:
+        message = self._messages.get(name)
+        if message is None:
+            message = self._messages[name] = self._templates[name][1](self)
+        return message
+
+    def encode(self, name: str) -> bytes:
+        """encoded bytes of a message, ready to be send as they are"""
+        if name not in self._templates:
+            data = self._static_encoded.get(name)
+            if data is None:
+                data = self._static_encoded[name] = encode_message(getattr(SocketMessage, name))
+            return data
+        data = self._encoded.get(name)
+        if data is None:
+            data = self._encoded[name] = encode_message(self.get_message(name))
+        return data
+
+    def _invalidate(self, setting: str):
+        for name in self._dependents.get(setting, ()):
+            self._messages.pop(name, None)
+            self._encoded.pop(name, None)
 
     @property
     def pulse_lag(self):
@@ -93,7 +225,7 @@ class SocketMessage:
     @pulse_lag.setter
     def pulse_lag(self, value: int):
         self._pulse_lag = value
-        self.update_messages()
+        self._invalidate('pulse_lag')
 
     @property
     def session_id(self):
@@ -102,7 +234,7 @@ class SocketMessage:
     @session_id.setter
     def session_id(self, value: str):
         self._session_id = value
-        self.update_messages()
+        self._invalidate('session_id')
 
     @property
     def session_path(self):
@@ -111,7 +243,7 @@ class SocketMessage:
     @session_path.setter
     def session_path(self, value: str):
         self._session_path = value
-        self.update_messages()
+        self._invalidate('session_path')
 
     @property
     def fps(self):
@@ -120,7 +252,7 @@ class SocketMessage:
     @fps.setter
     def fps(self, value: float):
         self._fps = value
-        self.update_messages()
+        self._invalidate('fps')
 
     @property
     def daq_setting_file(self):
@@ -129,7 +261,7 @@ class SocketMessage:
     @daq_setting_file.setter
     def daq_setting_file(self, value: str):
         self._daq_setting_file = value
-        self.update_messages()
+        self._invalidate('daq_setting_file')
 
     @property
     def basler_setting_file(self):
@@ -138,20 +270,127 @@ class SocketMessage:
     @basler_setting_file.setter
     def basler_setting_file(self, value: str):
         self._basler_setting_file = value
-        self.update_messages()
+        self._invalidate('basler_setting_file')
 
     def update_messages(self):
-        self.start_daq.update(**{'session_id': self.session_id, 'setting_file': self.daq_setting_file})
-        self.start_daq_viewing.update(**{'session_id': self._session_id,
-                                         'setting_file': self.daq_setting_file})
-        self.start_daq_pulses.update(**{'fps': self.fps, 'pulse_lag': self.pulse_lag})
-        self.start_video_rec.update(**{'session_id': self.session_id, 'setting_file': self.basler_setting_file,
-                                       'frame_rate': self.fps})
-        self.start_video_view.update(**{'session_id': self._session_id, 'setting_file': self.basler_setting_file,
-                                        'frame_rate': self.fps})
-        self.start_video_calibrec.update(**{'session_id': 'calibration', 'setting_file': self.basler_setting_file})
-        self.copy_files.update(**{'session_id': self.session_id, 'session_path': self._session_path})
-        self.purge_files.update(**{'session_id': self._session_id})
+        """drops all built messages, they are rebuilt from the current settings on next access"""
+        self._messages.clear()
+        self._encoded.clear()
+
+
+for _name, (_settings, _) in SocketMessage._templates.items():
+    for _setting in _settings:
+        SocketMessage._dependents.setdefault(_setting, []).append(_name)
+    # expose the messages as attributes as before, e.g. SocketMessage().start_daq
+    setattr(SocketMessage, _name, property(lambda self, name=_name: self.get_message(name)))
+del _name, _settings, _setting
+
+
+class FrameReader:
+    """
+    Collects received bytes and splits them into frames, partial frames are kept until they are completed.
+    Frames are either terminated by a delimiter or prefixed by their length (4 bytes, big endian).
+    """
+    LENGTH_HEADER = struct.Struct('>I')
+
+    def __init__(self, delimiter: bytes = b'\n', length_prefixed: bool = False):
+        self.delimiter = delimiter
+        self.length_prefixed = length_prefixed
+        self.buffer = bytearray()
+        self._start = 0  # begin of the first unread frame in buffer
+        self._scanned = 0  # position up to which the buffer was already searched for a delimiter
+        self._skip_delimiter = False  # a json popped without delimiter, its delimiter may still arrive
+
+    def __len__(self):
+        return len(self.buffer) - self._start
+
+    def feed(self, data: bytes):
+        if self._start:  # drop consumed frames once per read instead of once per frame
+            del self.buffer[:self._start]
+            self._scanned -= self._start
+            self._start = 0
+        self.buffer += data
+
+    def clear(self):
+        self.buffer = bytearray()
+        self._start = 0
+        self._scanned = 0
+        self._skip_delimiter = False
+
+    def set_length_prefixed(self, length_prefixed: bool):
+        """switches the framing, bytes already received are split with the new framing"""
+        self.length_prefixed = length_prefixed
+        self._scanned = self._start
+
+    def next_frame(self) -> (bytes, None):
+        """returns the next complete frame without delimiter/length header, None if there is none yet"""
+        if self.length_prefixed:
+            header_end = self._start + self.LENGTH_HEADER.size
+            if len(self.buffer) < header_end:
+                return None
+            length, = self.LENGTH_HEADER.unpack_from(self.buffer, self._start)
+            if len(self.buffer) < header_end + length:
+                return None
+            frame = bytes(self.buffer[header_end:header_end + length])
+            self._start = header_end + length
+        else:
+            if not self._consume_pending_delimiter():
+                return None
+            end = self.buffer.find(self.delimiter, max(self._start, self._scanned))
+            if end == -1:
+                self._scanned = max(self._start, len(self.buffer) - len(self.delimiter) + 1)
+                return None
+            frame = bytes(self.buffer[self._start:end])
+            self._start = end + len(self.delimiter)
+        self._scanned = self._start
+        return frame
+
+    def frames(self) -> list:
+        """returns all complete frames"""
+        frames = []
+        frame = self.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.next_frame()
+        return frames
+
+    def pop_unterminated_json(self) -> (bytes, None):
+        """
+        returns a complete json document at the start of the buffer even if the delimiter is missing,
+        for peers sending single messages without newline
+        """
+        if self.length_prefixed or not self._consume_pending_delimiter() or not len(self):
+            return None
+        data = bytes(self.buffer[self._start:])
+        try:
+            text = data.decode()
+        except UnicodeDecodeError as e:  # e.g. a character cut off at the end, the json may be complete before
+            text = data[:e.start].decode()
+        try:
+            _, end = json.JSONDecoder().raw_decode(text.lstrip())
+        except json.decoder.JSONDecodeError:
+            return None
+        end += len(text) - len(text.lstrip())
+        frame = text[:end].encode()  # the bytes of the decoded prefix, so the offset is counted in bytes
+        self._start += len(frame)
+        self._scanned = self._start
+        self._skip_delimiter = True
+        return frame
+
+    def _consume_pending_delimiter(self) -> bool:
+        """
+        skips the delimiter of a json popped without it once it arrives, so it is not read as an empty frame.
+        False while too few bytes arrived to tell
+        """
+        if not self._skip_delimiter:
+            return True
+        if len(self) < len(self.delimiter):
+            return False
+        if self.buffer.startswith(self.delimiter, self._start):
+            self._start += len(self.delimiter)
+            self._scanned = max(self._scanned, self._start)
+        self._skip_delimiter = False
+        return True
 
 
 class SocketComm:
@@ -159,7 +398,16 @@ class SocketComm:
     Socket communication class
     """
 
-    def __init__(self, type: str = "server", host: str = "localhost", port: int = 8800, use_ssl: bool = False):
+    def __init__(self, type: str = "server", host: str = "localhost", port: int = 8800, use_ssl: bool = False,
+                 cert_file: str = None, key_file: str = None, ca_file: str = None,
+                 connect_timeout: float = CONNECT_TIMEOUT):
+        """
+        :param use_ssl: encrypt the link with TLS
+        :param connect_timeout: s a client waits for the server to accept the connection
+        :param cert_file: certificate of the server, defaults to config.SSL_CERT_FILE
+        :param key_file: private key of the server certificate, defaults to config.SSL_KEY_FILE
+        :param ca_file: certificates the client trusts, defaults to config.SSL_CA_FILE
+        """
         self.acception_thread = None
         self.ssl_sock = None
         self.sock = None
@@ -168,24 +416,33 @@ class SocketComm:
         self.type = type
         self.host = host
         self.port = port
+        self.use_ssl = use_ssl
+        self.tls_session = None  # session of the last TLS connection, reused to skip the full handshake
+        self.connect_timeout = connect_timeout
         if self.type == "server":
             self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            cert_file = cert_file or SSL_CERT_FILE
+            if cert_file:
+                self.context.load_cert_chain(cert_file, key_file or SSL_KEY_FILE)
         else:
-            self.context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        # self.context.set_ciphers('DEFAULT')
-        self.use_ssl = use_ssl
-        # this doesnt work yet get some weird error from ssl module
+            self.context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=ca_file or SSL_CA_FILE)
         self.connected = False
         self.stop_event = threading.Event()
         self.log = logging.getLogger(f"SocketComm_{self.type}")
         self.log.setLevel(logging.DEBUG)
         self.message_time = time.monotonic()
+        self.reader = FrameReader()  # receive buffer, keeps partial messages between reads
+        self.send_lock = threading.RLock()  # messages can be send from several threads, e.g. heartbeats
+        self.framing = FRAMING_NEWLINE
+        self.allowed_framings = (FRAMING_NEWLINE, FRAMING_LENGTH)  # framings a server accepts if asked
 
     def create_socket(self):
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if self.type == 'client':
             pass
         elif self.type == 'server':
+            # listen again right away after a connection was closed, e.g. when a client reconnects
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             try:
                 self._sock.bind((self.host, self.port))
             except OSError:
@@ -195,7 +452,8 @@ class SocketComm:
                 self._ssl_sock = self.context.wrap_socket(self._sock, server_side=True, do_handshake_on_connect=False)
 
     def accept_connection(self):
-        self.create_socket()
+        if (self._ssl_sock if self.use_ssl else self._sock) is None:  # keep listening after close_connection
+            self.create_socket()
         while not self.stop_event.is_set():
             if time.monotonic() - self.message_time > 5:
                 self.message_time = time.monotonic()
@@ -204,7 +462,16 @@ class SocketComm:
                 ready, _, _ = select.select([self._ssl_sock], [], [], 0.1)
                 if ready:
                     self.ssl_sock, self.addr = self._ssl_sock.accept()
+                    try:
+                        self._do_handshake(self.ssl_sock)
+                    except (OSError, TimeoutError) as e:  # ssl.SSLError is an OSError
+                        self.log.warning(f"TLS handshake with {self.addr} failed: {e}")
+                        self.ssl_sock.close()
+                        self.ssl_sock = None
+                        continue
+                    self.ssl_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                     self.ssl_sock.settimeout(0.1)
+                    self.reader.clear()
                     self.connected = True
                     self.log.info(f"Connected to {self.addr}")
                     break
@@ -212,7 +479,9 @@ class SocketComm:
                 ready, _, _ = select.select([self._sock], [], [], 0.1)
                 if ready:
                     self.sock, self.addr = self._sock.accept()
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                     self.sock.settimeout(0.1)
+                    self.reader.clear()
                     self.connected = True
                     self.log.info(f"Connected to {self.addr}")
                     break
@@ -239,91 +508,263 @@ class SocketComm:
         Connects to the server
         """
         if self.type == 'client':
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # small control messages
+            self._sock.settimeout(self.connect_timeout)
+            self._sock.connect((self.host, self.port))
             if self.use_ssl:
-                self.ssl_sock = self.context.wrap_socket(self._sock, server_hostname=self.host,
-                                                         do_handshake_on_connect=False)
+                # wrapping detaches self._sock, from here on only ssl_sock is used
+                ssl_sock = self.context.wrap_socket(self._sock, server_hostname=self.host,
+                                                    do_handshake_on_connect=False, session=self.tls_session)
+                self._do_handshake(ssl_sock)
+                ssl_sock.settimeout(0.1)
+                with self.send_lock:
+                    self.ssl_sock = ssl_sock
+                self.log.debug(f"TLS connected, session reused: {ssl_sock.session_reused}")
             else:
-                self.sock = self._sock
-                self.sock.settimeout(0.1)  # otherwise we get issues if nothing is comming
-            self._connect(self.host, self.port)
+                self._sock.settimeout(0.1)  # otherwise we get issues if nothing is comming
+                with self.send_lock:
+                    self.sock = self._sock
+            self.reader.clear()
             self.connected = True
             return True
         else:
             return False
             # raise RuntimeError("Error: Cannot connect on server socket")
 
+    def _do_handshake(self, ssl_sock: ssl.SSLSocket, timeout: float = HANDSHAKE_TIMEOUT):
+        """runs the TLS handshake non-blocking, waiting on the socket with select in between"""
+        ssl_sock.setblocking(False)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                ssl_sock.do_handshake()
+                return
+            except ssl.SSLWantReadError:
+                wait_read, wait_write = [ssl_sock], []
+            except ssl.SSLWantWriteError:
+                wait_read, wait_write = [], [ssl_sock]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.stop_event.is_set():
+                raise TimeoutError("TLS handshake timed out")
+            select.select(wait_read, wait_write, [], min(remaining, 0.1))
+
+    @property
+    def session_reused(self) -> bool:
+        """True if the current TLS connection resumed a previous session"""
+        return self.ssl_sock is not None and self.ssl_sock.session_reused
+
     def close_socket(self):
-        if self.use_ssl:
-            if self.ssl_sock:
-                self.ssl_sock.close()
-            self._ssl_sock.close()
-        if self.sock:
-            self.sock.close()
-        if self._sock:
-            self._sock.close()
+        """closes all sockets, the object can be reused with create_socket and connect/accept_connection"""
+        if self.type == 'client' and self.ssl_sock is not None and self.ssl_sock.session is not None:
+            self.tls_session = self.ssl_sock.session  # tickets arrive after the handshake, so take it at the end
+        with self.send_lock:  # no send may use a socket while it is swapped
+            for sock in (self.ssl_sock, self._ssl_sock, self.sock, self._sock):
+                if sock:
+                    sock.close()
+            self.ssl_sock = self._ssl_sock = self.sock = self._sock = None
+        self.reader.clear()
+        self._set_framing(FRAMING_NEWLINE)
         self.connected = False
 
+    def close_connection(self):
+        """closes the connection to the client but keeps listening, accept_connection takes the next client"""
+        if self.type != 'server':
+            self.close_socket()
+            return
+        with self.send_lock:
+            for sock in (self.ssl_sock, self.sock):
+                if sock:
+                    sock.close()
+            self.ssl_sock = self.sock = None
+        self.reader.clear()
+        self._set_framing(FRAMING_NEWLINE)
+        self.connected = False
+
+    def reconnect(self) -> bool:
+        """opens a fresh connection to the server, raises OSError if the server is not reachable"""
+        self.close_socket()
+        self.create_socket()
+        return self.connect()
+
+    def _handle_control(self, message) -> bool:
+        """
+        answers heartbeats of a ConnectionSupervisor and framing requests,
+        returns True if message was one of them
+        """
+        if not isinstance(message, dict):
+            return False
+        message_type = message.get('type')
+        if message_type == MessageType.heartbeat.value:
+            self.send_json_message({'type': MessageType.heartbeat_ack.value, 'time': message.get('time')})
+            return True
+        if message_type == MessageType.framing.value:
+            mode = message.get('mode')
+            if self.type == 'server':
+                if mode not in self.allowed_framings:
+                    mode = self.framing  # refused, the client keeps the current framing
+                with self.send_lock:  # answer in the old framing, everything after in the new one
+                    self.send_json_message({'type': MessageType.framing.value, 'mode': mode})
+                    self._set_framing(mode)
+            elif mode in (FRAMING_NEWLINE, FRAMING_LENGTH):  # answer to negotiate_framing
+                self._set_framing(mode)
+            return True
+        return False
+
+    def _set_framing(self, mode: str):
+        self.framing = mode
+        self.reader.set_length_prefixed(mode == FRAMING_LENGTH)
+        if mode != FRAMING_NEWLINE:
+            self.log.debug(f"Using {mode} framing")
+
+    def negotiate_framing(self, mode: str = FRAMING_LENGTH, timeout: float = 1) -> list:
+        """
+        asks the server to switch to another framing, the framing in use afterwards is in self.framing.
+        Call it right after connecting, nothing may be sent until the answer arrived. Servers not knowing
+        framing messages do not answer, then the newline framing stays.
+        Returns the messages which were received while waiting for the answer.
+        """
+        self.send_json_message({'type': MessageType.framing.value, 'mode': mode})
+        received = []
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            framing = self.framing
+            received.extend(self.read_json_messages())
+            if self.framing != framing or self.framing == mode:
+                break
+        return received
+
+    def _decode(self, frame: bytes) -> dict:
+        if self.framing == FRAMING_LENGTH:
+            return decode_body(frame)
+        return json.loads(frame.decode())
+
+    def _encode(self, message: dict) -> bytes:
+        if self.framing == FRAMING_LENGTH:
+            body = encode_body(message)
+            return FrameReader.LENGTH_HEADER.pack(len(body)) + body
+        return encode_message(message)
+
     def read_json_message(self) -> dict:
         try:
             message = self._recv_until(b'\n')
             if message is not None:
-                message = json.loads(message.decode())
+                message = self._decode(message)
             else:
                 return message
-        except json.decoder.JSONDecodeError:
+        except ValueError:  # broken json or unknown binary body
+            message = None
+        if self._handle_control(message):
             message = None
         return message
 
 
 
     def read_json_message_fast(self) -> dict:
+        """
+        returns the next message without blocking for more than one socket timeout,
+        None if no complete message arrived yet
+        """
         try:
-            message = self._recv(1024)
-            if message == -1:
-                return SocketMessage.client_disconnected
+            message = self.reader.next_frame()
+            if message is None:
+                received = self._fill_buffer()
+                if received == -1:
+                    return SocketMessage.client_disconnected
+                message = self.reader.next_frame()
+                if message is None:
+                    message = self.reader.pop_unterminated_json()
             if message is not None:
-                message = json.loads(message.decode())
+                message = self._decode(message)
             else:
                 return message
-        except json.decoder.JSONDecodeError:
+        except ValueError:  # broken json or unknown binary body
             message = None
             print('message decoding failed')
+        if self._handle_control(message):
+            message = None
         return message
 
+    def read_json_messages(self) -> list:
+        """returns all complete messages received so far, reading the socket once"""
+        received = self._fill_buffer()
+        messages = []
+        frame = self.reader.next_frame()
+        while frame is not None:  # frame by frame, a framing message changes how the rest is split
+            try:
+                message = self._decode(frame)
+            except ValueError:
+                self.log.warning('message decoding failed')
+            else:
+                if not self._handle_control(message):
+                    messages.append(message)
+            frame = self.reader.next_frame()
+        if received == -1:
+            messages.append(SocketMessage.client_disconnected)
+        return messages
+
     def read_json_message_fast_linebreak(self) -> dict:
         try:
             message = self._recv_until(b'\n')
             if message == -1:
                 return SocketMessage.client_disconnected
             if message is not None:
-                message = json.loads(message.decode())
-        except json.decoder.JSONDecodeError:
+                message = self._decode(message)
+        except ValueError:  # broken json or unknown binary body
             message = None
             print('message decoding failed')
         except OSError:
             message = None
             print('socket disconnected and deleted')
+        if self._handle_control(message):
+            message = None
         return message
 
+    def subscribe(self, topics: list):
+        """subscribes to events of an EventBus on the server"""
+        topics = [topic.value if isinstance(topic, Enum) else topic for topic in topics]
+        self.send_json_message({'type': MessageType.subscribe.value, 'topics': topics})
+
+    def unsubscribe(self, topics: list = None):
+        """unsubscribes from topics, from all if topics is None"""
+        message = {'type': MessageType.unsubscribe.value}
+        if topics is not None:
+            message['topics'] = [topic.value if isinstance(topic, Enum) else topic for topic in topics]
+        self.send_json_message(message)
+
+    def send_trigger(self):
+        """fires the laser via a TriggerEndpoint, which only reads newline framing"""
+        if self.framing != FRAMING_NEWLINE:
+            raise RuntimeError(f"TriggerEndpoint does not understand {self.framing} framing")
+        self.send_encoded(TriggerEndpoint.TRIGGER_FRAME + b'\n')
+
     def send_json_message(self, message: dict):
-        message = json.dumps(message).encode()
-        message += b'\n'
-        self._send(message)
+        with self.send_lock:
+            self._send(self._encode(message))
 
-    def _connect(self, host, port):
-        if self.use_ssl:
-            self.ssl_sock.connect((host, port))
-        else:
-            self.sock.connect((host, port))
+    def send_encoded(self, data: bytes):
+        """sends an already encoded (newline terminated json) message, e.g. from SocketMessage.encode"""
+        with self.send_lock:
+            if self.framing == FRAMING_LENGTH:
+                body = data[:-1] if data.endswith(b'\n') else data
+                data = FrameReader.LENGTH_HEADER.pack(len(body)) + body
+            self._send(data)
 
     def _send(self, data):
         try:
-            if self.use_ssl:
-                self.ssl_sock.sendall(data)
-            else:
-                self.sock.sendall(data)
-        except ConnectionResetError:
+            with self.send_lock:
+                if self.use_ssl:
+                    self.ssl_sock.sendall(data)
+                else:
+                    self.sock.sendall(data)
+        except (ConnectionResetError, BrokenPipeError):
             self.log.error("Connection reset by peer")
+            self.connected = False
+        except AttributeError:  # socket closed by close_socket in between
+            self.log.error("Not connected, message dropped")
+            self.connected = False
+        except OSError as e:  # socket.timeout, ETIMEDOUT, ...
+            self.log.error(f"Sending failed: {e}")
+            self.connected = False
 
     def _recv(self, size) -> (bytes, int):
         try:
@@ -333,41 +774,659 @@ class SocketComm:
                 return self.sock.recv(size)
         except socket.timeout:
             return None
-        except ConnectionResetError:
+        except ssl.SSLWantReadError:  # only part of a TLS record arrived
+            return None
+        except (ConnectionResetError, ssl.SSLEOFError, ssl.SSLZeroReturnError):
             self.log.warning("Client disconnected")
             return -1
 
-    def _recv_until(self, delimiter) -> bytes:
-        data = b''
-        try:
-            if self.use_ssl:
-                while not data.endswith(delimiter):
-                    data += self.ssl_sock.recv(1)
-            else:
-                while not data.endswith(delimiter):
-                    data += self.sock.recv(1)
-        except socket.timeout:
-            data = None
-        except ConnectionResetError:
+    def _fill_buffer(self) -> (int, None):
+        """
+        reads one chunk from the socket into the receive buffer
+        returns number of bytes read, None on timeout and -1 if the peer disconnected
+        """
+        data = self._recv(RECV_SIZE)
+        if data is None or data == -1:
+            return data
+        if not data:  # orderly shutdown by peer
             self.log.warning("Client disconnected")
-            data = -1
-        return data
+            return -1
+        self.reader.feed(data)
+        return len(data)
+
+    def _recv_until(self, delimiter) -> bytes:
+        """returns the next frame ending with delimiter, None on timeout and -1 if the peer disconnected"""
+        self.reader.delimiter = delimiter
+        data = self.reader.next_frame()
+        while data is None:
+            received = self._fill_buffer()
+            if received is None or received == -1:
+                return received
+            data = self.reader.next_frame()
+        return data if self.reader.length_prefixed else data + delimiter
 
     def _recv_all(self):
-        data = b''
-        if self.use_ssl:
-            while True:
-                try:
-                    data += self.ssl_sock.recv(1024)
-                except socket.timeout:
+        chunks = []
+        while True:
+            data = self._recv(RECV_SIZE)
+            if not data or data == -1:
+                break
+            chunks.append(data)
+        return b''.join(chunks)
+
+
+class ConnectionSupervisor:
+    """
+    Keeps a client SocketComm connected. A background thread reads all messages into a queue (read them with
+    read_json_message), sends heartbeats and tracks the round trip time. If the peer stops answering or the
+    connection breaks, it reconnects with exponential backoff and calls on_reconnect.
+    The supervisor does not restore the session on the peer: on_reconnect has to send again whatever the peer
+    needs to continue, e.g. session_id, fps and setting files with the start messages of a SocketMessage.
+    Only one heartbeat is sent per connection until the peer answers it, peers which never answer heartbeats
+    (older SocketComm versions) get no further ones and are only considered dead once the connection breaks.
+    """
+
+    def __init__(self, comm: SocketComm, heartbeat_interval: float = 0.2,
+                 timeout: float = 0.6, backoff_start: float = 0.05, backoff_max: float = 1.0,
+                 on_reconnect=None):
+        self.comm = comm
+        self.heartbeat_interval = heartbeat_interval
+        self.timeout = timeout  # s without any data after which the peer counts as dead
+        self.backoff_start = backoff_start
+        self.backoff_max = backoff_max
+        self.on_reconnect = on_reconnect  # called with the comm after every reconnect, restores the session
+        self.inbox = queue.Queue()
+        self.rtt = None  # last round trip time in s
+        self.rtts = deque(maxlen=100)
+        self.reconnects = 0
+        self.peer_answers_heartbeats = False
+        self._heartbeat_probed = False  # the first heartbeat of the connection was sent
+        self._last_received = time.monotonic()
+        self._last_heartbeat = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.log = logging.getLogger(f"ConnectionSupervisor_{comm.host}:{comm.port}")
+
+    @property
+    def connected(self) -> bool:
+        return self.comm.connected
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def read_json_message(self, timeout: float = 0) -> (dict, None):
+        """next received message, None if there is none within timeout"""
+        try:
+            return self.inbox.get(timeout=timeout) if timeout else self.inbox.get_nowait()
+        except queue.Empty:
+            return None
+
+    def send_json_message(self, message: dict) -> bool:
+        if not self.comm.connected:
+            self.log.warning(f"Not connected, dropping {message.get('type')} message")
+            return False
+        self.comm.send_json_message(message)
+        return self.comm.connected
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if not self.comm.connected:
+                self._reconnect()
+                continue
+            try:
+                messages = self.comm.read_json_messages()
+            except OSError:
+                messages = [SocketMessage.client_disconnected]
+            now = time.monotonic()
+            for message in messages:
+                if message is SocketMessage.client_disconnected:
+                    self.comm.connected = False
                     break
+                self._last_received = now
+                if message.get('type') == MessageType.heartbeat_ack.value:
+                    self.peer_answers_heartbeats = True
+                    if message.get('time') is not None:
+                        self.rtt = time.perf_counter() - message['time']
+                        self.rtts.append(self.rtt)
+                else:
+                    self.inbox.put(message)
+            if not self.comm.connected:
+                continue
+            if (now - self._last_heartbeat >= self.heartbeat_interval
+                    and (self.peer_answers_heartbeats or not self._heartbeat_probed)):
+                self._heartbeat_probed = True
+                self._last_heartbeat = now
+                self.comm.send_json_message({'type': MessageType.heartbeat.value, 'time': time.perf_counter()})
+            if self.peer_answers_heartbeats and now - self._last_received > self.timeout:
+                self.log.warning(f"No answer for {now - self._last_received:.2f}s, reconnecting")
+                self.comm.connected = False
+
+    def _reconnect(self):
+        backoff = self.backoff_start
+        while not self.stop_event.is_set():
+            try:
+                self.comm.reconnect()
+                break
+            except OSError as e:
+                self.log.debug(f"Reconnect failed ({e}), retrying in {backoff:.2f}s")
+                self.stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.backoff_max)
         else:
-            while True:
+            return
+        self.reconnects += 1
+        self._heartbeat_probed = False
+        self._last_received = time.monotonic()
+        self.log.info(f"Reconnected to {self.comm.host}:{self.comm.port}")
+        if self.on_reconnect is not None:
+            self.on_reconnect(self.comm)
+
+
+class ClientConnection:
+    """State of one client of SocketServer, with its own read buffer and write queue"""
+
+    def __init__(self, sock: socket.socket, addr):
+        self.sock = sock
+        self.addr = addr
+        self.reader = FrameReader()
+        self.out_buffer = bytearray()  # encoded messages not yet accepted by the socket
+        self.closed = False
+
+    def __repr__(self):
+        return f"ClientConnection({self.addr})"
+
+
+class SocketServer:
+    """
+    Socket server for many concurrent clients, e.g. DAQ, video and behaviour controllers.
+    All clients are served from one background thread via selectors. Sockets are non-blocking and every
+    client has its own read buffer and write queue, so a slow client never stalls the others. Clients whose
+    write queue grows beyond max_queue_bytes are disconnected.
+    Received messages are dispatched by their 'type' to the handlers registered with register_handler.
+    Handlers run on the server thread and should return quickly. Disconnects requested from other threads are
+    queued and carried out by the server thread, which alone touches the selector and the client list.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 8800, max_queue_bytes: int = 1 << 20):
+        self.host = host
+        self.port = port
+        self.max_queue_bytes = max_queue_bytes
+        self.handlers = {}
+        self.default_handler = None
+        self.clients = []
+        self.selector = None
+        self._sock = None
+        self._lock = threading.Lock()  # guards the write queues, which are filled from other threads
+        self._pending_disconnects = []  # clients closed from other threads, removed by the server thread
+        self._wake_r, self._wake_w = None, None
+        self.serve_thread = None
+        self.stop_event = threading.Event()
+        self.log = logging.getLogger("SocketServer")
+        self.register_handler(MessageType.heartbeat, self._answer_heartbeat)
+
+    def register_handler(self, message_type: (MessageType, str), handler):
+        """
+        handler(client, message) is called for every received message of this type. Several handlers can be
+        registered for one type, they are called in the order of registration.
+        """
+        if isinstance(message_type, MessageType):
+            message_type = message_type.value
+        handlers = self.handlers.setdefault(message_type, [])
+        if handler not in handlers:
+            handlers.append(handler)
+
+    def unregister_handler(self, message_type: (MessageType, str), handler):
+        if isinstance(message_type, MessageType):
+            message_type = message_type.value
+        handlers = self.handlers.get(message_type, [])
+        if handler in handlers:
+            handlers.remove(handler)
+
+    def start(self):
+        """starts listening and serving in a background thread"""
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen()
+        self._sock.setblocking(False)
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self._sock, selectors.EVENT_READ, None)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self.stop_event.clear()
+        self.serve_thread = threading.Thread(target=self.serve, daemon=True)
+        self.serve_thread.start()
+        self.log.info(f"Listening on {self.host}:{self.port}")
+
+    def stop(self):
+        self.stop_event.set()
+        self._wake()
+        if self.serve_thread is not None:
+            self.serve_thread.join()
+            self.serve_thread = None
+
+    def serve(self):
+        try:
+            while not self.stop_event.is_set():
+                for key, events in self.selector.select(timeout=0.1):
+                    if key.fileobj is self._sock:
+                        self._accept()
+                    elif key.fileobj is self._wake_r:
+                        self._drain_wake()
+                    else:
+                        client = key.data
+                        if events & selectors.EVENT_READ and not client.closed:
+                            self._read(client)
+                        if events & selectors.EVENT_WRITE and not client.closed:
+                            self._write(client)
+                self._remove_pending_disconnects()
+                self._update_interest()
+        finally:
+            self._remove_pending_disconnects()
+            for client in list(self.clients):
+                self.disconnect(client)
+            self.selector.close()
+            self._sock.close()
+            self._wake_r.close()
+            self._wake_w.close()
+            self.log.info("Server stopped")
+
+    def send(self, client: ClientConnection, message: dict) -> bool:
+        """queues a message for one client, can be called from any thread"""
+        return self.send_bytes(client, encode_message(message))
+
+    def send_bytes(self, client: ClientConnection, data: bytes) -> bool:
+        with self._lock:
+            if client.closed:
+                return False
+            if len(client.out_buffer) + len(data) > self.max_queue_bytes:
+                overflow = True
+            else:
+                overflow = False
+                client.out_buffer += data
+        if overflow:
+            self.log.warning(f"Write queue of {client.addr} is full, disconnecting slow client")
+            self.disconnect(client)
+            return False
+        self._wake()
+        return True
+
+    def broadcast(self, message: dict):
+        """queues a message, e.g. a status, for all connected clients"""
+        data = encode_message(message)
+        for client in list(self.clients):
+            self.send_bytes(client, data)
+
+    def disconnect(self, client: ClientConnection):
+        """closes a client, can be called from any thread"""
+        with self._lock:
+            if client.closed:
+                return
+            client.closed = True  # no further messages are queued
+            if self.serve_thread is not None and threading.current_thread() is not self.serve_thread:
+                self._pending_disconnects.append(client)
+                queued = True
+            else:
+                queued = False
+        if queued:
+            self._wake()
+        else:
+            self._remove_client(client)
+
+    def _remove_pending_disconnects(self):
+        with self._lock:
+            pending, self._pending_disconnects = self._pending_disconnects, []
+        for client in pending:
+            self._remove_client(client)
+
+    def _remove_client(self, client: ClientConnection):
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+        if client in self.clients:
+            self.clients.remove(client)
+        self.log.info(f"{client.addr} disconnected")
+        self._dispatch(client, SocketMessage.client_disconnected)
+
+    def _answer_heartbeat(self, client: ClientConnection, message: dict):
+        self.send(client, {'type': MessageType.heartbeat_ack.value, 'time': message.get('time')})
+
+    def _wake(self):
+        """interrupts select, so new write requests are picked up immediately"""
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError, AttributeError):
+            pass  # already woken up or not running
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _accept(self):
+        try:
+            sock, addr = self._sock.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        client = ClientConnection(sock, addr)
+        self.clients.append(client)
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        self.log.info(f"Connected to {addr}")
+
+    def _read(self, client: ClientConnection):
+        try:
+            data = client.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except (ConnectionResetError, OSError):
+            data = b''
+        if not data:
+            self.disconnect(client)
+            return
+        client.reader.feed(data)
+        for frame in client.reader.frames():
+            try:
+                message = json.loads(frame.decode())
+            except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+                self.log.warning(f'message decoding failed from {client.addr}')
+                continue
+            self._dispatch(client, message)
+
+    def _dispatch(self, client: ClientConnection, message: dict):
+        handlers = self.handlers.get(message.get('type') if isinstance(message, dict) else None)
+        if not handlers:
+            handlers = [] if self.default_handler is None else [self.default_handler]
+        if not handlers:
+            self.log.debug(f"No handler for {message}")
+            return
+        for handler in list(handlers):
+            try:
+                handler(client, message)
+            except Exception as e:  # a failing handler must not take down the server
+                self.log.error(f"Handler for {message.get('type')} failed: {e}")
+
+    def _write(self, client: ClientConnection):
+        with self._lock:
+            if not client.out_buffer:
+                return
+            try:
+                n_sent = client.sock.send(client.out_buffer)
+            except BlockingIOError:
+                return
+            except OSError:
+                n_sent = -1
+            if n_sent > 0:
+                del client.out_buffer[:n_sent]
+        if n_sent < 0:
+            self.disconnect(client)
+
+    def _update_interest(self):
+        for client in list(self.clients):
+            with self._lock:
+                if client.closed:
+                    continue
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.out_buffer else 0)
+            try:
+                if self.selector.get_key(client.sock).events != events:
+                    self.selector.modify(client.sock, events, client)
+            except (KeyError, ValueError):  # removed meanwhile
+                continue
+
+
+class EventTopic(Enum):
+    laser_edge = 'laser.edge'
+    laser_trigger = 'laser.trigger'
+    trial_end = 'trial.end'
+    board_stats = 'board.stats'
+    transfer_progress = 'transfer.progress'
+    transfer_done = 'transfer.done'
+
+
+class Subscription:
+    """Topics and bounded event queue of one subscriber"""
+
+    def __init__(self, client: ClientConnection, max_events: int):
+        self.client = client
+        self.topics = set()
+        self.events = deque(maxlen=max_events)  # oldest events are dropped if the subscriber lags
+        self.dropped = 0
+
+
+class EventBus:
+    """
+    Publish/subscribe layer on top of SocketServer. Clients send {'type': 'subscribe', 'topics': [...]} and
+    receive batches {'type': 'event', 'events': [...], 'dropped': n} every flush_interval seconds.
+    Every subscriber has a bounded queue, if it lags behind the oldest events are dropped and counted.
+    publish can be called from any thread.
+    """
+
+    def __init__(self, server: SocketServer, flush_interval: float = 0.01, max_events: int = 1000):
+        self.server = server
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.subscriptions = {}  # client -> Subscription
+        self._lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.flush_thread = None
+        self.log = logging.getLogger("EventBus")
+        server.register_handler(MessageType.subscribe, self._subscribe)
+        server.register_handler(MessageType.unsubscribe, self._unsubscribe)
+        server.register_handler(MessageType.disconnected, self._client_disconnected)
+
+    def start(self):
+        self.stop_event.clear()
+        self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flush_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+            self.flush_thread = None
+        self.flush()
+
+    def publish(self, topic: (EventTopic, str), data: dict = None, timestamp: float = None):
+        """queues an event for all subscribers of topic"""
+        if isinstance(topic, EventTopic):
+            topic = topic.value
+        event = {'topic': topic, 'time': time.time() if timestamp is None else timestamp, 'data': data}
+        with self._lock:
+            for subscription in self.subscriptions.values():
+                if topic in subscription.topics:
+                    if len(subscription.events) == subscription.events.maxlen:
+                        subscription.dropped += 1
+                    subscription.events.append(event)
+
+    def flush(self):
+        """sends all queued events, one batch per subscriber"""
+        with self._lock:
+            batches = []
+            for subscription in self.subscriptions.values():
+                if subscription.events:
+                    batches.append((subscription.client, list(subscription.events), subscription.dropped))
+                    subscription.events.clear()
+        for client, events, dropped in batches:
+            message = {'type': MessageType.event.value, 'events': events, 'dropped': dropped}
+            try:
+                self.server.send(client, message)
+            except (TypeError, ValueError):  # an event is not json serializable, send the others
+                message['events'] = [event for event in events if self._serializable(event)]
+                if message['events']:
+                    self.server.send(client, message)
+
+    def _serializable(self, event: dict) -> bool:
+        try:
+            json.dumps(event)
+            return True
+        except (TypeError, ValueError) as e:
+            self.log.error(f"Dropping event of {event['topic']}, data is not json serializable: {e}")
+            return False
+
+    def drop_counts(self) -> dict:
+        with self._lock:
+            return {subscription.client.addr: subscription.dropped for subscription in self.subscriptions.values()}
+
+    def _flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def _subscribe(self, client: ClientConnection, message: dict):
+        with self._lock:
+            subscription = self.subscriptions.setdefault(client, Subscription(client, self.max_events))
+            subscription.topics.update(message.get('topics', []))
+        self.log.info(f"{client.addr} subscribed to {message.get('topics', [])}")
+
+    def _unsubscribe(self, client: ClientConnection, message: dict):
+        with self._lock:
+            subscription = self.subscriptions.get(client)
+            if subscription is None:
+                return
+            subscription.topics.difference_update(message.get('topics', subscription.topics.copy()))
+            if not subscription.topics:
+                del self.subscriptions[client]
+
+    def _client_disconnected(self, client: ClientConnection, message: dict):
+        with self._lock:
+            self.subscriptions.pop(client, None)
+
+
+class TriggerEndpoint:
+    """
+    Fast path for remote triggers of the laser. Listens on its own port and handles 'trigger' messages on a
+    dedicated thread, calling trigger_callback(t_received) right away. Sockets use TCP_NODELAY, the trigger and
+    acknowledge frames are encoded once in advance. Peers not in allowed_hosts are refused.
+    The trigger latency, from socket receive (t_received, perf_counter_ns) to the serial write, is recorded by
+    whoever writes the frame to the serial port, via record_latency.
+    """
+    TRIGGER_FRAME = encode_message({'type': MessageType.trigger.value}).rstrip(b'\n')
+    ACK = encode_message({'type': MessageType.response.value, 'status': MessageStatus.trigger_ok.value})
+
+    def __init__(self, trigger_callback, host: str = "127.0.0.1", port: int = 8810, event_bus: EventBus = None,
+                 n_latencies: int = 1000, allowed_hosts: list = None):
+        self.trigger_callback = trigger_callback
+        self.host = host
+        self.port = port
+        self.allowed_hosts = None if allowed_hosts is None else set(allowed_hosts)  # None: any peer
+        self.event_bus = event_bus  # if given, every trigger is published as laser.trigger event
+        self.latencies = deque(maxlen=n_latencies)  # ns from receive to serial write
+        self.selector = None
+        self._sock = None
+        self.readers = {}  # socket -> FrameReader
+        self.stop_event = threading.Event()
+        self.serve_thread = None
+        self.log = logging.getLogger("TriggerEndpoint")
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen()
+        self._sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self._sock, selectors.EVENT_READ)
+        self.stop_event.clear()
+        self.serve_thread = threading.Thread(target=self.serve, daemon=True)
+        self.serve_thread.start()
+        self.log.info(f"Trigger endpoint listening on {self.host}:{self.port}")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.serve_thread is not None:
+            self.serve_thread.join()
+            self.serve_thread = None
+
+    def serve(self):
+        try:
+            while not self.stop_event.is_set():
+                for key, _ in self.selector.select(timeout=0.1):
+                    if key.fileobj is self._sock:
+                        self._accept()
+                    else:
+                        self._read(key.fileobj)
+        finally:
+            for sock in list(self.readers):
+                self._close(sock)
+            self.selector.close()
+            self._sock.close()
+
+    def _accept(self):
+        try:
+            sock, addr = self._sock.accept()
+        except BlockingIOError:
+            return
+        if self.allowed_hosts is not None and addr[0] not in self.allowed_hosts:
+            self.log.warning(f"Refused trigger client {addr}, not in allowed hosts")
+            sock.close()
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self.readers[sock] = FrameReader()
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.log.info(f"Trigger client connected from {addr}")
+
+    def _close(self, sock: socket.socket):
+        self.selector.unregister(sock)
+        self.readers.pop(sock, None)
+        sock.close()
+
+    def _read(self, sock: socket.socket):
+        try:
+            data = sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        t_received = time.perf_counter_ns()
+        if not data:
+            self._close(sock)
+            return
+        reader = self.readers[sock]
+        reader.feed(data)
+        for frame in reader.frames():
+            if frame != self.TRIGGER_FRAME:  # other encodings of the message, e.g. different whitespace
                 try:
-                    data += self.sock.recv(1024)
-                except socket.timeout:
-                    break
-        return data
+                    if json.loads(frame.decode()).get('type') != MessageType.trigger.value:
+                        continue
+                except (json.decoder.JSONDecodeError, UnicodeDecodeError, AttributeError):
+                    continue
+            try:
+                self.trigger_callback(t_received)
+            except Exception:  # a failing callback must not end the endpoint thread
+                self.log.exception("Trigger callback failed")
+                continue
+            try:
+                sock.send(self.ACK)
+            except OSError:
+                pass
+
+    def record_latency(self, t_received: int):
+        """called once the trigger received at t_received (perf_counter_ns) was written to the serial port"""
+        latency = time.perf_counter_ns() - t_received
+        self.latencies.append(latency)
+        if self.event_bus is not None:
+            self.event_bus.publish(EventTopic.laser_trigger, {'source': 'network', 'latency_us': latency / 1000})
+
+    def latency_stats(self) -> dict:
+        """statistics in us of the host side trigger latency"""
+        if not self.latencies:
+            return {'n': 0}
+        latencies = sorted(self.latencies)
+        n = len(latencies)
+        return {'n': n, 'mean': sum(latencies) / n / 1000, 'p50': latencies[n // 2] / 1000,
+                'p99': latencies[min(n - 1, int(n * 0.99))] / 1000, 'max': latencies[-1] / 1000}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,316 @@
+"""
+Columnar storage of the trials of a session. Every field (e.g. DataWriter.fieldnames) is kept as one NumPy array:
+numbers as float64 with NaN where the trial had None, strings as object arrays, plus a boolean mask per field
+which is True where the trial had a value. Sessions are saved as .npz next to the session JSON, or as one .npy
+per column which can be memory mapped.
+make_trial_math_batch derives the fields of DataWriter.make_trial_math for whole sessions at once.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+FLOAT = 'float'
+STRING = 'str'
+MASK_SUFFIX = '__mask'
+FIELDS_KEY = '__fields__'
+DERIVED_FIELDS = ('duration', 'time_to_NPd', 'time_to_NPc', 'time_to_lick', 'choice', 'tone_dur',
+                  'NP_exitR', 'NP_exitL', 'NP_exitC')  # fields set by DataWriter.make_trial_math
+
+
+class TrialStore:
+    """
+    Trials as columns, appending is amortised O(1) as the arrays grow by doubling.
+    The kind of a column (float or str) is taken from its first value which is not None, values which are
+    neither numbers nor strings (e.g. nested laser parameters) are not stored.
+    """
+
+    def __init__(self, fieldnames: list, capacity: int = 256):
+        self.fieldnames = list(fieldnames)
+        self.capacity = max(capacity, 1)
+        self.n_trials = 0
+        self.kinds = {name: None for name in self.fieldnames}  # None until the first value arrives
+        self._values = {}  # name -> array of capacity entries
+        self._masks = {name: np.zeros(self.capacity, dtype=bool) for name in self.fieldnames}
+
+    def __len__(self):
+        return self.n_trials
+
+    def append(self, trial: dict):
+        if self.n_trials == self.capacity:
+            self._grow(self.capacity * 2)
+        row = self.n_trials
+        for name in self.fieldnames:
+            value = trial.get(name)
+            if value is None:
+                continue
+            kind = STRING if isinstance(value, str) else FLOAT if isinstance(value, (int, float)) else None
+            if kind is None:
+                continue
+            if self.kinds[name] is None:
+                self._add_column(name, kind)
+            elif self.kinds[name] != kind:
+                self._to_string_column(name)
+                value = str(value)
+            self._values[name][row] = value
+            self._masks[name][row] = True
+        self.n_trials += 1
+
+    def extend(self, trials: list):
+        if self.n_trials + len(trials) > self.capacity:
+            self._grow(max(self.capacity * 2, self.n_trials + len(trials)))
+        for trial in trials:
+            self.append(trial)
+
+    def column(self, name: str) -> np.ndarray:
+        """values of a field for all trials (a view), NaN/None where the trial had None"""
+        if self.kinds[name] is None:
+            return np.full(self.n_trials, np.nan)
+        return self._values[name][:self.n_trials]
+
+    def mask(self, name: str) -> np.ndarray:
+        """True where the trial had a value for the field"""
+        return self._masks[name][:self.n_trials]
+
+    def set_column(self, name: str, values: np.ndarray, mask: np.ndarray = None):
+        """replaces (or adds) a field, mask defaults to the values which are not NaN/None"""
+        values = np.asarray(values)
+        if len(values) != self.n_trials:
+            raise ValueError(f"{name} has {len(values)} values for {self.n_trials} trials")
+        kind = FLOAT if values.dtype.kind in 'biuf' else STRING
+        if mask is None:
+            mask = ~np.isnan(values.astype(float)) if kind == FLOAT else np.array([v is not None for v in values],
+                                                                                   dtype=bool)
+        if name not in self.kinds:
+            self.fieldnames.append(name)
+            self._masks[name] = np.zeros(self.capacity, dtype=bool)
+        self.kinds[name] = None
+        self._add_column(name, kind)
+        self._values[name][:self.n_trials] = values
+        self._masks[name][:self.n_trials] = mask
+        if kind == FLOAT:
+            self._values[name][:self.n_trials][~mask] = np.nan
+        else:
+            self._values[name][:self.n_trials][~mask] = None
+
+    def to_trials(self) -> list:
+        """trials as list of dicts, None where the trial had no value. Numbers are returned as float"""
+        columns = [(name, self.column(name).tolist(), self.mask(name).tolist()) for name in self.fieldnames]
+        trials = []
+        for row in range(self.n_trials):
+            trials.append({name: values[row] if mask[row] else None for name, values, mask in columns})
+        return trials
+
+    @classmethod
+    def from_trials(cls, fieldnames: list, trials: list) -> 'TrialStore':
+        store = cls(fieldnames, capacity=len(trials))
+        store.extend(trials)
+        return store
+
+    @classmethod
+    def concatenate(cls, stores: list) -> 'TrialStore':
+        """one store with the trials of all stores, e.g. several sessions, in order"""
+        fieldnames = []
+        for store in stores:
+            fieldnames.extend(name for name in store.fieldnames if name not in fieldnames)
+        n_trials = sum(len(store) for store in stores)
+        result = cls(fieldnames, capacity=n_trials)
+        result.n_trials = n_trials
+        for name in fieldnames:
+            kinds = {store.kinds.get(name) for store in stores}
+            if kinds <= {None}:
+                continue
+            values, masks = [], []
+            for store in stores:
+                if store.kinds.get(name) is None:
+                    values.append(np.full(len(store), np.nan if STRING not in kinds else None))
+                    masks.append(np.zeros(len(store), dtype=bool))
+                    continue
+                column, mask = store.column(name), store.mask(name)
+                if STRING in kinds and store.kinds[name] == FLOAT:
+                    column = np.array([str(value) if valid else None for value, valid in zip(column, mask)],
+                                      dtype=object)
+                values.append(column)
+                masks.append(mask)
+            result.set_column(name, np.concatenate(values), np.concatenate(masks))
+        return result
+
+    @classmethod
+    def from_json(cls, json_file: (str, Path), fieldnames: list = None) -> 'TrialStore':
+        """columns of the trials of a session JSON written by DataWriter, fieldnames default to the keys of the
+        first trial"""
+        with open(json_file, 'r') as fi:
+            trials = json.load(fi).get('trials', [])
+        if fieldnames is None:
+            fieldnames = list(trials[0].keys()) if trials else []
+        return cls.from_trials(fieldnames, trials)
+
+    def save(self, npz_file: (str, Path)):
+        """saves all columns to one .npz file, strings as unicode arrays, so no pickling is needed to load"""
+        arrays = {FIELDS_KEY: np.array(self.fieldnames, dtype=str)}
+        for name in self.fieldnames:
+            arrays[name] = self._saveable(name)
+            arrays[name + MASK_SUFFIX] = self.mask(name)
+        np.savez(npz_file, **arrays)
+
+    @classmethod
+    def load(cls, npz_file: (str, Path)) -> 'TrialStore':
+        with np.load(npz_file, allow_pickle=False) as data:
+            return cls._from_arrays(list(data[FIELDS_KEY]), data)
+
+    def save_columns(self, directory: (str, Path)):
+        """saves every column (and mask) as its own .npy file, they can be loaded memory mapped"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        with open(directory / 'fields.json', 'w') as fo:
+            json.dump(self.fieldnames, fo)
+        for name in self.fieldnames:
+            np.save(directory / f'{name}.npy', self._saveable(name))
+            np.save(directory / f'{name}{MASK_SUFFIX}.npy', self.mask(name))
+
+    @classmethod
+    def load_columns(cls, directory: (str, Path), mmap: bool = True) -> 'TrialStore':
+        """
+        loads columns saved with save_columns, memory mapped unless mmap is False (data is copied on append).
+        The maps are copy-on-write, changes of the store (e.g. make_trial_math_batch) never reach the files.
+        """
+        directory = Path(directory)
+        with open(directory / 'fields.json', 'r') as fi:
+            fieldnames = json.load(fi)
+        mode = 'c' if mmap else None
+        arrays = {}
+        for name in fieldnames:
+            arrays[name] = np.load(directory / f'{name}.npy', mmap_mode=mode, allow_pickle=False)
+            arrays[name + MASK_SUFFIX] = np.load(directory / f'{name}{MASK_SUFFIX}.npy', mmap_mode=mode)
+        return cls._from_arrays(fieldnames, arrays)
+
+    @classmethod
+    def _from_arrays(cls, fieldnames: list, arrays) -> 'TrialStore':
+        n_trials = len(arrays[fieldnames[0] + MASK_SUFFIX]) if fieldnames else 0
+        store = cls(fieldnames, capacity=n_trials)
+        store.n_trials = n_trials
+        for name in fieldnames:
+            values = arrays[name]
+            store._masks[name][:n_trials] = arrays[name + MASK_SUFFIX]  # copied, the masks have capacity entries
+            if values.dtype.kind == 'U':
+                store.kinds[name] = STRING
+                store._values[name] = values.astype(object)
+                store._values[name][~store.mask(name)] = None
+            elif store.mask(name).any():
+                store.kinds[name] = FLOAT
+                if not values.flags.writeable:
+                    values = np.array(values)
+                store._values[name] = values  # stays memory mapped (copy-on-write) until the store grows
+        if store.capacity > n_trials:  # empty store, capacity is at least 1
+            store._grow(store.capacity)
+        return store
+
+    def _saveable(self, name: str) -> np.ndarray:
+        if self.kinds[name] == STRING:
+            return np.array(['' if value is None else value for value in self.column(name)], dtype=str)
+        return np.asarray(self.column(name), dtype=float)
+
+    def _add_column(self, name: str, kind: str):
+        self.kinds[name] = kind
+        if kind == FLOAT:
+            self._values[name] = np.full(self.capacity, np.nan)
+        else:
+            self._values[name] = np.full(self.capacity, None, dtype=object)
+
+    def _to_string_column(self, name: str):
+        """a field had numbers and strings, all are kept as strings from then on"""
+        values = self._values[name]
+        self.kinds[name] = STRING
+        self._values[name] = np.array([str(value) if mask else None
+                                       for value, mask in zip(values, self._masks[name])], dtype=object)
+
+    def _grow(self, capacity: int):
+        for name, values in self._values.items():
+            grown = np.full(capacity, np.nan) if self.kinds[name] == FLOAT else np.full(capacity, None, dtype=object)
+            grown[:self.n_trials] = values[:self.n_trials]
+            self._values[name] = grown
+        for name, mask in self._masks.items():
+            grown = np.zeros(capacity, dtype=bool)
+            grown[:self.n_trials] = mask[:self.n_trials]
+            self._masks[name] = grown
+        self.capacity = capacity
+
+
+def make_trial_math_batch(store: TrialStore) -> np.ndarray:
+    """
+    vectorised DataWriter.make_trial_math, sets DERIVED_FIELDS for all trials of store (in place) with the same
+    results. Trials for which make_trial_math raises (a value needed for a calculation is None) keep their
+    fields, like in DataWriter.injest_trial. Returns the mask of the trials which were derived.
+    """
+    n_trials = len(store)
+
+    def numeric(name: str):
+        if store.kinds.get(name) != FLOAT:
+            return np.full(n_trials, np.nan), np.zeros(n_trials, dtype=bool)
+        return store.column(name), store.mask(name)
+
+    start, has_start = numeric('trial_start_absolute')
+    end, has_end = numeric('trial_end_absolute')
+    poke, has_poke, gate, has_gate, poke_dur, has_poke_dur = {}, {}, {}, {}, {}, {}
+    for port in 'RLC':
+        poke[port], has_poke[port] = numeric(f'nose_poke_timing{port}')
+        gate[port], has_gate[port] = numeric(f'gate_opened{port}')
+        poke_dur[port], has_poke_dur[port] = numeric(f'nose_poke_duration{port}')
+    lick, has_lick = numeric('lick_start')
+    hit, has_hit = numeric('hit')
+    tone_on, has_tone_on = numeric('tone_on')
+    tone_off, has_tone_off = numeric('tone_off')
+
+    # trials where make_trial_math hits None in an arithmetic operation
+    derived = has_start & has_end
+    derived &= ~(has_poke['R'] & ~has_gate['R'])
+    derived &= ~(~has_poke['R'] & has_poke['L'] & ~has_gate['L'])
+    derived &= ~(has_poke['C'] & ~has_gate['C'])
+    for port in 'RLC':
+        derived &= ~(has_poke[port] & ~has_poke_dur[port])
+
+    results = {
+        'duration': (end - start, derived),
+        'time_to_NPd': (np.where(has_poke['R'], poke['R'] - gate['R'], poke['L'] - gate['L']),
+                        has_poke['R'] | has_poke['L']),
+        'time_to_NPc': (poke['C'] - gate['C'], has_poke['C']),
+        'time_to_lick': (lick - hit, has_lick & has_hit),
+        'choice': (np.where(has_poke['R'], 'right', np.where(has_poke['L'], 'left', 'None')).astype(object),
+                   np.ones(n_trials, dtype=bool)),
+        'tone_dur': (tone_off - tone_on, has_tone_on & has_tone_off),
+    }
+    for port in 'RLC':
+        results[f'NP_exit{port}'] = (poke[port] + poke_dur[port], has_poke[port])
+
+    for name, (values, mask) in results.items():
+        if store.kinds.get(name) is not None:  # trials which could not be derived keep their values
+            values = np.where(derived, values, store.column(name))
+            mask = np.where(derived, mask, store.mask(name))
+        else:
+            mask = mask & derived
+        store.set_column(name, values, mask)
+    return derived
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Re-derive the calculated trial fields of all sessions in a folder')
+    parser.add_argument('folder', type=str, help='Folder searched (recursively) for *_behav.json session files')
+    parser.add_argument('--save', action='store_true', help='Save the columns as .npz next to every session JSON')
+    args = parser.parse_args()
+
+    t_start = time.perf_counter()
+    sessions = sorted(Path(args.folder).rglob('*_behav.json'))
+    stores = [TrialStore.from_json(session) for session in sessions]
+    t_loaded = time.perf_counter()
+    archive = TrialStore.concatenate(stores)
+    derived = make_trial_math_batch(archive)
+    t_derived = time.perf_counter()
+    if args.save:
+        for session, store in zip(sessions, stores):
+            make_trial_math_batch(store)
+            store.save(session.with_suffix('.npz'))
+    print(f"{len(sessions)} sessions, {len(archive)} trials ({(~derived).sum()} not derivable): "
+          f"loading {t_loaded - t_start:.2f}s, deriving {t_derived - t_loaded:.3f}s")